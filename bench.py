@@ -0,0 +1,609 @@
+# -*- coding: utf-8 -*-
+"""วัดความเร็วแบบ offline (ไม่ยิง LINE จริง)
+
+ตัวอย่าง:
+    python bench.py push --groups 300 --latency 0.05 --rate-429 0.02
+    python bench.py suite --json bench_baseline.json
+    python bench.py suite --baseline bench_baseline.json --tolerance 0.3
+    python bench.py startup --budget-ms 800
+"""
+import os
+import re
+import sys
+import hmac
+import json
+import time
+import uuid
+import base64
+import random
+import hashlib
+import argparse
+import tempfile
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Any, Dict, List, Optional, Tuple
+# Mock LINE Messaging API
+class MockLineHandler(BaseHTTPRequestHandler):
+    """จำลอง endpoint ของ Messaging API ที่บอทใช้ (latency / 429 / error ตั้งค่าได้)"""
+    protocol_version = "HTTP/1.1"
+    # เขียน header+body ทีเดียว ไม่งั้น keep-alive โดน Nagle/delayed ACK หน่วง ~40ms
+    disable_nagle_algorithm = True
+    wbufsize = -1
+    def log_message(self, fmt, *args):
+        pass
+    def _send_json(self, status: int, payload: Dict[str, Any], headers: Optional[Dict[str, str]] = None) -> None:
+        body = json.dumps(payload).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        for k, v in (headers or {}).items():
+            self.send_header(k, v)
+        self.end_headers()
+        self.wfile.write(body)
+    def do_GET(self):
+        srv = self.server
+        with srv.lock:
+            srv.calls += 1
+        if srv.latency:
+            time.sleep(srv.latency)
+        m = re.match(r"^/v2/bot/group/([^/]+)/summary$", self.path)
+        if m:
+            gid = m.group(1)
+            self._send_json(200, {"groupId": gid, "groupName": srv.group_names.get(gid, f"group {gid}")})
+            return
+        self._send_json(404, {"message": "Not found"})
+    def do_POST(self):
+        srv = self.server
+        length = int(self.headers.get("Content-Length") or 0)
+        if length:
+            self.rfile.read(length)
+        with srv.lock:
+            srv.calls += 1
+        if srv.latency:
+            time.sleep(srv.latency)
+        roll = random.random()
+        if roll < srv.rate_429:
+            with srv.lock:
+                srv.throttled += 1
+            self._send_json(429, {"message": "The API rate limit has been exceeded. Try again later."}, {"Retry-After": "0"})
+            return
+        if roll < srv.rate_429 + srv.rate_error:
+            self._send_json(500, {"message": "Internal server error"})
+            return
+        self._send_json(200, {"sentMessages": [{"id": str(srv.calls)}]})
+class QuietHTTPServer(ThreadingHTTPServer):
+    """client ปิด connection กลางทาง (เช่น race ยกเลิกแหล่งที่ช้ากว่า) ไม่ต้องพิมพ์ traceback"""
+    daemon_threads = True
+    def handle_error(self, request, client_address):
+        if not isinstance(sys.exc_info()[1], (ConnectionResetError, BrokenPipeError)):
+            super().handle_error(request, client_address)
+def start_mock_line(latency: float = 0.0, rate_429: float = 0.0, rate_error: float = 0.0) -> ThreadingHTTPServer:
+    srv = QuietHTTPServer(("127.0.0.1", 0), MockLineHandler)
+    srv.daemon_threads = True
+    srv.latency = latency
+    srv.rate_429 = rate_429
+    srv.rate_error = rate_error
+    srv.calls = 0
+    srv.throttled = 0
+    srv.group_names = {}
+    srv.lock = threading.Lock()
+    threading.Thread(target=srv.serve_forever, daemon=True).start()
+    return srv
+# Mock lotto websites
+class MockLottoHandler(BaseHTTPRequestHandler):
+    """เสิร์ฟ fixtures แทนเว็บผลหวย (latency ตั้งค่าได้ ไม่มี ETag ทุกครั้งจึงต้อง parse ใหม่)"""
+    protocol_version = "HTTP/1.1"
+    disable_nagle_algorithm = True
+    wbufsize = -1
+    def log_message(self, fmt, *args):
+        pass
+    def do_GET(self):
+        srv = self.server
+        with srv.lock:
+            srv.calls += 1
+        if srv.latency:
+            time.sleep(srv.latency)
+        body = srv.pages.get(self.path.split("?")[0])
+        if body is None:
+            self.send_response(404)
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+            return
+        self.send_response(200)
+        self.send_header("Content-Type", "text/html; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+def start_mock_lotto(latency: float = 0.0) -> ThreadingHTTPServer:
+    srv = QuietHTTPServer(("127.0.0.1", 0), MockLottoHandler)
+    srv.daemon_threads = True
+    srv.latency = latency
+    srv.calls = 0
+    srv.lock = threading.Lock()
+    srv.pages = {}
+    for path, fname in (("/lottery", "lottery_co_th.html"), ("/sanook", "sanook_icheck.html")):
+        with open(os.path.join(FIXTURES_DIR, fname), "rb") as f:
+            srv.pages[path] = f.read()
+    threading.Thread(target=srv.serve_forever, daemon=True).start()
+    return srv
+def bot_env(mock: Optional[ThreadingHTTPServer] = None, lotto: Optional[ThreadingHTTPServer] = None) -> None:
+    """ตั้ง env ปลอมสำหรับ off.py (ใช้ทั้ง import ใน process นี้ และ process ลูกของ bench startup)"""
+    os.environ.setdefault("CHANNEL_ACCESS_TOKEN", "bench-token")
+    os.environ.setdefault("CHANNEL_SECRET", "bench-secret")
+    # ไม่ให้ scheduler วันออกผลไปยิงเว็บจริงระหว่างวัดผล
+    os.environ.setdefault("LOTTO_SCHEDULER", "0")
+    # ไม่แตะ bot.db จริง / ไม่ resume broadcast ค้าง
+    os.environ.setdefault("BOT_DB_PATH", os.path.join(tempfile.mkdtemp(prefix="lotto-bench-"), "bench.db"))
+    os.environ.setdefault("BACKGROUND_TASKS", "0")
+    os.environ.setdefault("LOG_LEVEL", "WARNING")
+    if mock is not None:
+        os.environ["LINE_API_HOST"] = f"http://127.0.0.1:{mock.server_address[1]}"
+    if lotto is not None:
+        os.environ["LOTTERY_CO_TH_URL"] = f"http://127.0.0.1:{lotto.server_address[1]}/lottery"
+        os.environ["SANOOK_ICHECK_URL"] = f"http://127.0.0.1:{lotto.server_address[1]}/sanook"
+def load_bot(mock: Optional[ThreadingHTTPServer] = None, lotto: Optional[ThreadingHTTPServer] = None):
+    """import off.py ด้วย env ปลอม (ต้องเรียกก่อน import off ที่อื่น)"""
+    bot_env(mock, lotto)
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    import off
+    return off
+# Benchmarks
+def bench_push(args) -> None:
+    mock = start_mock_line(args.latency, args.rate_429, args.rate_error)
+    off = load_bot(mock)
+    from linebot.v3.messaging import ApiClient, MessagingApi, PushMessageRequest, TextMessage
+    targets: List[str] = [f"Cbench{i:05d}" for i in range(args.groups)]
+    messages = [TextMessage(text="bench")]
+    if not args.skip_sequential:
+        # แบบเดิม: ส่งทีละกลุ่มผ่าน MessagingApi ตัวเดียว
+        t0 = time.perf_counter()
+        ok = 0
+        with ApiClient(off.line_config()) as api_client:
+            api = MessagingApi(api_client)
+            for gid in targets:
+                try:
+                    api.push_message(PushMessageRequest(to=gid, messages=messages))
+                    ok += 1
+                except Exception:
+                    pass
+        dt = time.perf_counter() - t0
+        print(f"sequential : {args.groups} groups ok={ok} in {dt:.2f}s ({args.groups / dt:.1f} push/s)")
+    t0 = time.perf_counter()
+    summary = off.broadcast(targets, messages, workers=args.workers)
+    dt = time.perf_counter() - t0
+    print(f"broadcast  : {args.groups} groups ok={summary['ok']} failed={summary['failed']} "
+          f"in {dt:.2f}s ({args.groups / dt:.1f} push/s)")
+    print(f"mock calls={mock.calls} throttled={mock.throttled}")
+    mock.shutdown()
+def bench_client(args) -> None:
+    mock = start_mock_line(args.latency)
+    off = load_bot(mock)
+    from linebot.v3.messaging import ApiClient, MessagingApi, PushMessageRequest, TextMessage
+    req = PushMessageRequest(to="Cbench", messages=[TextMessage(text="bench")])
+    # แบบเดิม: สร้าง ApiClient ใหม่ทุกครั้ง (connection ใหม่ทุกครั้ง)
+    t0 = time.perf_counter()
+    opened = 0
+    for _ in range(args.calls):
+        with ApiClient(off.line_config()) as api_client:
+            MessagingApi(api_client).push_message(req)
+            opened += sum(api_client.rest_client.pool_manager.pools.get(k).num_connections
+                          for k in api_client.rest_client.pool_manager.pools.keys())
+    dt = time.perf_counter() - t0
+    print(f"per-call ApiClient : {args.calls} calls in {dt:.2f}s ({dt / args.calls * 1000:.2f} ms/call) connections={opened}")
+    t0 = time.perf_counter()
+    for _ in range(args.calls):
+        off.line_call("push", off.line_api().push_message, req)
+    dt = time.perf_counter() - t0
+    stats = off.line_connection_stats()
+    print(f"shared line_api    : {args.calls} calls in {dt:.2f}s ({dt / args.calls * 1000:.2f} ms/call) "
+          f"connections={stats['connections_opened']}")
+    mock.shutdown()
+FIXTURES_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "fixtures")
+def _timeit(fn, *args, repeat: int = 20) -> float:
+    """เวลาเฉลี่ยต่อครั้ง (วินาที)"""
+    fn(*args)
+    t0 = time.perf_counter()
+    for _ in range(repeat):
+        fn(*args)
+    return (time.perf_counter() - t0) / repeat
+def bench_parse(args) -> None:
+    off = load_bot()
+    from bs4 import BeautifulSoup
+    def old_parse(html: str, text_parser):
+        # แบบเดิม: สร้าง DOM ทั้งหน้าด้วย html.parser แล้ว get_text ทั้งหน้า
+        return text_parser(BeautifulSoup(html, "html.parser").get_text("\n", strip=True))
+    cases = [
+        ("lottery.co.th", "lottery_co_th.html", off._parse_lottery_co_th_text, off._parse_lottery_co_th),
+        ("sanook", "sanook_icheck.html", off._parse_sanook_icheck_text, off._parse_sanook_icheck),
+    ]
+    for tag, fname, text_parser, new_parse in cases:
+        with open(os.path.join(FIXTURES_DIR, fname), "r", encoding="utf-8") as f:
+            html = f.read()
+        expected = old_parse(html, text_parser)
+        got = new_parse(html)
+        same = "same" if expected == got else "DIFFERENT"
+        t_old = _timeit(old_parse, html, text_parser, repeat=args.repeat)
+        t_new = _timeit(new_parse, html, repeat=args.repeat)
+        print(f"{tag:14s}: bs4 {t_old * 1000:7.2f} ms | fast {t_new * 1000:7.2f} ms | x{t_old / t_new:5.1f} | result {same}")
+        if args.verbose:
+            print(f"  {got}")
+def bench_schedule(args) -> None:
+    """จำลองวันออกผลด้วยนาฬิกาปลอม ไม่ได้ยิงเว็บจริง"""
+    off = load_bot()
+    from datetime import datetime
+    day = off.next_draw_date(datetime.strptime(args.day, "%Y-%m-%d").date())
+    clock = [datetime(day.year, day.month, day.day, 12, 0, tzinfo=off.TH_TZ).timestamp()]
+    partial_at = off._hhmm(day, args.partial_at).timestamp()
+    complete_at = off._hhmm(day, args.complete_at).timestamp()
+    date_th = f"{day.day} {list(off.THAI_MONTHS_ABBR.values())[day.month - 1]} {day.year + 543}"
+    def fetch():
+        # แหล่งข้อมูลปลอม: ยังไม่ออก -> ออกบางส่วน -> ครบ
+        if clock[0] < partial_at:
+            return None
+        data = {"date_th": date_th, "first": "245174", "front3": ["264", ""], "last3": ["093", ""], "last2": "90"}
+        if clock[0] >= complete_at:
+            data.update(front3=["264", "686"], last3=["093", "659"])
+        return data
+    done: List[Dict[str, Any]] = []
+    sched = off.DrawScheduler(
+        clock=lambda: clock[0],
+        sleep=lambda sec: clock.__setitem__(0, clock[0] + sec),
+        fetch=fetch,
+        on_complete=done.append,
+        cached=lambda: None,
+        use_lease=False,
+    )
+    when = ""
+    while not done and sched.polls < 1000:
+        wait = sched.tick()
+        when = datetime.fromtimestamp(clock[0], off.TH_TZ).strftime("%H:%M:%S")
+        if args.verbose:
+            print(f"{when} polls={sched.polls} next in {wait:.0f}s")
+        sched.sleep(wait)
+    print(f"draw {day}: complete after {sched.polls} polls, detected by {when} -> {done[0] if done else None}")
+    print(f"next draw: {off.next_draw_date(day + off.timedelta(days=1))}")
+def legacy_render(off, data: Dict[str, Any], encode: bool = True):
+    # สำเนาของ render_lotto_image_clean เดิม (วาด gradient ทีละเส้น + โหลดฟอนต์ใหม่ทุกครั้ง) ไว้เทียบเวลา
+    from io import BytesIO
+    from PIL import Image, ImageDraw
+    _load_font = off._load_font.__wrapped__
+    W, H = 1200, 720
+    img = Image.new("RGB", (W, H), (255, 255, 255))
+    draw = ImageDraw.Draw(img)
+    top_color = (245, 247, 250)
+    bottom_color = (255, 210, 230)
+    for y in range(H):
+        t = y / max(H - 1, 1)
+        r = int(top_color[0] * (1 - t) + bottom_color[0] * t)
+        g = int(top_color[1] * (1 - t) + bottom_color[1] * t)
+        b = int(top_color[2] * (1 - t) + bottom_color[2] * t)
+        draw.line([(0, y), (W, y)], fill=(r, g, b))
+    COLOR_PINK = (233, 30, 99)
+    COLOR_PINK_SOFT = (255, 105, 180)
+    COLOR_TEXT = (30, 30, 30)
+    COLOR_CARD = (255, 255, 255)
+    COLOR_BORDER = (240, 180, 210)
+    font_title = _load_font(52, bold=True)
+    font_date = _load_font(30, bold=True)
+    font_label_big = _load_font(32, bold=True)
+    font_num_big = _load_font(120, bold=True)
+    font_label = _load_font(28, bold=True)
+    font_num = _load_font(56, bold=True)
+    draw.text((W / 2, 80), "ผลสลากกินแบ่งรัฐบาล", font=font_title, fill=COLOR_PINK, anchor="mm")
+    date_th = str(data.get("date_th", "")).strip()
+    date_text = f"งวดประจำวันที่  {date_th}" if date_th else "งวดประจำวันที่ -"
+    pad_x, pad_y = 40, 12
+    bbox = draw.textbbox((0, 0), date_text, font=font_date)
+    w_date = bbox[2] - bbox[0]
+    h_date = bbox[3] - bbox[1]
+    box_w, box_h = w_date + pad_x * 2, h_date + pad_y * 2
+    box_x0, box_y0 = (W - box_w) / 2, 130
+    box_x1, box_y1 = box_x0 + box_w, box_y0 + box_h
+    draw.rounded_rectangle((box_x0, box_y0, box_x1, box_y1), radius=25, fill=COLOR_PINK, outline=None)
+    draw.text(((box_x0 + box_x1) / 2, (box_y0 + box_y1) / 2), date_text, font=font_date, fill=(255, 255, 255), anchor="mm")
+    margin = 70
+    main_card = (margin, 210, int(W * 0.68), 520)
+    last2_card = (int(W * 0.72), 210, W - margin, 520)
+    front3_card = (margin, 540, int(W * 0.5) - 10, 690)
+    last3_card = (int(W * 0.5) + 10, 540, W - margin, 690)
+    def card(box, radius=35):
+        draw.rounded_rectangle(box, radius=radius, fill=COLOR_CARD, outline=COLOR_BORDER, width=2)
+    card(main_card)
+    card(last2_card)
+    card(front3_card, radius=28)
+    card(last3_card, radius=28)
+    x0, y0, x1, y1 = main_card
+    band_h = 80
+    draw.rounded_rectangle((x0, y0, x1, y0 + band_h), radius=35, fill=COLOR_PINK_SOFT, outline=None)
+    draw.rectangle((x0, y0 + band_h - 20, x1, y0 + band_h), fill=COLOR_PINK_SOFT)
+    draw.text(((x0 + x1) / 2, y0 + band_h / 2 + 2), "รางวัลที่ 1", font=font_label_big, fill=(255, 255, 255), anchor="mm")
+    first = str(data.get("first", "")).strip() or "-"
+    draw.text(((x0 + x1) / 2, (y0 + y1) / 2 + 30), first, font=font_num_big, fill=COLOR_TEXT, anchor="mm")
+    x0, y0, x1, y1 = last2_card
+    draw.rounded_rectangle((x0, y0, x1, y0 + band_h), radius=35, fill=COLOR_PINK_SOFT, outline=None)
+    draw.rectangle((x0, y0 + band_h - 20, x1, y0 + band_h), fill=COLOR_PINK_SOFT)
+    draw.text(((x0 + x1) / 2, y0 + band_h / 2 + 2), "เลขท้าย 2 ตัว", font=font_label, fill=(255, 255, 255), anchor="mm")
+    last2 = str(data.get("last2", "")).zfill(2) if data.get("last2") is not None else "-"
+    draw.text(((x0 + x1) / 2, (y0 + y1) / 2 + 24), last2, font=font_num_big, fill=COLOR_TEXT, anchor="mm")
+    x0, y0, x1, y1 = front3_card
+    band_h2 = 60
+    draw.rounded_rectangle((x0, y0, x1, y0 + band_h2), radius=28, fill=COLOR_PINK, outline=None)
+    draw.rectangle((x0, y0 + band_h2 - 18, x1, y0 + band_h2), fill=COLOR_PINK)
+    draw.text(((x0 + x1) / 2, y0 + band_h2 / 2 + 1), "เลขหน้า 3 ตัว", font=font_label, fill=(255, 255, 255), anchor="mm")
+    f = data.get("front3") or []
+    f1 = str(f[0]).zfill(3) if len(f) > 0 and f[0] else "---"
+    f2 = str(f[1]).zfill(3) if len(f) > 1 and f[1] else "---"
+    draw.text(((x0 + x1) / 2, (y0 + y1) / 2 + 26), f"{f1}   {f2}", font=font_num, fill=COLOR_TEXT, anchor="mm")
+    x0, y0, x1, y1 = last3_card
+    draw.rounded_rectangle((x0, y0, x1, y0 + band_h2), radius=28, fill=COLOR_PINK, outline=None)
+    draw.rectangle((x0, y0 + band_h2 - 18, x1, y0 + band_h2), fill=COLOR_PINK)
+    draw.text(((x0 + x1) / 2, y0 + band_h2 / 2 + 1), "เลขท้าย 3 ตัว", font=font_label, fill=(255, 255, 255), anchor="mm")
+    l = data.get("last3") or []
+    l1 = str(l[0]).zfill(3) if len(l) > 0 and l[0] else "---"
+    l2 = str(l[1]).zfill(3) if len(l) > 1 and l[1] else "---"
+    draw.text(((x0 + x1) / 2, (y0 + y1) / 2 + 26), f"{l1}   {l2}", font=font_num, fill=COLOR_TEXT, anchor="mm")
+    if not encode:
+        return img
+    buf = BytesIO()
+    img.save(buf, format="PNG")
+    return buf.getvalue()
+SAMPLE_RESULT = {"date_th": "16 กรกฎาคม 2568", "first": "245174", "front3": ["264", "686"], "last3": ["093", "659"], "last2": "90"}
+def bench_render(args) -> None:
+    off = load_bot()
+    from PIL import ImageChops
+    def new_cold(data):
+        off._render_base_cache.clear()
+        off._load_font.cache_clear()
+        return off.render_lotto_image(data)
+    same = ImageChops.difference(legacy_render(off, SAMPLE_RESULT, encode=False),
+                                 off.render_lotto_image(SAMPLE_RESULT)).getbbox() is None
+    print(f"pixels identical to old renderer: {same}")
+    t_old = _timeit(lambda d: legacy_render(off, d, encode=False), SAMPLE_RESULT, repeat=args.repeat)
+    t_cold = _timeit(new_cold, SAMPLE_RESULT, repeat=args.repeat)
+    t_warm = _timeit(off.render_lotto_image, SAMPLE_RESULT, repeat=args.repeat)
+    print(f"draw only   : old {t_old * 1000:7.2f} ms | new cold {t_cold * 1000:7.2f} ms | new warm {t_warm * 1000:7.2f} ms")
+    t_old_png = _timeit(lambda d: legacy_render(off, d), SAMPLE_RESULT, repeat=args.repeat)
+    t_new_png = _timeit(off.render_lotto_image_clean, SAMPLE_RESULT, repeat=args.repeat)
+    print(f"draw + PNG  : old {t_old_png * 1000:7.2f} ms | new warm {t_new_png * 1000:7.2f} ms")
+# Load / latency suite
+def _percentiles(samples: List[float]) -> Dict[str, float]:
+    vals = sorted(samples)
+    if not vals:
+        return {"n": 0, "p50_ms": 0.0, "p99_ms": 0.0}
+    pick = lambda q: vals[min(len(vals) - 1, int(q * len(vals)))] * 1000
+    return {"n": len(vals), "p50_ms": round(pick(0.5), 3), "p99_ms": round(pick(0.99), 3)}
+def _report(name: str, samples: List[float], elapsed: float, units: int) -> Dict[str, Any]:
+    row = {"name": name, **_percentiles(samples), "per_sec": round(units / elapsed, 1) if elapsed else 0.0,
+           "elapsed_s": round(elapsed, 3)}
+    print(f"{name:24s} n={row['n']:<6d} p50 {row['p50_ms']:9.2f} ms | p99 {row['p99_ms']:9.2f} ms | "
+          f"{row['per_sec']:9.1f}/s | {row['elapsed_s']:.2f}s")
+    return row
+def signed_webhook(secret: str, events: List[Dict[str, Any]]) -> Tuple[bytes, str]:
+    """body + X-Line-Signature แบบเดียวกับที่ LINE ส่งมา"""
+    body = json.dumps({"destination": "Ubench", "events": events}, ensure_ascii=False).encode("utf-8")
+    sig = base64.b64encode(hmac.new(secret.encode("utf-8"), body, hashlib.sha256).digest()).decode()
+    return body, sig
+def text_event(text: str, group_id: str) -> Dict[str, Any]:
+    return {
+        "type": "message", "mode": "active", "timestamp": int(time.time() * 1000),
+        "webhookEventId": uuid.uuid4().hex, "deliveryContext": {"isRedelivery": False},
+        "source": {"type": "group", "groupId": group_id, "userId": "Ubench"},
+        "replyToken": uuid.uuid4().hex,
+        "message": {"type": "text", "id": str(random.randrange(10 ** 12)), "quoteToken": "q", "text": text},
+    }
+def bench_webhook(args, off=None) -> List[Dict[str, Any]]:
+    """ยิง webhook ที่เซ็นแล้วเข้า /callback ของ server จริง (werkzeug threaded) พร้อมกันหลาย connection"""
+    import requests
+    from werkzeug.serving import make_server
+    if off is None:
+        off = load_bot(start_mock_line(args.latency))
+    import logging
+    logging.getLogger("werkzeug").setLevel(logging.ERROR)
+    server = make_server("127.0.0.1", 0, off.app, threaded=True)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    url = f"http://127.0.0.1:{server.server_port}/callback"
+    secret = os.environ["CHANNEL_SECRET"]
+    local = threading.local()
+    def post(i: int) -> float:
+        session = getattr(local, "session", None) or requests.Session()
+        local.session = session
+        text = "/ตรวจหวย 245174" if random.random() < args.command_ratio else "ข้อความทั่วไป"
+        body, sig = signed_webhook(secret, [text_event(text, f"Cload{i % args.groups:04d}")])
+        t0 = time.perf_counter()
+        r = session.post(url, data=body, headers={"Content-Type": "application/json", "X-Line-Signature": sig})
+        dt = time.perf_counter() - t0
+        if r.status_code != 200:
+            raise RuntimeError(f"/callback -> {r.status_code}")
+        return dt
+    from concurrent.futures import ThreadPoolExecutor
+    t0 = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=args.concurrency) as pool:
+        samples = list(pool.map(post, range(args.requests)))
+    elapsed = time.perf_counter() - t0
+    rows = [_report("webhook /callback", samples, elapsed, args.requests)]
+    # รอคิวงานเบื้องหลังทำจนหมด (throughput ของการประมวลผลจริง ไม่ใช่แค่ตอบ 200)
+    while True:
+        q = off.job_queue_status()
+        if not q["depth"] and not q["running"] and not q["deferred"]:
+            break
+        time.sleep(0.005)
+    drained = time.perf_counter() - t0
+    print(f"{'  queue drained':24s} {args.requests / drained:.1f} events/s ({drained:.2f}s)")
+    server.shutdown()
+    return rows
+def bench_push_sizes(args, off=None) -> List[Dict[str, Any]]:
+    """push_to_all ทั้งเส้นทาง (target store -> broadcast job -> push) ที่จำนวนกลุ่มต่าง ๆ"""
+    from linebot.v3.messaging import TextMessage
+    if off is None:
+        off = load_bot(start_mock_line(args.latency, args.rate_429, args.rate_error))
+    rows = []
+    for n in args.sizes:
+        for gid in off.target_store.ids():
+            off.target_store.delete(gid)
+        off.target_store.put_many({f"Cpush{n}_{i:05d}": {"name": f"bench {i}", "updated_at": 0} for i in range(n)})
+        off.metrics = off._Metrics()
+        t0 = time.perf_counter()
+        summary = off.push_to_all([TextMessage(text="bench")], job_key=f"bench:{n}:{uuid.uuid4().hex}")
+        elapsed = time.perf_counter() - t0
+        h = off.metrics.histograms.get(("line_api_seconds", (("op", "push"),)))
+        row = _report(f"push_to_all {n} groups", list(h.recent) if h else [], elapsed, n)
+        row["failed"] = summary["failed"]
+        rows.append(row)
+    return rows
+def bench_fetch(args, off=None) -> List[Dict[str, Any]]:
+    """fetch_latest_lotto: ดึงจริงผ่าน mock เว็บ (force) และอ่านจาก cache"""
+    if off is None:
+        off = load_bot(lotto=start_mock_lotto(args.web_latency))
+    samples = []
+    t0 = time.perf_counter()
+    for _ in range(args.repeat):
+        t = time.perf_counter()
+        data = off.fetch_latest_lotto(force=True)
+        samples.append(time.perf_counter() - t)
+        if not data:
+            raise RuntimeError("fetch_latest_lotto returned nothing from fixtures")
+    rows = [_report("fetch_latest_lotto force", samples, time.perf_counter() - t0, args.repeat)]
+    samples = []
+    t0 = time.perf_counter()
+    for _ in range(args.repeat * 10):
+        t = time.perf_counter()
+        off.fetch_latest_lotto()
+        samples.append(time.perf_counter() - t)
+    rows.append(_report("fetch_latest_lotto cached", samples, time.perf_counter() - t0, args.repeat * 10))
+    return rows
+def bench_render_clean(args, off=None) -> List[Dict[str, Any]]:
+    if off is None:
+        off = load_bot()
+    off.render_lotto_image_clean(SAMPLE_RESULT)
+    samples = []
+    t0 = time.perf_counter()
+    for _ in range(args.repeat):
+        t = time.perf_counter()
+        off.render_lotto_image_clean(SAMPLE_RESULT)
+        samples.append(time.perf_counter() - t)
+    return [_report("render_lotto_image_clean", samples, time.perf_counter() - t0, args.repeat)]
+# โมดูลที่ข้อความแชทธรรมดาไม่ต้องใช้ ต้องไม่ถูก import ตอนเริ่ม (off.py โหลดแบบ lazy)
+# requests ไม่อยู่ในนี้ เพราะแพ็กเกจ linebot (v2 เดิม) import เองตอนโหลด linebot.v3.webhook
+STARTUP_HEAVY_MODULES = ("bs4", "PIL.Image", "linebot.v3.messaging")
+def bench_startup(args, off=None) -> List[Dict[str, Any]]:
+    """import off.py ใน interpreter ใหม่ทีละรอบ (= cold start ของ worker) เกิน --budget-ms หรือมีโมดูลหนักโผล่มา exit 1"""
+    import subprocess
+    bot_env()
+    code = ("import sys, json, time; t = time.perf_counter(); import off; "
+            "print(json.dumps({'wall': time.perf_counter() - t, 'import_ms': off.STARTUP['import_ms'], "
+            f"'heavy': [m for m in {STARTUP_HEAVY_MODULES!r} if m in sys.modules]}}))")
+    here = os.path.dirname(os.path.abspath(__file__))
+    samples: List[float] = []
+    heavy: set = set()
+    t0 = time.perf_counter()
+    for _ in range(args.startup_runs):
+        out = subprocess.run([sys.executable, "-c", code], cwd=here, env=dict(os.environ, LOG_LEVEL="ERROR"),
+                             capture_output=True, text=True, check=True).stdout
+        row = json.loads(out.strip().splitlines()[-1])
+        samples.append(row["wall"])
+        heavy.update(row["heavy"])
+    report = _report("startup_import", samples, time.perf_counter() - t0, len(samples))
+    problems = []
+    if heavy:
+        problems.append(f"โหลดตอน import: {', '.join(sorted(heavy))}")
+    if args.budget_ms and report["p50_ms"] > args.budget_ms:
+        problems.append(f"p50 {report['p50_ms']:.0f} ms เกิน budget {args.budget_ms:.0f} ms")
+    if problems:
+        print("STARTUP:\n  " + "\n  ".join(problems))
+        sys.exit(1)
+    return [report]
+def bench_suite(args) -> None:
+    """ทุกเส้นทางหลักในครั้งเดียว เทียบกับ baseline ได้ (exit 1 ถ้าช้าลงเกิน tolerance)"""
+    mock = start_mock_line(args.latency, args.rate_429, args.rate_error)
+    off = load_bot(mock, lotto=start_mock_lotto(args.web_latency))
+    rows: List[Dict[str, Any]] = []
+    rows += bench_webhook(args, off)
+    rows += bench_push_sizes(args, off)
+    rows += bench_fetch(args, off)
+    rows += bench_render_clean(args, off)
+    rows += bench_startup(args, off)
+    print(f"mock LINE calls={mock.calls} throttled={mock.throttled}")
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump({"created_at": time.time(), "results": rows}, f, ensure_ascii=False, indent=2)
+    if not args.baseline:
+        return
+    with open(args.baseline, encoding="utf-8") as f:
+        base = {r["name"]: r for r in json.load(f)["results"]}
+    regressions = []
+    for r in rows:
+        b = base.get(r["name"])
+        if not b:
+            continue
+        if b["p99_ms"] and r["p99_ms"] > b["p99_ms"] * (1 + args.tolerance):
+            regressions.append(f"{r['name']}: p99 {b['p99_ms']:.2f} -> {r['p99_ms']:.2f} ms")
+        if b["per_sec"] and r["per_sec"] < b["per_sec"] * (1 - args.tolerance):
+            regressions.append(f"{r['name']}: {b['per_sec']:.1f} -> {r['per_sec']:.1f}/s")
+    if regressions:
+        print("REGRESSION:\n  " + "\n  ".join(regressions))
+        sys.exit(1)
+    print(f"no regression vs {args.baseline} (tolerance {args.tolerance:.0%})")
+def _add_load_args(p, suite: bool = False) -> None:
+    p.add_argument("--latency", type=float, default=0.02, help="วินาทีต่อ request ของ mock LINE")
+    p.add_argument("--rate-429", type=float, default=0.0)
+    p.add_argument("--rate-error", type=float, default=0.0)
+    p.add_argument("--web-latency", type=float, default=0.05, help="วินาทีต่อ request ของ mock เว็บผลหวย")
+    p.add_argument("--requests", type=int, default=2000, help="จำนวน webhook ที่ยิง")
+    p.add_argument("--concurrency", type=int, default=16)
+    p.add_argument("--groups", type=int, default=200, help="จำนวนกลุ่มที่ webhook มาจาก")
+    p.add_argument("--command-ratio", type=float, default=0.02, help="สัดส่วนข้อความที่เป็นคำสั่ง")
+    p.add_argument("--sizes", type=lambda v: [int(x) for x in v.split(",")], default=[10, 100, 1000])
+    p.add_argument("--repeat", type=int, default=20)
+    p.add_argument("--startup-runs", type=int, default=5, help="จำนวนรอบ import off.py ใน process ใหม่")
+    p.add_argument("--budget-ms", type=float, default=0.0, help="p50 ของ startup_import ต้องไม่เกินนี้ (0 = ไม่เช็ค)")
+    if suite:
+        p.add_argument("--json", default=None, help="บันทึกผลเป็น JSON (ใช้เป็น baseline ครั้งถัดไป)")
+        p.add_argument("--baseline", default=None)
+        p.add_argument("--tolerance", type=float, default=0.25)
+def main(argv: Optional[List[str]] = None) -> None:
+    parser = argparse.ArgumentParser(description="lotto-bot offline benchmarks")
+    sub = parser.add_subparsers(dest="cmd", required=True)
+    p = sub.add_parser("push", help="push_to_all กับ mock Messaging API")
+    p.add_argument("--groups", type=int, default=200)
+    p.add_argument("--workers", type=int, default=None)
+    p.add_argument("--latency", type=float, default=0.05, help="วินาทีต่อ request ของ mock")
+    p.add_argument("--rate-429", type=float, default=0.0)
+    p.add_argument("--rate-error", type=float, default=0.0)
+    p.add_argument("--skip-sequential", action="store_true")
+    p.set_defaults(func=bench_push)
+    p = sub.add_parser("client", help="ApiClient ต่อครั้ง เทียบกับ client ที่ใช้ร่วมกัน")
+    p.add_argument("--calls", type=int, default=200)
+    p.add_argument("--latency", type=float, default=0.0)
+    p.set_defaults(func=bench_client)
+    p = sub.add_parser("parse", help="เวลา parse หน้าเว็บผลหวยจาก fixtures (แบบเดิมเทียบแบบเร็ว)")
+    p.add_argument("--repeat", type=int, default=20)
+    p.add_argument("--verbose", action="store_true")
+    p.set_defaults(func=bench_parse)
+    p = sub.add_parser("schedule", help="จำลอง scheduler วันออกผลด้วยนาฬิกาปลอม")
+    p.add_argument("--day", default="2026-07-16")
+    p.add_argument("--partial-at", default="14:50")
+    p.add_argument("--complete-at", default="15:05")
+    p.add_argument("--verbose", action="store_true")
+    p.set_defaults(func=bench_schedule)
+    p = sub.add_parser("render", help="เวลาเรนเดอร์รูปผลหวย (แบบเดิมเทียบแบบ cache ชั้นนิ่ง)")
+    p.add_argument("--repeat", type=int, default=20)
+    p.set_defaults(func=bench_render)
+    p = sub.add_parser("webhook", help="ยิง webhook ที่เซ็นแล้วเข้า /callback (load test)")
+    _add_load_args(p)
+    p.set_defaults(func=bench_webhook)
+    p = sub.add_parser("push-sizes", help="push_to_all ที่ 10/100/1000 กลุ่ม (p50/p99 ต่อกลุ่ม)")
+    _add_load_args(p)
+    p.set_defaults(func=bench_push_sizes)
+    p = sub.add_parser("fetch", help="fetch_latest_lotto กับ mock เว็บผลหวย (fixtures)")
+    _add_load_args(p)
+    p.set_defaults(func=bench_fetch)
+    p = sub.add_parser("startup", help="เวลา import off.py ใน process ใหม่ (cold start) + import-time budget")
+    _add_load_args(p)
+    p.set_defaults(func=bench_startup)
+    p = sub.add_parser("suite", help="ทุกอย่างข้างบน + เทียบ baseline (--json / --baseline)")
+    _add_load_args(p, suite=True)
+    p.set_defaults(func=bench_suite)
+    args = parser.parse_args(argv)
+    args.func(args)
+if __name__ == "__main__":
+    main()
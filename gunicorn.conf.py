@@ -0,0 +1,27 @@
+# -*- coding: utf-8 -*-
+"""ค่า gunicorn ของบอท (Procfile: gunicorn -c gunicorn.conf.py off:app)
+
+GUNICORN_PRELOAD=1 : import off.py ครั้งเดียวใน master แล้ว fork เป็น worker (copy-on-write)
+worker ใหม่ (รวมถึงตัวที่ถูก restart) พร้อมรับ webhook ทันทีโดยไม่ต้อง import เอง
+ค่าอื่น (bind / workers) ใช้ของ gunicorn ตามเดิม ($PORT, $WEB_CONCURRENCY)
+"""
+import gc
+import os
+preload_app = os.getenv("GUNICORN_PRELOAD", "0").strip() == "1"
+_background = os.getenv("BACKGROUND_TASKS", "1").strip() != "0"
+if preload_app:
+    # thread ที่เริ่มใน master ไม่ตามไปใน worker ที่ fork ออกไป -> ให้ post_fork เริ่มงานเบื้องหลังแทน
+    os.environ["BACKGROUND_TASKS"] = "0"
+def when_ready(server):
+    if not preload_app:
+        return
+    import off
+    # โหลดโมดูล lazy ไว้ใน master ด้วย worker จะได้ใช้หน้าหน่วยความจำร่วมกัน ไม่ต้อง import เองตอนคำสั่งแรก
+    off.warm_imports()
+    # ย้าย object ที่มีอยู่ไป generation ถาวร GC ใน worker จะไม่ไปเขียน header ของมันจนหน้าถูก copy
+    gc.freeze()
+    server.log.info("preloaded off.py: import %.0f ms, lazy %s", off.STARTUP["import_ms"], off.STARTUP["lazy_ms"])
+def post_fork(server, worker):
+    if preload_app and _background:
+        import off
+        off.start_background_tasks()
@@ -0,0 +1,45 @@
+# -*- coding: utf-8 -*-
+"""คลังผลหวยย้อนหลัง: นำเข้า / สร้าง index ใหม่ / ตรวจสลาก (ไม่ต้องรัน Flask)
+
+ตัวอย่าง:
+    python lotto_archive.py import results.jsonl
+    python lotto_archive.py check 245174 123456 --draw 16/7/68
+    python lotto_archive.py check 245174 --all
+"""
+import sys
+import time
+import argparse
+from typing import List, Optional
+from render_batch import load_bot, read_records
+def main(argv: Optional[List[str]] = None) -> int:
+    parser = argparse.ArgumentParser(description="lotto-bot draw archive")
+    sub = parser.add_subparsers(dest="cmd", required=True)
+    p = sub.add_parser("import", help="นำผลย้อนหลังจากไฟล์ JSON/JSONL เข้าคลัง (งวดที่มีแล้วข้าม)")
+    p.add_argument("files", nargs="+")
+    sub.add_parser("reindex", help="สร้าง index เลขรางวัลใหม่จากคลังทั้งหมด")
+    sub.add_parser("list", help="รายการงวดในคลัง")
+    p = sub.add_parser("check", help="ตรวจสลาก")
+    p.add_argument("tickets", nargs="+")
+    p.add_argument("--draw", default=None, help="งวด เช่น 2568-07-16 หรือ 16/7/68 (ค่าเริ่มต้น = งวดล่าสุด)")
+    p.add_argument("--all", action="store_true", help="ตรวจทุกงวดในคลัง")
+    args = parser.parse_args(argv)
+    off = load_bot()
+    if args.cmd == "import":
+        records = [r for path in args.files for r in read_records(path)]
+        added = off.import_lotto_results(records)
+        print(f"นำเข้า {added} งวด (ข้าม {len(records) - added}) | ในคลัง {len(off.lotto_draw_keys())} งวด")
+    elif args.cmd == "reindex":
+        t0 = time.perf_counter()
+        n = off.rebuild_lotto_index()
+        print(f"สร้าง index {n} งวด ใน {time.perf_counter() - t0:.3f}s")
+    elif args.cmd == "list":
+        for key in off.lotto_draw_keys():
+            print(key)
+    else:
+        words = list(args.tickets) + (["ทั้งหมด"] if args.all else [args.draw] if args.draw else [])
+        t0 = time.perf_counter()
+        print(off.build_ticket_check_text(words))
+        print(f"({(time.perf_counter() - t0) * 1000:.1f} ms)")
+    return 0
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,192 +1,1141 @@
 # -*- coding: utf-8 -*-
+from __future__ import annotations
+import time
+_IMPORT_STARTED = time.perf_counter()
 import os
 import re
-import time
+import atexit
+import bisect
 import json
+import uuid
+import hashlib
+import socket
+import sqlite3
+import queue
+import logging
+import importlib
+import threading
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from concurrent.futures import TimeoutError as FuturesTimeout
+from html import unescape
+from functools import lru_cache
 from io import BytesIO
+from datetime import date, datetime, timedelta, timezone
 from typing import Any, Dict, Iterable, List, Optional, Tuple
-import requests
-from bs4 import BeautifulSoup
-from PIL import Image, ImageDraw, ImageFont
 from flask import Flask, request, abort, Response
+from werkzeug.exceptions import HTTPException
 from dotenv import load_dotenv
 from linebot.v3.webhook import WebhookHandler
+from linebot.v3.exceptions import InvalidSignatureError
 from linebot.v3.webhooks import MessageEvent
 from linebot.v3.webhooks.models import TextMessageContent
-from linebot.v3.messaging import (
-    ApiClient,
-    Configuration,
-    MessagingApi,
-    ReplyMessageRequest,
-    PushMessageRequest,
-    TextMessage,
-    ImageMessage,
-)
-from linebot.v3.messaging.exceptions import ApiException
+# Lazy imports
+# โมดูลหนักที่ข้อความแชทธรรมดาไม่ได้ใช้ (ดึงเว็บ / วาดรูป / ส่งข้อความ) import ตอนใช้ครั้งแรก
+# เก็บเวลาที่ใช้ import แต่ละตัวไว้ใน STARTUP["lazy_ms"] ให้ /status กับ /metrics ดูได้
+STARTUP: Dict[str, Any] = {"import_ms": None, "lazy_ms": {}}
+class _LazyModule:
+    """แทนโมดูลที่ยังไม่ import เช่น Image = _LazyModule("PIL.Image") แล้วใช้ Image.new(...) ได้ตามปกติ"""
+    def __init__(self, name: str):
+        self._name = name
+        self._module = None
+    def _load(self) -> Any:
+        if self._module is None:
+            started = time.perf_counter()
+            module = importlib.import_module(self._name)
+            elapsed = time.perf_counter() - started
+            STARTUP["lazy_ms"].setdefault(self._name, round(elapsed * 1000, 1))
+            metrics.observe("lazy_import_seconds", elapsed, module=self._name)
+            self._module = module
+        return self._module
+    def __getattr__(self, attr: str) -> Any:
+        return getattr(self._load(), attr)
+    def __repr__(self) -> str:
+        return f"<lazy module {self._name!r} {'loaded' if self._module is not None else 'not loaded'}>"
+requests = _LazyModule("requests")
+bs4 = _LazyModule("bs4")
+Image = _LazyModule("PIL.Image")
+ImageDraw = _LazyModule("PIL.ImageDraw")
+ImageFont = _LazyModule("PIL.ImageFont")
+# linebot.v3.messaging import model ทั้งชุด (~1 วินาที) ใช้ผ่าน messaging.TextMessage(...) ฯลฯ
+messaging = _LazyModule("linebot.v3.messaging")
+_LAZY_MODULES = (requests, bs4, Image, ImageDraw, ImageFont, messaging)
+def warm_imports() -> None:
+    """import โมดูลหนักทั้งหมดล่วงหน้า (ใช้ตอน gunicorn preload ให้ worker ที่ fork ออกไปใช้หน้าหน่วยความจำร่วมกัน)"""
+    for module in _LAZY_MODULES:
+        module._load()
 load_dotenv()
 CHANNEL_ACCESS_TOKEN = os.getenv("CHANNEL_ACCESS_TOKEN", "").strip()
 CHANNEL_SECRET = os.getenv("CHANNEL_SECRET", "").strip()
 BASE_URL = os.getenv("BASE_URL", "").strip()
+# ชี้ไปที่ mock Messaging API ในเครื่องได้ (ใช้ตอนวัดความเร็ว/ทดสอบ) ปกติปล่อยว่าง = api.line.me
+LINE_API_HOST = os.getenv("LINE_API_HOST", "").strip()
 if not CHANNEL_ACCESS_TOKEN or not CHANNEL_SECRET:
     raise RuntimeError("Missing CHANNEL_ACCESS_TOKEN or CHANNEL_SECRET in environment/.env")
 # Paths / storage
 BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+# สร้างโฟลเดอร์ตอนเขียนไฟล์ครั้งแรก ไม่ใช่ตอน import
 STATIC_DIR = os.path.join(BASE_DIR, "static")
-os.makedirs(STATIC_DIR, exist_ok=True)
+# targets.json เดิม ใช้แค่ย้ายข้อมูลเข้า target store ครั้งแรก
 TARGETS_PATH = os.path.join(BASE_DIR, "targets.json")
-LOTTO_IMAGE_FILENAME = "lotto_latest.png"
-LOTTO_IMAGE_PATH = f"/static/{LOTTO_IMAGE_FILENAME}"
 # Flask + LINE
 app = Flask(__name__)
 handler = WebhookHandler(CHANNEL_SECRET)
-config = Configuration(access_token=CHANNEL_ACCESS_TOKEN)
 ZERO_REPLY_TOKEN = "00000000000000000000000000000000"
+# Logging
+# LOG_LEVEL = DEBUG/INFO/WARNING/ERROR  LOG_FORMAT = text (key=value) หรือ json (บรรทัดละ 1 object)
+# log_event() เช็ค level ก่อน ถ้าปิดอยู่จะไม่ format อะไรเลย
+LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO").strip().upper()
+LOG_FORMAT = os.getenv("LOG_FORMAT", "text").strip().lower()
+class _StructuredFormatter(logging.Formatter):
+    def format(self, record: logging.LogRecord) -> str:
+        fields = getattr(record, "fields", None) or {}
+        exc = self.formatException(record.exc_info) if record.exc_info else None
+        if LOG_FORMAT == "json":
+            return json.dumps({"ts": round(record.created, 3), "level": record.levelname,
+                               "event": record.getMessage(), **fields, **({"exc": exc} if exc else {})},
+                              ensure_ascii=False, default=str)
+        kv = " ".join(f"{k}={v}" for k, v in fields.items())
+        return f"{self.formatTime(record)} {record.levelname} {record.getMessage()}" + (f" {kv}" if kv else "") + (f"\n{exc}" if exc else "")
+log = logging.getLogger("lotto-bot")
+if not log.handlers:
+    _log_handler = logging.StreamHandler()
+    _log_handler.setFormatter(_StructuredFormatter())
+    log.addHandler(_log_handler)
+log.setLevel(LOG_LEVEL)
+log.propagate = False
+app.logger.setLevel(LOG_LEVEL)
+def log_event(level: int, event: str, exc_info: bool = False, **fields) -> None:
+    """exc_info=True แนบ traceback ของ exception ที่กำลังจัดการอยู่ (แทน logger.exception)"""
+    if log.isEnabledFor(level):
+        log.log(level, event, exc_info=exc_info, extra={"fields": fields})
+# Metrics (in-process)
+class _Histogram:
+    """histogram แบบ bucket + หน้าต่างค่าล่าสุดไว้คิด p50/p99"""
+    BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+    def __init__(self):
+        self.counts = [0] * (len(self.BUCKETS) + 1)
+        self.sum = 0.0
+        self.count = 0
+        self.recent: deque = deque(maxlen=1024)
+    def observe(self, value: float) -> None:
+        i = 0
+        while i < len(self.BUCKETS) and value > self.BUCKETS[i]:
+            i += 1
+        self.counts[i] += 1
+        self.sum += value
+        self.count += 1
+        self.recent.append(value)
+    def percentile(self, q: float) -> float:
+        if not self.recent:
+            return 0.0
+        vals = sorted(self.recent)
+        return vals[min(len(vals) - 1, int(q * len(vals)))]
+# จำนวนชุด label สูงสุดต่อชื่อ metric ชุดที่เกินรวมเป็น label ค่า "other" (กันหน่วยความจำและ /metrics บวมไม่จำกัด)
+METRICS_MAX_SERIES = int(os.getenv("METRICS_MAX_SERIES", "200"))
+class _Metrics:
+    """counter / gauge / histogram แบบมี label เก็บในหน่วยความจำของ process"""
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.counters: Dict[Tuple[str, Tuple], float] = {}
+        self.gauges: Dict[Tuple[str, Tuple], float] = {}
+        self.histograms: Dict[Tuple[str, Tuple], _Histogram] = {}
+        self.series: Dict[str, int] = {}
+    @staticmethod
+    def _key(name: str, labels: Dict[str, Any]) -> Tuple[str, Tuple]:
+        return name, tuple(sorted((k, str(v)) for k, v in labels.items()))
+    def _bounded(self, store: Dict[Tuple[str, Tuple], Any], key: Tuple[str, Tuple]) -> Tuple[str, Tuple]:
+        """key เดิม หรือ key ใหม่ถ้ายังไม่เกิน METRICS_MAX_SERIES (เรียกภายใต้ lock)"""
+        if key in store:
+            return key
+        name, labels = key
+        if self.series.get(name, 0) >= METRICS_MAX_SERIES:
+            return name, tuple((k, "other") for k, _ in labels)
+        self.series[name] = self.series.get(name, 0) + 1
+        return key
+    def inc(self, name: str, n: float = 1, **labels) -> None:
+        key = self._key(name, labels)
+        with self.lock:
+            key = self._bounded(self.counters, key)
+            self.counters[key] = self.counters.get(key, 0) + n
+    def set(self, name: str, value: float, **labels) -> None:
+        key = self._key(name, labels)
+        with self.lock:
+            self.gauges[self._bounded(self.gauges, key)] = value
+    def observe(self, name: str, value: float, **labels) -> None:
+        key = self._key(name, labels)
+        with self.lock:
+            key = self._bounded(self.histograms, key)
+            h = self.histograms.get(key)
+            if h is None:
+                h = self.histograms[key] = _Histogram()
+            h.observe(value)
+    def snapshot(self) -> Dict[str, Any]:
+        def fmt(key):
+            name, labels = key
+            return name + ("{" + ",".join(f"{k}={v}" for k, v in labels) + "}" if labels else "")
+        with self.lock:
+            return {
+                "counters": {fmt(k): v for k, v in self.counters.items()},
+                "gauges": {fmt(k): v for k, v in self.gauges.items()},
+                "histograms": {
+                    fmt(k): {"count": h.count, "sum": round(h.sum, 6),
+                             "p50": round(h.percentile(0.5), 6), "p99": round(h.percentile(0.99), 6)}
+                    for k, h in self.histograms.items()
+                },
+            }
+    def export(self) -> Dict[str, Any]:
+        """ค่าดิบ (รวมข้าม worker ได้) ใช้กับ /metrics"""
+        with self.lock:
+            return {
+                "worker": _owner_id(),
+                "counters": [[n, list(map(list, l)), v] for (n, l), v in self.counters.items()],
+                "gauges": [[n, list(map(list, l)), v] for (n, l), v in self.gauges.items()],
+                "histograms": [[n, list(map(list, l)), list(h.counts), h.sum, h.count] for (n, l), h in self.histograms.items()],
+            }
+metrics = _Metrics()
+def _prom_labels(labels: Iterable[Any]) -> str:
+    parts = []
+    for k, v in labels:
+        v = str(v).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+        parts.append(f'{k}="{v}"')
+    return "{" + ",".join(parts) + "}" if parts else ""
+def render_prometheus(exports: List[Dict[str, Any]]) -> str:
+    """รวม export หลายชุด (หลาย worker) เป็น text format ของ Prometheus: counter/histogram รวมกัน
+    gauge ไม่รวม (บวกกันแล้วความหมายผิด เช่น breaker เปิด 1 กลายเป็น 3) แยกตาม label worker ให้ฝั่ง query ใช้ max/sum เอง"""
+    counters: Dict[Tuple[str, Tuple], float] = {}
+    gauges: Dict[Tuple[str, Tuple], float] = {}
+    hists: Dict[Tuple[str, Tuple], List[Any]] = {}
+    for ex in exports:
+        for n, l, v in ex.get("counters", []):
+            key = (n, tuple(map(tuple, l)))
+            counters[key] = counters.get(key, 0) + v
+        worker = ex.get("worker")
+        for n, l, v in ex.get("gauges", []):
+            labels = list(map(tuple, l)) + ([("worker", worker)] if worker else [])
+            gauges[(n, tuple(labels))] = v
+        for n, l, counts, total, count in ex.get("histograms", []):
+            key = (n, tuple(map(tuple, l)))
+            h = hists.setdefault(key, [[0] * len(counts), 0.0, 0])
+            h[0] = [a + b for a, b in zip(h[0], counts)]
+            h[1] += total
+            h[2] += count
+    out: List[str] = []
+    for kind, series in (("counter", counters), ("gauge", gauges)):
+        typed = set()
+        for (n, l), v in sorted(series.items()):
+            if n not in typed:
+                out.append(f"# TYPE {n} {kind}")
+                typed.add(n)
+            out.append(f"{n}{_prom_labels(l)} {v:g}")
+    typed = set()
+    for (n, l), (counts, total, count) in sorted(hists.items()):
+        if n not in typed:
+            out.append(f"# TYPE {n} histogram")
+            typed.add(n)
+        cum = 0
+        for le, c in zip(list(_Histogram.BUCKETS) + ["+Inf"], counts):
+            cum += c
+            out.append(f"{n}_bucket{_prom_labels(list(l) + [('le', le)])} {cum}")
+        out.append(f"{n}_sum{_prom_labels(l)} {total:.6f}")
+        out.append(f"{n}_count{_prom_labels(l)} {count}")
+    return "\n".join(out) + "\n"
+class _TokenBucket:
+    """token bucket แบบ thread-safe ใช้คุมอัตราการเรียก LINE API"""
+    def __init__(self, rate: float, burst: int):
+        self.rate = max(float(rate), 0.001)
+        self.capacity = max(int(burst), 1)
+        self.tokens = float(self.capacity)
+        self.ts = time.monotonic()
+        self.blocked_until = 0.0
+        self.lock = threading.Lock()
+    def acquire(self) -> None:
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                if now < self.blocked_until:
+                    wait = self.blocked_until - now
+                else:
+                    self.tokens = min(self.capacity, self.tokens + (now - self.ts) * self.rate)
+                    self.ts = now
+                    if self.tokens >= 1:
+                        self.tokens -= 1
+                        return
+                    wait = (1 - self.tokens) / self.rate
+            time.sleep(wait)
+    def try_acquire(self) -> bool:
+        """เหมือน acquire แต่ไม่รอ: ไม่มี token -> False"""
+        with self.lock:
+            now = time.monotonic()
+            if now < self.blocked_until:
+                return False
+            self.tokens = min(self.capacity, self.tokens + (now - self.ts) * self.rate)
+            self.ts = now
+            if self.tokens >= 1:
+                self.tokens -= 1
+                return True
+            return False
+    def wait_time(self) -> float:
+        """อีกกี่วินาทีจะมี token ให้ (ใช้บอกผู้ใช้ตอนโดนจำกัดความถี่)"""
+        with self.lock:
+            now = time.monotonic()
+            tokens = min(self.capacity, self.tokens + (now - self.ts) * self.rate)
+            return max(self.blocked_until - now, (1 - tokens) / self.rate, 0.0)
+    def pause(self, seconds: float) -> None:
+        """โดน 429 -> หยุดทุก worker พร้อมกันตาม Retry-After"""
+        with self.lock:
+            self.blocked_until = max(self.blocked_until, time.monotonic() + seconds)
+            self.tokens = 0.0
 # Utilities
 def _is_https(url: str) -> bool:
     return isinstance(url, str) and url.lower().startswith("https://")
-def _load_targets() -> Dict[str, Any]:
-    """อ่าน targets.json (เก็บเฉพาะ 'groups' เท่านั้น ไม่เก็บ 'rooms')"""
-    if not os.path.exists(TARGETS_PATH):
-        return {"settings": {"remember_enabled": False}, "groups": {}}
+# LINE API client (shared)
+# ApiClient ตัวเดียวต่อ process: urllib3 pool เป็น thread-safe ทุกทางส่งจึงใช้ connection
+# keep-alive / TLS session ชุดเดียวกัน ไม่ต้อง handshake ใหม่ทุกครั้ง
+LINE_POOL_SIZE = int(os.getenv("LINE_POOL_SIZE", "32"))
+LINE_CONNECT_TIMEOUT = float(os.getenv("LINE_CONNECT_TIMEOUT", "5"))
+LINE_READ_TIMEOUT = float(os.getenv("LINE_READ_TIMEOUT", "15"))
+_line_config: Optional[messaging.Configuration] = None
+def line_config() -> messaging.Configuration:
+    """Configuration ของ LINE SDK (สร้างตอนส่งครั้งแรก เพราะต้อง import linebot.v3.messaging)"""
+    global _line_config
+    if _line_config is None:
+        cfg = messaging.Configuration(access_token=CHANNEL_ACCESS_TOKEN, host=LINE_API_HOST or None)
+        cfg.connection_pool_maxsize = LINE_POOL_SIZE
+        _line_config = cfg
+    return _line_config
+_line_client_lock = threading.Lock()
+_line_client: Optional[Tuple[int, messaging.ApiClient, messaging.MessagingApi]] = None
+def line_api() -> messaging.MessagingApi:
+    global _line_client
+    client = _line_client
+    if client is not None and client[0] == os.getpid():
+        return client[2]
+    with _line_client_lock:
+        # หลัง fork ต้องสร้างใหม่ (socket ของ parent ใช้ร่วมกันไม่ได้)
+        if _line_client is None or _line_client[0] != os.getpid():
+            api_client = messaging.ApiClient(line_config())
+            _line_client = (os.getpid(), api_client, messaging.MessagingApi(api_client))
+        return _line_client[2]
+def line_call(op: str, fn: Any, *args, **kwargs) -> Any:
+    """เรียก LINE API พร้อม timeout มาตรฐาน และเก็บเวลาต่อครั้งลง histogram"""
+    kwargs.setdefault("_request_timeout", (LINE_CONNECT_TIMEOUT, LINE_READ_TIMEOUT))
+    started = time.monotonic()
+    status = "ok"
     try:
-        with open(TARGETS_PATH, "r", encoding="utf-8") as f:
-            data = json.load(f) or {}
-        data.setdefault("settings", {"remember_enabled": False})
-        data.setdefault("groups", {})
-        # ล้างข้อมูล rooms เก่า (ถ้ามี) เพื่อไม่ให้เก็บ/ส่งต่อ
-        data.pop("rooms", None)
-        return data
+        return fn(*args, **kwargs)
+    except messaging.ApiException as e:
+        status = str(getattr(e, "status", None) or "error")
+        raise
     except Exception:
-        return {"settings": {"remember_enabled": False}, "groups": {}}
+        status = "error"
+        raise
+    finally:
+        metrics.observe("line_api_seconds", time.monotonic() - started, op=op)
+        metrics.inc("line_api_calls_total", op=op, status=status)
+def line_connection_stats() -> Dict[str, int]:
+    """จำนวน connection ที่เปิดใหม่ (= handshake) เทียบกับจำนวน request ใน pool ของ process นี้"""
+    client = _line_client
+    stats = {"connections_opened": 0, "requests": 0, "idle": 0}
+    if client is None or client[0] != os.getpid():
+        return stats
+    pm = client[1].rest_client.pool_manager
+    for key in pm.pools.keys():
+        pool = pm.pools.get(key)
+        if pool is None:
+            continue
+        stats["connections_opened"] += pool.num_connections
+        stats["requests"] += pool.num_requests
+        stats["idle"] += pool.pool.qsize() if pool.pool is not None else 0
+    return stats
+# Local database (SQLite, WAL) ใช้ร่วมกันได้ทุก gunicorn worker บนเครื่องเดียวกัน
+DB_PATH = os.getenv("BOT_DB_PATH", os.path.join(BASE_DIR, "bot.db"))
+_DB_SCHEMA = [
+    """CREATE TABLE IF NOT EXISTS broadcast_jobs (
+        id TEXT PRIMARY KEY,
+        label TEXT,
+        status TEXT NOT NULL,
+        messages TEXT NOT NULL,
+        total INTEGER NOT NULL,
+        owner TEXT,
+        heartbeat REAL NOT NULL,
+        created_at REAL NOT NULL,
+        finished_at REAL
+    )""",
+    """CREATE TABLE IF NOT EXISTS broadcast_targets (
+        job_id TEXT NOT NULL,
+        gid TEXT NOT NULL,
+        status TEXT NOT NULL,
+        attempts INTEGER NOT NULL DEFAULT 0,
+        next_at REAL NOT NULL DEFAULT 0,
+        last_error TEXT,
+        PRIMARY KEY (job_id, gid)
+    )""",
+    "CREATE INDEX IF NOT EXISTS idx_broadcast_jobs_status ON broadcast_jobs(status)",
+    """CREATE TABLE IF NOT EXISTS meta (
+        key TEXT PRIMARY KEY,
+        value INTEGER NOT NULL
+    )""",
+    """CREATE TABLE IF NOT EXISTS target_groups (
+        gid TEXT PRIMARY KEY,
+        data TEXT NOT NULL,
+        deleted INTEGER NOT NULL DEFAULT 0,
+        rev INTEGER NOT NULL
+    )""",
+    "CREATE INDEX IF NOT EXISTS idx_target_groups_rev ON target_groups(rev)",
+    """CREATE TABLE IF NOT EXISTS leases (
+        name TEXT PRIMARY KEY,
+        owner TEXT NOT NULL,
+        until REAL NOT NULL
+    )""",
+    """CREATE TABLE IF NOT EXISTS lotto_results (
+        draw_key TEXT PRIMARY KEY,
+        data TEXT NOT NULL,
+        source TEXT,
+        fetched_at REAL NOT NULL
+    )""",
+    """CREATE TABLE IF NOT EXISTS lotto_index (
+        kind TEXT NOT NULL,
+        number TEXT NOT NULL,
+        draw_key TEXT NOT NULL,
+        PRIMARY KEY (kind, number, draw_key)
+    ) WITHOUT ROWID""",
+    "CREATE INDEX IF NOT EXISTS idx_lotto_index_draw ON lotto_index(draw_key)",
+    """CREATE TABLE IF NOT EXISTS seen_events (
+        event_id TEXT PRIMARY KEY,
+        seen_at REAL NOT NULL
+    ) WITHOUT ROWID""",
+    "CREATE INDEX IF NOT EXISTS idx_seen_events_seen_at ON seen_events(seen_at)",
+    """CREATE TABLE IF NOT EXISTS metrics_snapshots (
+        owner TEXT PRIMARY KEY,
+        data TEXT NOT NULL,
+        updated_at REAL NOT NULL
+    )""",
+    """CREATE TABLE IF NOT EXISTS state (
+        key TEXT PRIMARY KEY,
+        value TEXT NOT NULL
+    )""",
+    """CREATE TABLE IF NOT EXISTS target_settings (
+        key TEXT PRIMARY KEY,
+        value TEXT NOT NULL,
+        rev INTEGER NOT NULL
+    )""",
+]
+_db_local = threading.local()
+def _db() -> sqlite3.Connection:
+    """connection ต่อ thread (เปิดใหม่หลัง fork) สร้างตารางครั้งแรกที่ใช้"""
+    conn = getattr(_db_local, "conn", None)
+    if conn is not None and getattr(_db_local, "pid", None) == os.getpid():
+        return conn
+    conn = sqlite3.connect(DB_PATH, timeout=10, check_same_thread=False)
+    conn.row_factory = sqlite3.Row
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA synchronous=NORMAL")
+    with conn:
+        for stmt in _DB_SCHEMA:
+            conn.execute(stmt)
+    _db_local.conn = conn
+    _db_local.pid = os.getpid()
+    return conn
+def _owner_id() -> str:
+    return f"{socket.gethostname()}:{os.getpid()}"
+def _acquire_lease(name: str, ttl: float) -> bool:
+    """lease ข้าม worker (ต่อ process) ได้คืนเมื่อว่างหรือหมดอายุแล้ว หรือเราถืออยู่เอง"""
+    now = time.time()
+    owner = _owner_id()
+    conn = _db()
+    with conn:
+        conn.execute("INSERT OR IGNORE INTO leases (name, owner, until) VALUES (?, '', 0)", (name,))
+        cur = conn.execute(
+            "UPDATE leases SET owner = ?, until = ? WHERE name = ? AND (until < ? OR owner = ?)",
+            (owner, now + ttl, name, now, owner),
+        )
+    return cur.rowcount == 1
+def _release_lease(name: str) -> None:
+    conn = _db()
+    with conn:
+        conn.execute("UPDATE leases SET until = 0 WHERE name = ? AND owner = ?", (name, _owner_id()))
+def _meta_get(key: str, default: float = 0) -> float:
+    row = _db().execute("SELECT value FROM meta WHERE key = ?", (key,)).fetchone()
+    return row[0] if row else default
+def _state_get(key: str) -> Optional[str]:
+    row = _db().execute("SELECT value FROM state WHERE key = ?", (key,)).fetchone()
+    return row[0] if row else None
+def _state_set(key: str, value: str) -> None:
+    conn = _db()
+    with conn:
+        conn.execute(
+            "INSERT INTO state (key, value) VALUES (?, ?) ON CONFLICT(key) DO UPDATE SET value = excluded.value",
+            (key, value),
+        )
+def _state_update(key: str, fn: Any) -> str:
+    """อ่าน-แก้-เขียน state ใน transaction เดียว fn(ค่าเดิม หรือ None) คืนค่าใหม่
+    BEGIN IMMEDIATE ล็อกการเขียนตั้งแต่ก่อนอ่าน worker อื่นจึงเขียนทับกันไม่ได้"""
+    conn = _db()
+    with conn:
+        conn.execute("BEGIN IMMEDIATE")
+        row = conn.execute("SELECT value FROM state WHERE key = ?", (key,)).fetchone()
+        value = fn(row[0] if row else None)
+        conn.execute(
+            "INSERT INTO state (key, value) VALUES (?, ?) ON CONFLICT(key) DO UPDATE SET value = excluded.value",
+            (key, value),
+        )
+    return value
+def _meta_set(key: str, value: float) -> None:
+    conn = _db()
+    with conn:
+        conn.execute(
+            "INSERT INTO meta (key, value) VALUES (?, ?) ON CONFLICT(key) DO UPDATE SET value = excluded.value",
+            (key, value),
+        )
+# Target store
+# เก็บกลุ่ม + settings ไว้ใน memory (dict ค้นหา O(1)) เขียนลง SQLite ทีละแถว
+# แต่ละแถวมีเลข rev ที่เพิ่มขึ้นทุกครั้งที่เขียน worker อื่นจะดึงเฉพาะแถวที่ rev ใหม่กว่าของตัวเอง
+TARGET_STORE_SYNC_SEC = float(os.getenv("TARGET_STORE_SYNC_SEC", "1.0"))
+# กลุ่มที่มีข้อความภายใน TARGET_ACTIVE_DAYS วัน = @active ที่เหลือ = @inactive
+# เงียบเกิน TARGET_PRUNE_DAYS วันจะถูกพักจาก broadcast อัตโนมัติ (0 = ไม่พัก) มีข้อความเข้าอีกก็กลับมาเอง
+TARGET_ACTIVE_DAYS = float(os.getenv("TARGET_ACTIVE_DAYS", "30"))
+TARGET_PRUNE_DAYS = float(os.getenv("TARGET_PRUNE_DAYS", "90"))
+TARGET_PRUNE_CHECK_SEC = float(os.getenv("TARGET_PRUNE_CHECK_SEC", "3600"))
+class TargetStore:
+    def __init__(self):
+        self.lock = threading.RLock()
+        self.groups: Dict[str, Dict[str, Any]] = {}
+        self.settings: Dict[str, Any] = {}
+        self.rev = 0
+        self.checked_at = 0.0
+        self.pid: Optional[int] = None
+        self.write_times: deque = deque(maxlen=4096)
+        # (ชื่อตัวพิมพ์เล็ก, gid) เรียงไว้ตลอด อัปเดตทีละกลุ่มตอนเขียน/sync ไม่ต้อง sort ทั้งหมดทุกครั้งที่ดูรายชื่อ
+        self.name_index: List[Tuple[str, str]] = []
+        # แท็ก -> set ของ gid, (updated_at, gid) เรียงไว้ และกลุ่มที่ถูกพักจาก broadcast
+        # ดูแลพร้อม name_index ใน _set_group เลือกกลุ่มตาม selector ได้โดยไม่ต้องไล่ทุกกลุ่ม
+        self.tag_index: Dict[str, set] = {}
+        self.activity_index: List[Tuple[int, str]] = []
+        self.pruned: set = set()
+    @staticmethod
+    def _name_key(gid: str, rec: Optional[Dict[str, Any]]) -> Tuple[str, str]:
+        return (str((rec or {}).get("name") or "").lower(), gid)
+    @staticmethod
+    def _activity_key(gid: str, rec: Dict[str, Any]) -> Tuple[int, str]:
+        return (int(rec.get("updated_at") or 0), gid)
+    @staticmethod
+    def _remove_sorted(index: List[Any], key: Any) -> None:
+        i = bisect.bisect_left(index, key)
+        if i < len(index) and index[i] == key:
+            del index[i]
+    def _set_group(self, gid: str, rec: Optional[Dict[str, Any]]) -> None:
+        """แทนที่/ลบกลุ่มใน memory พร้อมอัปเดต index ทั้งหมด (เรียกภายใต้ self.lock)"""
+        old = self.groups.get(gid)
+        if old is not None:
+            self._remove_sorted(self.name_index, self._name_key(gid, old))
+            self._remove_sorted(self.activity_index, self._activity_key(gid, old))
+            for tag in old.get("tags") or ():
+                members = self.tag_index.get(tag)
+                if members is not None:
+                    members.discard(gid)
+                    if not members:
+                        del self.tag_index[tag]
+            self.pruned.discard(gid)
+        if rec is None:
+            self.groups.pop(gid, None)
+            return
+        self.groups[gid] = rec
+        bisect.insort(self.name_index, self._name_key(gid, rec))
+        bisect.insort(self.activity_index, self._activity_key(gid, rec))
+        for tag in rec.get("tags") or ():
+            self.tag_index.setdefault(tag, set()).add(gid)
+        if rec.get("pruned_at"):
+            self.pruned.add(gid)
+    def _selector_term(self, name: str, now: float) -> set:
+        """gid ของแท็กเดียว (เรียกภายใต้ self.lock) active/inactive ใช้ bisect บน activity_index"""
+        if name == "all":
+            return set(self.groups)
+        if name in ("active", "inactive"):
+            i = bisect.bisect_left(self.activity_index, (int(now - TARGET_ACTIVE_DAYS * 86400), ""))
+            rows = self.activity_index[i:] if name == "active" else self.activity_index[:i]
+            return {gid for _, gid in rows}
+        if name not in self.tag_index:
+            raise ValueError(f"ไม่รู้จักแท็ก @{name}")
+        return self.tag_index[name]
+    def select(self, selector: List[str]) -> set:
+        """gid ที่ตรงกับ selector (ไม่รวมกลุ่มที่ถูกพัก) เช่น ["@vip", "@north+gold", "-@inactive"]
 
-def _save_targets(data: Dict[str, Any]) -> None:
-    # บังคับไม่เขียน key 'rooms' ลงไฟล์ (เผื่อมีหลงมา)
-    data.pop("rooms", None)
-    try:
-        with open(TARGETS_PATH, "w", encoding="utf-8") as f:
-            json.dump(data, f, ensure_ascii=False, indent=2)
-    except Exception as e:
-        app.logger.warning(f"save targets.json failed: {e}")
+        หลายตัว = หรือ, + = และ, -@ = ยกเว้น ไม่มี selector = ทุกกลุ่ม ไม่รู้จักแท็กจะ ValueError
+        """
+        self.refresh()
+        now = time.time()
+        with self.lock:
+            include: Optional[set] = None
+            exclude: set = set()
+            for token in selector:
+                # แต่ละส่วนของ + ใส่ @ นำหน้าได้ (@vip+@north เท่ากับ @vip+north)
+                names = [n[1:] if n.startswith("@") else n for n in token.lower().removeprefix("-").split("+")]
+                names = [n for n in names if n]
+                if not names:
+                    continue
+                sets = sorted((self._selector_term(n, now) for n in names), key=len)
+                hit = sets[0].intersection(*sets[1:])
+                if token.startswith("-"):
+                    exclude |= hit
+                elif include is None:
+                    include = set(hit)
+                else:
+                    include |= hit
+            if include is None:
+                include = set(self.groups)
+            return include - exclude - self.pruned
+    def tag_counts(self) -> Dict[str, int]:
+        self.refresh()
+        with self.lock:
+            return {tag: len(members) for tag, members in self.tag_index.items()}
+    def inactive_since(self, cutoff: float) -> List[str]:
+        """กลุ่มที่ยังไม่ถูกพักและ updated_at เก่ากว่า cutoff (ไม่นับกลุ่มที่ไม่มี updated_at เช่นข้อมูลจาก targets.json เดิม)"""
+        self.refresh()
+        with self.lock:
+            i = bisect.bisect_left(self.activity_index, (int(cutoff), ""))
+            return [gid for ts, gid in self.activity_index[:i] if ts > 0 and gid not in self.pruned]
+    def page(self, page: int, size: int) -> Tuple[int, List[Tuple[int, str, Dict[str, Any]]]]:
+        """หน้าที่ page (เริ่ม 1) ของรายชื่อเรียงตามชื่อ คืน (จำนวนทั้งหมด, [(ลำดับ, gid, record)])"""
+        self.refresh()
+        with self.lock:
+            start = (page - 1) * size
+            rows = self.name_index[start:start + size]
+            return len(self.name_index), [(start + i + 1, gid, dict(self.groups[gid])) for i, (_, gid) in enumerate(rows)]
+    def search(self, query: str, limit: int) -> Tuple[int, List[Tuple[int, str, Dict[str, Any]]]]:
+        """ค้นหาชื่อกลุ่ม (มีคำนี้อยู่ในชื่อ) คืน (จำนวนที่พบทั้งหมด, limit รายการแรกตามลำดับชื่อ)"""
+        self.refresh()
+        q = query.strip().lower()
+        found: List[Tuple[int, str, Dict[str, Any]]] = []
+        total = 0
+        with self.lock:
+            for i, (name, gid) in enumerate(self.name_index, start=1):
+                if q in name:
+                    total += 1
+                    if len(found) < limit:
+                        found.append((i, gid, dict(self.groups[gid])))
+        return total, found
+    def _count_write(self, kind: str, n: int = 1) -> None:
+        metrics.inc("target_store_writes_total", n, kind=kind)
+        self.write_times.append(time.monotonic())
+    def writes_per_sec(self, window: float = 60.0) -> float:
+        cutoff = time.monotonic() - window
+        return sum(1 for t in list(self.write_times) if t >= cutoff) / window
+    def _migrate_json(self, conn: sqlite3.Connection) -> None:
+        """ย้ายข้อมูลจาก targets.json เดิมเข้า SQLite ครั้งแรก (ไม่ลบไฟล์เดิม)"""
+        if conn.execute("SELECT 1 FROM meta WHERE key = 'targets_migrated'").fetchone():
+            return
+        data: Dict[str, Any] = {}
+        if os.path.exists(TARGETS_PATH):
+            try:
+                with open(TARGETS_PATH, "r", encoding="utf-8") as f:
+                    data = json.load(f) or {}
+            except Exception as e:
+                log_event(logging.WARNING, "targets_migration_read_failed", error=e)
+        with conn:
+            if conn.execute("SELECT 1 FROM meta WHERE key = 'targets_migrated'").fetchone():
+                return
+            rev = self._next_rev(conn)
+            # rooms เก่าไม่ย้าย (เก็บเฉพาะ groups)
+            conn.executemany(
+                "INSERT OR IGNORE INTO target_groups (gid, data, rev) VALUES (?, ?, ?)",
+                [(gid, json.dumps(g or {}, ensure_ascii=False), rev) for gid, g in (data.get("groups") or {}).items() if gid],
+            )
+            conn.executemany(
+                "INSERT OR IGNORE INTO target_settings (key, value, rev) VALUES (?, ?, ?)",
+                [(k, json.dumps(v), rev) for k, v in (data.get("settings") or {}).items()],
+            )
+            conn.execute("INSERT OR IGNORE INTO meta (key, value) VALUES ('targets_migrated', 1)")
+    @staticmethod
+    def _next_rev(conn: sqlite3.Connection) -> int:
+        conn.execute("INSERT OR IGNORE INTO meta (key, value) VALUES ('targets_rev', 0)")
+        conn.execute("UPDATE meta SET value = value + 1 WHERE key = 'targets_rev'")
+        return conn.execute("SELECT value FROM meta WHERE key = 'targets_rev'").fetchone()[0]
+    def refresh(self, force: bool = False) -> None:
+        """ดึงการเปลี่ยนแปลงจาก worker อื่น (อย่างมากทุก TARGET_STORE_SYNC_SEC วินาที)"""
+        now = time.monotonic()
+        if not force and self.pid == os.getpid() and now - self.checked_at < TARGET_STORE_SYNC_SEC:
+            return
+        started = time.monotonic()
+        with self.lock:
+            conn = _db()
+            if self.pid != os.getpid():
+                self._migrate_json(conn)
+                self.groups, self.settings, self.rev, self.name_index = {}, {}, 0, []
+                self.tag_index, self.activity_index, self.pruned = {}, [], set()
+                self.pid = os.getpid()
+            row = conn.execute("SELECT value FROM meta WHERE key = 'targets_rev'").fetchone()
+            db_rev = row[0] if row else 0
+            if db_rev > self.rev:
+                for r in conn.execute("SELECT gid, data, deleted FROM target_groups WHERE rev > ?", (self.rev,)):
+                    self._set_group(r["gid"], None if r["deleted"] else json.loads(r["data"]))
+                for r in conn.execute("SELECT key, value FROM target_settings WHERE rev > ?", (self.rev,)):
+                    self.settings[r["key"]] = json.loads(r["value"])
+                self.rev = db_rev
+            self.checked_at = now
+        metrics.observe("target_store_io_seconds", time.monotonic() - started, op="refresh")
+    def get(self, gid: str) -> Optional[Dict[str, Any]]:
+        self.refresh()
+        g = self.groups.get(gid)
+        return dict(g) if g is not None else None
+    def ids(self) -> List[str]:
+        self.refresh()
+        return list(self.groups.keys())
+    def items(self) -> List[Tuple[str, Dict[str, Any]]]:
+        self.refresh()
+        with self.lock:
+            return [(gid, dict(g)) for gid, g in self.groups.items()]
+    def __len__(self) -> int:
+        self.refresh()
+        return len(self.groups)
+    def put(self, gid: str, record: Dict[str, Any]) -> None:
+        self.put_many({gid: record})
+    def put_many(self, records: Dict[str, Dict[str, Any]]) -> None:
+        """เขียนหลายกลุ่มใน transaction เดียว (ใช้ rev เดียวกัน)"""
+        if not records:
+            return
+        started = time.monotonic()
+        with self.lock:
+            conn = _db()
+            with conn:
+                rev = self._next_rev(conn)
+                conn.executemany(
+                    "INSERT INTO target_groups (gid, data, deleted, rev) VALUES (?, ?, 0, ?)"
+                    " ON CONFLICT(gid) DO UPDATE SET data = excluded.data, deleted = 0, rev = excluded.rev",
+                    [(gid, json.dumps(rec, ensure_ascii=False), rev) for gid, rec in records.items()],
+                )
+            for gid, rec in records.items():
+                self._set_group(gid, dict(rec))
+            self._count_write("groups")
+        metrics.observe("target_store_io_seconds", time.monotonic() - started, op="write")
+    def modify_many(self, gids: Iterable[str], fn: Any) -> Dict[str, Dict[str, Any]]:
+        """แก้หลายกลุ่มจากแถวล่าสุดใน DB ไม่ใช่จาก cache (ที่อาจช้ากว่า worker อื่นได้ถึง TARGET_STORE_SYNC_SEC)
 
+        fn(gid, record) แก้ record ตรง ๆ แล้วคืน True ถ้าต้องเขียน อ่านหลังได้ write lock ใน transaction เดียวกับที่เขียน
+        จึงไม่ทับ field ที่ worker อื่นเพิ่งแก้ (เช่นแท็ก) คืน {gid: record ที่เขียน}
+        """
+        gids = list(dict.fromkeys(gids))
+        if not gids:
+            return {}
+        started = time.monotonic()
+        changed: Dict[str, Dict[str, Any]] = {}
+        with self.lock:
+            conn = _db()
+            with conn:
+                # เขียน rev ก่อน = ได้ write lock แล้ว ค่อยอ่าน (ไม่มี worker อื่นแทรกระหว่างอ่านกับเขียน)
+                rev = self._next_rev(conn)
+                for i in range(0, len(gids), 500):
+                    chunk = gids[i:i + 500]
+                    for r in conn.execute(
+                        f"SELECT gid, data FROM target_groups WHERE deleted = 0 AND gid IN ({','.join('?' * len(chunk))})", chunk
+                    ):
+                        rec = json.loads(r["data"])
+                        if fn(r["gid"], rec):
+                            changed[r["gid"]] = rec
+                conn.executemany(
+                    "UPDATE target_groups SET data = ?, rev = ? WHERE gid = ?",
+                    [(json.dumps(rec, ensure_ascii=False), rev, gid) for gid, rec in changed.items()],
+                )
+            for gid, rec in changed.items():
+                self._set_group(gid, dict(rec))
+            if changed:
+                self._count_write("groups")
+        metrics.observe("target_store_io_seconds", time.monotonic() - started, op="write")
+        return changed
+    def delete(self, gid: str) -> None:
+        with self.lock:
+            conn = _db()
+            with conn:
+                rev = self._next_rev(conn)
+                conn.execute("UPDATE target_groups SET deleted = 1, rev = ? WHERE gid = ?", (rev, gid))
+            self._set_group(gid, None)
+            self._count_write("delete")
+    def get_setting(self, key: str, default: Any = None) -> Any:
+        self.refresh()
+        return self.settings.get(key, default)
+    def set_setting(self, key: str, value: Any) -> None:
+        with self.lock:
+            conn = _db()
+            with conn:
+                rev = self._next_rev(conn)
+                conn.execute(
+                    "INSERT INTO target_settings (key, value, rev) VALUES (?, ?, ?)"
+                    " ON CONFLICT(key) DO UPDATE SET value = excluded.value, rev = excluded.rev",
+                    (key, json.dumps(value), rev),
+                )
+            self.settings[key] = value
+            self._count_write("settings")
+target_store = TargetStore()
 def remember_enabled() -> bool:
-    data = _load_targets()
-    return bool((data.get("settings") or {}).get("remember_enabled", False))
+    return bool(target_store.get_setting("remember_enabled", False))
 def set_remember_enabled(enabled: bool) -> None:
-    data = _load_targets()
-    data.setdefault("settings", {})
-    data["settings"]["remember_enabled"] = bool(enabled)
-    _save_targets(data)
+    target_store.set_setting("remember_enabled", bool(enabled))
+    if not enabled:
+        # กลุ่มที่อยู่ในช่วง debounce จะไม่ถูก touch ต่อ
+        with _remember_lock:
+            _remember_last.clear()
 def current_target_id(event: MessageEvent) -> Optional[str]:
     src = event.source
     # group/room/user (room จะไม่ถูกบันทึก)
     return getattr(src, "group_id", None) or getattr(src, "room_id", None) or getattr(src, "user_id", None)
-def remember_target(event: MessageEvent):
-    """เวอร์ชัน Debug: เก็บเฉพาะ Group ID (ไม่เก็บ Room)"""
-    print(f"--- 🔍 เริ่มตรวจสอบ: มีข้อความเข้า ---")
-
-    # เช็กว่าเปิดโหมดจำหรือไม่
-    is_enabled = remember_enabled()
-    print(f"   สถานะโหมดจำ: {'เปิด ✅' if is_enabled else 'ปิด ⛔'}")
-    if not is_enabled:
-        print("   ❌ จบการทำงาน: เพราะโหมดจำปิดอยู่")
+# Group summary cache
+# ชื่อกลุ่มแทบไม่เปลี่ยน เก็บไว้ใน cache (TTL + LRU) แล้วให้ thread เบื้องหลังไปถาม LINE
+# ตามอัตราที่จำกัด ทางหลักของข้อความจึงไม่ต้องรอ get_group_summary เลย
+GROUP_NAME_TTL_SEC = float(os.getenv("GROUP_NAME_TTL_SEC", "21600"))
+GROUP_NAME_CACHE_SIZE = int(os.getenv("GROUP_NAME_CACHE_SIZE", "5000"))
+GROUP_NAME_REFRESH_PER_SEC = float(os.getenv("GROUP_NAME_REFRESH_PER_SEC", "5"))
+# ถาม LINE ไม่สำเร็จ จำไว้แค่ช่วงสั้น ๆ (ไม่ถามซ้ำทุกข้อความ แต่ไม่ติดชื่อเดิม/ไม่ทราบชื่อไปทั้ง TTL)
+GROUP_NAME_RETRY_SEC = float(os.getenv("GROUP_NAME_RETRY_SEC", "300"))
+class GroupSummaryCache:
+    def __init__(self, ttl: float, max_size: int, refresh_per_sec: float, retry_ttl: float = GROUP_NAME_RETRY_SEC):
+        self.ttl = ttl
+        self.retry_ttl = retry_ttl
+        self.max_size = max(1, max_size)
+        self.lock = threading.Lock()
+        # gid -> (ชื่อ, เวลาหมดอายุ monotonic)
+        self.entries: "OrderedDict[str, Tuple[Optional[str], float]]" = OrderedDict()
+        self.queue: "queue.Queue[str]" = queue.Queue()
+        self.queued: set = set()
+        self.bucket = _TokenBucket(refresh_per_sec, 1)
+        self.on_update = None
+        self.worker_pid: Optional[int] = None
+    def get(self, gid: str) -> Optional[str]:
+        """คืนชื่อใน cache ทันที (อาจเก่าหรือไม่มี) ถ้าหมดอายุจะสั่ง refresh เบื้องหลัง"""
+        with self.lock:
+            entry = self.entries.get(gid)
+            if entry is not None:
+                self.entries.move_to_end(gid)
+        if entry is None:
+            metrics.inc("group_summary_cache_total", result="miss")
+            self.request_refresh(gid)
+            return None
+        name, expires_at = entry
+        if time.monotonic() >= expires_at:
+            metrics.inc("group_summary_cache_total", result="stale")
+            self.request_refresh(gid)
+        else:
+            metrics.inc("group_summary_cache_total", result="hit")
+        return name
+    def put(self, gid: str, name: Optional[str], ttl: Optional[float] = None) -> None:
+        with self.lock:
+            self.entries[gid] = (name, time.monotonic() + (self.ttl if ttl is None else ttl))
+            self.entries.move_to_end(gid)
+            while len(self.entries) > self.max_size:
+                self.entries.popitem(last=False)
+    def request_refresh(self, gid: str) -> None:
+        self._ensure_worker()
+        with self.lock:
+            if gid in self.queued:
+                return
+            self.queued.add(gid)
+        self.queue.put(gid)
+    def refresh_all(self, gids: Iterable[str]) -> int:
+        """สั่ง refresh ทุกกลุ่มที่ cache หมดอายุหรือยังไม่มี (ทยอยทำตาม rate) คืนจำนวนที่เข้าคิว"""
+        now = time.monotonic()
+        n = 0
+        for gid in gids:
+            with self.lock:
+                entry = self.entries.get(gid)
+            if entry is None or now >= entry[1]:
+                self.request_refresh(gid)
+                n += 1
+        return n
+    def pending(self) -> int:
+        return self.queue.qsize()
+    def _ensure_worker(self) -> None:
+        if self.worker_pid == os.getpid():
+            return
+        with self.lock:
+            if self.worker_pid == os.getpid():
+                return
+            self.worker_pid = os.getpid()
+        threading.Thread(target=self._worker, name="group-summary-refresh", daemon=True).start()
+    def _worker(self) -> None:
+        while True:
+            gid = self.queue.get()
+            with self.lock:
+                self.queued.discard(gid)
+            self.bucket.acquire()
+            try:
+                name = getattr(line_call("group_summary", line_api().get_group_summary, gid), "group_name", None)
+                metrics.inc("group_summary_refresh_total", status="ok")
+            except Exception as e:
+                metrics.inc("group_summary_refresh_total", status="error")
+                log_event(logging.WARNING, "group_summary_failed", gid=gid, error=e)
+                # จำไว้ว่าเพิ่งลอง จะได้ไม่ถามซ้ำทุกข้อความ (ใช้ชื่อเดิมไปก่อน) แล้วลองใหม่หลัง retry_ttl
+                with self.lock:
+                    prev = self.entries.get(gid)
+                self.put(gid, prev[0] if prev else None, ttl=self.retry_ttl)
+                continue
+            self.put(gid, name)
+            if self.on_update is not None and name:
+                try:
+                    self.on_update(gid, name)
+                except Exception as e:
+                    log_event(logging.WARNING, "group_name_update_failed", gid=gid, error=e)
+group_names = GroupSummaryCache(GROUP_NAME_TTL_SEC, GROUP_NAME_CACHE_SIZE, GROUP_NAME_REFRESH_PER_SEC)
+# โหมดจำ: กลุ่มที่เพิ่งจัดการไปภายใน REMEMBER_DEBOUNCE_SEC จะไม่ถามชื่อจาก LINE ซ้ำ
+# ส่วน updated_at ที่แค่เลื่อนเวลาจะพักไว้ใน memory แล้วเขียนรวมทุก REMEMBER_FLUSH_SEC
+REMEMBER_DEBOUNCE_SEC = float(os.getenv("REMEMBER_DEBOUNCE_SEC", "300"))
+REMEMBER_FLUSH_SEC = float(os.getenv("REMEMBER_FLUSH_SEC", "30"))
+_remember_lock = threading.Lock()
+_remember_last: Dict[str, float] = {}
+_pending_touches: Dict[str, int] = {}
+_touches_flushed_at = time.monotonic()
+def _touch_target(gid: str, ts: int) -> None:
+    with _remember_lock:
+        _pending_touches[gid] = ts
+        due = time.monotonic() - _touches_flushed_at >= REMEMBER_FLUSH_SEC
+    if due:
+        flush_target_touches()
+def flush_target_touches() -> int:
+    """เขียน updated_at ที่ค้างอยู่ทั้งหมดใน transaction เดียว คืนจำนวนกลุ่มที่เขียน"""
+    global _touches_flushed_at
+    with _remember_lock:
+        pending = dict(_pending_touches)
+        _pending_touches.clear()
+        _touches_flushed_at = time.monotonic()
+    # worker อื่นอาจปิดโหมดจำไปแล้วหลังจากที่ touch ถูกเก็บไว้ -> ทิ้ง
+    if not pending or not remember_enabled():
+        return 0
+    def touch(gid: str, rec: Dict[str, Any]) -> bool:
+        ts = pending[gid]
+        if ts <= int(rec.get("updated_at") or 0):
+            return False
+        rec["updated_at"] = ts
+        # กลุ่มที่ถูกพักไว้กลับมามีข้อความ -> รับ broadcast ตามเดิม
+        rec.pop("pruned_at", None)
+        return True
+    # กลุ่มที่ถูกลบไประหว่างรอ modify_many ข้ามให้เอง
+    try:
+        records = target_store.modify_many(pending, touch)
+    except Exception as e:
+        log_event(logging.WARNING, "target_touch_flush_failed", error=e)
+        with _remember_lock:
+            for gid, ts in pending.items():
+                _pending_touches.setdefault(gid, ts)
+        return 0
+    return len(records)
+def _touch_flush_loop() -> None:
+    while True:
+        time.sleep(REMEMBER_FLUSH_SEC)
+        if _pending_touches:
+            flush_target_touches()
+def _on_group_name(gid: str, name: str) -> None:
+    """callback จาก group_names: เขียนลง store เฉพาะเมื่อชื่อเปลี่ยนจริง"""
+    cur = target_store.get(gid)
+    if cur is None or cur.get("name") == name:
         return
+    def rename(_: str, rec: Dict[str, Any]) -> bool:
+        if rec.get("name") == name:
+            return False
+        rec["name"] = name
+        return True
+    if target_store.modify_many([gid], rename):
+        metrics.inc("remember_events_total", outcome="renamed")
+group_names.on_update = _on_group_name
+def remember_target(event: MessageEvent):
+    """เก็บเฉพาะ Group ID (ไม่เก็บ Room) เขียนจริงเฉพาะกลุ่มใหม่/ชื่อเปลี่ยน
 
-    src = event.source
-    gid = getattr(src, "group_id", None)
-    print(f"   ชนิด Source: {src.type}")
-    print(f"   Group ID: {gid}")
-
+    กลุ่มที่เพิ่งเห็นในช่วง REMEMBER_DEBOUNCE_SEC ใช้แค่ข้อมูลใน memory (ทางด่วนของแชทปกติ)
+    """
+    gid = getattr(event.source, "group_id", None)
     # เก็บเฉพาะกลุ่มเท่านั้น
     if not gid:
-        print("   ❌ จบการทำงาน: ไม่ใช่ Group (อาจเป็น Room หรือแชทส่วนตัว)")
         return
+    # เช็คก่อนทางด่วน debounce: worker อื่นอาจปิดโหมดจำไปแล้ว (set_remember_enabled ล้าง debounce ได้แค่ใน process ตัวเอง)
+    if not remember_enabled():
+        return
+    now = time.time()
+    with _remember_lock:
+        last = _remember_last.get(gid)
+        debounced = last is not None and now - last < REMEMBER_DEBOUNCE_SEC
+    if debounced:
+        metrics.inc("remember_events_total", outcome="debounced")
+        _touch_target(gid, int(now))
+        return
+    cur = target_store.get(gid)
+    with _remember_lock:
+        _remember_last[gid] = now
 
-    # ดึงชื่อกลุ่ม
-    name = None
-    try:
-        with ApiClient(config) as api_client:
-            api = MessagingApi(api_client)
-            print("   ...กำลังขอชื่อกลุ่มจาก LINE API...")
-            prof = api.get_group_summary(gid)
-            name = getattr(prof, "group_name", None)
-            print(f"   ✅ ได้ชื่อกลุ่มมาว่า: {name}")
-    except Exception as e:
-        print(f"   ⚠️ ดึงชื่อกลุ่มไม่ได้ (Error: {e}) -> จะใช้ชื่อเดิมหรือเว้นว่าง")
-        name = None
+    # ชื่อกลุ่มจาก cache (ไม่รอ LINE) ถ้าเปลี่ยน _on_group_name จะเขียนให้ทีหลัง
+    name = group_names.get(gid)
+    if cur is not None:
+        metrics.inc("remember_events_total", outcome="unchanged")
+        _touch_target(gid, int(now))
+        return
 
-    # บันทึกลงไฟล์ (groups เท่านั้น)
+    # กลุ่มใหม่ บันทึกทันที (groups เท่านั้น)
     try:
-        data = _load_targets()
-        data.setdefault("groups", {})
-        cur = data["groups"].get(gid) or {}
-
-        # อัปเดตชื่อ
-        if name:
-            cur["name"] = name
-        else:
-            cur.setdefault("name", cur.get("name") or "(ไม่ทราบชื่อกลุ่ม)")
-
-        cur["updated_at"] = int(time.time())
-        data["groups"][gid] = cur
-
-        _save_targets(data)
-        print(f"   ✅✅ SAVE SUCCESS! บันทึก Group ID ลง targets.json เรียบร้อย")
+        target_store.put(gid, {"name": name or "(ไม่ทราบชื่อกลุ่ม)", "updated_at": int(now)})
+        metrics.inc("remember_events_total", outcome="written")
+        log_event(logging.INFO, "target_saved", gid=gid)
     except Exception as e:
-        print(f"   🔥 SAVE FAILED: เกิดข้อผิดพลาดตอนบันทึกไฟล์: {e}")
+        metrics.inc("remember_events_total", outcome="error")
+        log_event(logging.ERROR, "target_save_failed", gid=gid, error=e)
 
-def iter_all_targets(exclude_id: Optional[str] = None) -> Iterable[str]:
-    data = _load_targets()
-    for gid in (data.get("groups") or {}).keys():
+def iter_all_targets(exclude_id: Optional[str] = None, selector: Optional[List[str]] = None) -> Iterable[str]:
+    """กลุ่มปลายทางของ broadcast (ไม่รวมกลุ่มที่ถูกพัก) selector เช่น ["@vip"] ดู TargetStore.select"""
+    # ก่อน broadcast ดึงการเปลี่ยนแปลงล่าสุดจาก worker อื่นเสมอ
+    target_store.refresh(force=True)
+    for gid in target_store.select(selector or []):
         if gid and gid != exclude_id:
             yield gid
+# Tags / segments
+# ขึ้นต้นด้วย - ไม่ได้ (ชนกับ -@ ที่แปลว่ายกเว้นใน selector)
+_TAG_RE = re.compile(r"^[0-9a-zก-๙_][0-9a-zก-๙_\-]{0,31}$")
+_RESERVED_TAGS = ("all", "active", "inactive")
+_GROUP_ID_RE = re.compile(r"^C[0-9a-f]{32}$")
+def normalize_tag(tag: str) -> str:
+    """ชื่อแท็กตัวพิมพ์เล็กไม่มี @ (ตัวอักษร/ตัวเลข/ไทย/_/- ไม่เกิน 32 ตัว ห้ามขึ้นต้นด้วย -) ผิดรูปแบบจะ ValueError"""
+    tag = tag.strip().lower()
+    tag = tag[1:] if tag.startswith("@") else tag
+    if not _TAG_RE.match(tag):
+        raise ValueError(f"ชื่อแท็กไม่ถูกต้อง: {tag or '(ว่าง)'}")
+    if tag in _RESERVED_TAGS:
+        raise ValueError(f"@{tag} เป็นแท็กของระบบ ตั้งเองไม่ได้")
+    return tag
+def split_selector(args: List[str]) -> Tuple[List[str], List[str]]:
+    """แยก args ของคำสั่งเป็น (selector ที่ขึ้นต้นด้วย @ หรือ -@, ที่เหลือ)"""
+    selector = [a for a in args if a.startswith("@") or a.startswith("-@")]
+    return selector, [a for a in args if a not in selector]
+def set_target_tags(gid: str, add: Iterable[str] = (), remove: Iterable[str] = ()) -> Optional[List[str]]:
+    """เพิ่ม/ลบแท็กของกลุ่ม คืนแท็กหลังแก้ (None ถ้าไม่รู้จักกลุ่มนี้)"""
+    added = {normalize_tag(t) for t in add}
+    removed = {t.strip().lstrip("@").lower() for t in remove}
+    result: Dict[str, List[str]] = {}
+    def retag(_: str, rec: Dict[str, Any]) -> bool:
+        before = sorted(rec.get("tags") or ())
+        tags = result["tags"] = sorted((set(before) | added) - removed)
+        if tags == before:
+            return False
+        if tags:
+            rec["tags"] = tags
+        else:
+            rec.pop("tags", None)
+        return True
+    target_store.modify_many([gid], retag)
+    return result.get("tags")
+def prune_inactive_targets(now: Optional[float] = None) -> int:
+    """พักกลุ่มที่เงียบเกิน TARGET_PRUNE_DAYS จาก broadcast (ไม่ลบ แท็กยังอยู่) คืนจำนวนที่พัก
+
+    ถ้าปิดโหมดจำอยู่ updated_at จะไม่ขยับ จึงไม่พักอะไรเลย
+    """
+    if TARGET_PRUNE_DAYS <= 0 or not remember_enabled():
+        return 0
+    now = time.time() if now is None else now
+    flush_target_touches()
+    cutoff = now - TARGET_PRUNE_DAYS * 86400
+    def prune(_: str, rec: Dict[str, Any]) -> bool:
+        # เช็คซ้ำจากแถวล่าสุด worker อื่นอาจเพิ่ง flush updated_at ใหม่ไป
+        if rec.get("pruned_at") or not 0 < int(rec.get("updated_at") or 0) < cutoff:
+            return False
+        rec["pruned_at"] = int(now)
+        return True
+    records = target_store.modify_many(target_store.inactive_since(cutoff), prune)
+    if records:
+        metrics.inc("targets_pruned_total", len(records))
+        log_event(logging.INFO, "targets_pruned", count=len(records), days=TARGET_PRUNE_DAYS)
+    return len(records)
+def _prune_loop() -> None:
+    while True:
+        time.sleep(TARGET_PRUNE_CHECK_SEC)
+        try:
+            if _acquire_lease("target_prune", TARGET_PRUNE_CHECK_SEC / 2):
+                prune_inactive_targets()
+        except Exception as e:
+            log_event(logging.WARNING, "target_prune_failed", error=e)
 
-def build_customers_text() -> str:
-    data = _load_targets()
-    enabled = bool((data.get("settings") or {}).get("remember_enabled", False))
-    groups: Dict[str, Any] = data.get("groups", {}) or {}
-    total = len(groups)
+CUSTOMERS_PAGE_SIZE = int(os.getenv("CUSTOMERS_PAGE_SIZE", "50"))
+LINE_TEXT_MAX = 5000
+def _customer_line(i: int, g: Optional[Dict[str, Any]]) -> str:
+    g = g or {}
+    # ชื่อยาวผิดปกติตัดไว้ ให้ 1 หน้าไม่เกินขนาดข้อความของ LINE (5000 ตัวอักษร)
+    line = f" {i}: {(g.get('name') or '(ไม่ทราบชื่อกลุ่ม)')[:60]}"
+    if g.get("tags"):
+        line += " " + " ".join(f"@{t}" for t in g["tags"])
+    return line + (" 💤" if g.get("pruned_at") else "")
+def _customer_lines(rows: List[Tuple[int, str, Dict[str, Any]]], room: int = LINE_TEXT_MAX) -> List[str]:
+    """บรรทัดรายชื่อที่รวมกันไม่เกิน room ตัวอักษร (กลุ่มที่มีแท็กเยอะ บรรทัดยาวเกินส่วนแบ่งจะถูกตัดท้าย)"""
+    lines = [_customer_line(i, g) for i, _, g in rows]
+    if sum(len(l) + 1 for l in lines) <= room:
+        return lines
+    width = max(8, room // max(1, len(lines)) - 1)
+    return [l if len(l) <= width else l[:width - 1] + "…" for l in lines]
+def build_customers_text(page: int = 1) -> str:
+    enabled = remember_enabled()
     status = "เปิด✅" if enabled else "ปิด⛔"
+    size = max(1, CUSTOMERS_PAGE_SIZE)
+    page = max(1, page)
+    total, rows = target_store.page(page, size)
+    pages = max(1, -(-total // size))
+    if page > pages:
+        # ขอหน้าเกินจำนวนที่มี แสดงหน้าสุดท้ายแทน
+        page = pages
+        total, rows = target_store.page(page, size)
 
     lines: List[str] = []
     lines.append(f"โหมดจำชื่อกลุ่ม/ID: {status}")
     lines.append("")
     lines.append("📒 รายชื่อลูกค้าที่บันทึกไว้ ")
-    lines.append(f"รวมทั้งหมด: {total} (กลุ่ม {len(groups)})")
+    lines.append(f"รวมทั้งหมด: {total} (กลุ่ม {total})")
 
     # Groups
-    lines.append("👥 กลุ่ม (Group)")
-    if groups:
-        def gkey(item):
-            _, g = item
-            name = (g or {}).get("name") or ""
-            return name.lower()
-
-        for i, (_, g) in enumerate(sorted(groups.items(), key=gkey), start=1):
-            name = (g or {}).get("name") or "(ไม่ทราบชื่อกลุ่ม)"
-            lines.append(f" {i}: {name}")
+    lines.append(f"👥 กลุ่ม (Group) หน้า {page}/{pages}")
+    tail: List[str] = []
+    if page < pages:
+        tail.append(f"➡️ หน้าถัดไป: /ลูกค้า {page + 1}")
+    if page == 1:
+        tail.append("")
+        # รายการคำสั่งมาจาก registry เดียวกับข้อความช่วยเหลือ คำสั่งใหม่จึงขึ้นที่นี่เองโดยไม่ต้องแก้
+        tail.append(build_help_text())
+    if rows:
+        lines.extend(_customer_lines(rows, LINE_TEXT_MAX - len("\n".join(lines + tail)) - 1))
     else:
         lines.append(" (ยังไม่มี)")
-
+    return "\n".join(lines + tail).rstrip()
+def build_customer_search_text(query: str) -> str:
+    size = max(1, CUSTOMERS_PAGE_SIZE)
+    total, rows = target_store.search(query, size)
+    if not total:
+        return f"🔎 ไม่พบกลุ่มที่ชื่อมี \"{query}\""
+    lines = [f"🔎 พบ {total} กลุ่มที่ชื่อมี \"{query[:100]}\" (ตัวเลข = ลำดับใน /ลูกค้า)"]
+    tail = [f"... แสดง {len(rows)} รายการแรก พิมพ์ชื่อให้เจาะจงขึ้นเพื่อดูที่เหลือ"] if total > len(rows) else []
+    lines.extend(_customer_lines(rows, LINE_TEXT_MAX - len("\n".join(lines + tail)) - 1))
+    return "\n".join(lines + tail)
+def build_tags_text() -> str:
+    counts = target_store.tag_counts()
+    lines = ["🏷️ แท็กกลุ่ม"]
+    if counts:
+        lines.extend(f" @{tag}: {n} กลุ่ม" for tag, n in sorted(counts.items(), key=lambda kv: (-kv[1], kv[0])))
+    else:
+        lines.append(" (ยังไม่มีแท็ก)")
+    active, inactive = len(target_store.select(["@active"])), len(target_store.select(["@inactive"]))
+    lines.append(f"@active (มีข้อความใน {TARGET_ACTIVE_DAYS:g} วัน): {active} | @inactive: {inactive} | พักไว้ 💤: {len(target_store.pruned)}")
     lines.append("")
-    lines.append("รายการคำสั่ง:")
-    lines.append("- /ลูกค้า          (ดูรายชื่อกลุ่มที่บันทึกไว้)")
-    lines.append("- /ลูกค้า เปิด/ปิด   (เริ่ม/หยุดจำชื่อกลุ่ม)")
-    lines.append("- /ปิดรับ          (ส่งรูปปิดรับให้ทุกกลุ่ม)")
-    lines.append("- /ผลหวย           (สร้างรูปผลหวยและบันทึก)")
-    lines.append("- /ส่งผลหวย ลิ้ง    (ส่งรูปแบบลิ้งให้ทุกกลุ่ม)")
-    lines.append("- /แจ้งโอน         (ส่งรูปแจ้งโอนให้ทุกกลุ่ม)")
-    return "\n".join(lines).rstrip()
+    lines.append("ส่งเฉพาะแท็ก: /ปิดรับ @vip  (@a @b = หรือ, @a+b = และ, -@a = ยกเว้น)")
+    return "\n".join(lines)
+def build_selector_text(selector: List[str]) -> str:
+    gids = target_store.select(selector)
+    size = max(1, CUSTOMERS_PAGE_SIZE)
+    rows = sorted((TargetStore._name_key(gid, target_store.get(gid)), gid) for gid in gids)
+    lines = [f"🎯 {' '.join(selector)}: {len(gids)} กลุ่ม"]
+    lines.extend(_customer_line(i, target_store.get(gid)) for i, (_, gid) in enumerate(rows[:size], start=1))
+    if len(rows) > size:
+        lines.append(f"... แสดง {size} กลุ่มแรกตามชื่อ")
+    return "\n".join(lines)
 
+def _api_error_body(e: messaging.ApiException) -> str:
+    body = getattr(e, "body", "") or ""
+    if isinstance(body, (bytes, bytearray)):
+        body = body.decode("utf-8", errors="ignore")
+    return str(body)
 def reply_messages(reply_token: str, messages: List[Any]) -> None:
-    with ApiClient(config) as api_client:
-        api = MessagingApi(api_client)
-        req = ReplyMessageRequest(reply_token=reply_token, messages=messages)
-        api.reply_message(req)
+    req = messaging.ReplyMessageRequest(reply_token=reply_token, messages=messages)
+    line_call("reply", line_api().reply_message, req)
 def push_messages(to: str, messages: List[Any]) -> None:
-    with ApiClient(config) as api_client:
-        api = MessagingApi(api_client)
-        req = PushMessageRequest(to=to, messages=messages)
-        api.push_message(req)
+    req = messaging.PushMessageRequest(to=to, messages=messages)
+    line_call("push", line_api().push_message, req)
 def safe_send(event: MessageEvent, messages: List[Any]) -> None:
     """reply ก่อน ถ้า reply token ใช้ไม่ได้ค่อย fallback เป็น push"""
     to_id = current_target_id(event)
@@ -197,64 +1146,335 @@ def safe_send(event: MessageEvent, messages: List[Any]) -> None:
             try:
                 push_messages(to_id, messages)
             except Exception as e:
-                app.logger.warning(f"push failed (no reply token) to {to_id}: {e}")
+                log_event(logging.WARNING, "push_failed", to=to_id, reason="no_reply_token", error=e)
         return
     try:
         reply_messages(reply_token, messages)
-    except ApiException as e:
-        body = getattr(e, "body", "") or ""
-        if isinstance(body, (bytes, bytearray)):
-            try:
-                body = body.decode("utf-8", errors="ignore")
-            except Exception:
-                body = str(body)
-        if "Invalid reply token" in str(body):
+    except messaging.ApiException as e:
+        body = _api_error_body(e)
+        if "Invalid reply token" in body:
             if to_id:
                 try:
                     push_messages(to_id, messages)
                     return
                 except Exception as e2:
-                    app.logger.warning(f"push fallback failed to {to_id}: {e2}")
+                    log_event(logging.WARNING, "push_fallback_failed", to=to_id, error=e2)
             return
-        app.logger.warning(f"reply failed: {e} body={body}")
+        log_event(logging.WARNING, "reply_failed", error=e, body=body)
     except Exception as e:
-        app.logger.warning(f"reply failed (unknown): {e}")
-def push_to_all(messages: List[Any], exclude_id: Optional[str] = None) -> None:
-    """ส่งข้อความไปยังทุก Group ID ที่บันทึกไว้ (ใช้ push_message ทีละกลุ่ม)
+        log_event(logging.WARNING, "reply_failed", error=e)
+# Broadcast engine
+# LINE จำกัด push ไว้ที่ 2,000 req/s ต่อ channel ตั้งค่าเริ่มต้นต่ำกว่านั้นเผื่อ margin
+PUSH_WORKERS = int(os.getenv("PUSH_WORKERS", "16"))
+PUSH_RATE_PER_SEC = float(os.getenv("PUSH_RATE_PER_SEC", "1500"))
+PUSH_BURST = int(os.getenv("PUSH_BURST", "100"))
+PUSH_MAX_RETRIES = int(os.getenv("PUSH_MAX_RETRIES", "3"))
+_push_bucket = _TokenBucket(PUSH_RATE_PER_SEC, PUSH_BURST)
+def _retry_delay(e: messaging.ApiException, attempt: int) -> float:
+    """อ่าน Retry-After จาก response ถ้ามี ไม่งั้น backoff แบบ exponential"""
+    headers = getattr(e, "headers", None) or {}
+    try:
+        val = headers.get("Retry-After")
+        if val:
+            return min(max(float(val), 0.0), 60.0)
+    except Exception:
+        pass
+    return min(0.5 * (2 ** (attempt - 1)), 8.0)
+def _push_one(gid: str, messages: List[Any], retry_key: Optional[str] = None) -> Dict[str, Any]:
+    """push ไป 1 กลุ่ม พร้อม retry (ใช้ retry key เดิมทุกครั้ง LINE จะไม่ส่งซ้ำ)"""
+    retry_key = retry_key or str(uuid.uuid4())
+    attempts = 0
+    while True:
+        attempts += 1
+        _push_bucket.acquire()
+        try:
+            req = messaging.PushMessageRequest(to=gid, messages=messages)
+            line_call("push", line_api().push_message, req, x_line_retry_key=retry_key)
+            return {"status": "ok", "attempts": attempts}
+        except messaging.ApiException as e:
+            status = getattr(e, "status", None) or 0
+            body = _api_error_body(e)
+            # 409 = คำขอที่ใช้ retry key นี้ถูกรับไปแล้ว ถือว่าส่งสำเร็จ
+            if status == 409:
+                return {"status": "ok", "attempts": attempts}
+            # 429 เพราะโควต้ารายเดือนหมด retry ไปก็ไม่ผ่าน
+            retryable = (status == 429 and "monthly limit" not in body.lower()) or status >= 500
+            if retryable and attempts <= PUSH_MAX_RETRIES:
+                delay = _retry_delay(e, attempts)
+                if status == 429:
+                    _push_bucket.pause(delay)
+                else:
+                    time.sleep(delay)
+                continue
+            return {"status": "failed", "attempts": attempts, "http_status": status,
+                    "retryable": retryable, "error": body or str(e)}
+        except Exception as e:
+            return {"status": "failed", "attempts": attempts, "http_status": None, "retryable": True, "error": str(e)}
+def broadcast(
+    targets: List[str],
+    messages: List[Any],
+    workers: Optional[int] = None,
+    retry_keys: Optional[Dict[str, str]] = None,
+    on_result: Optional[Any] = None,
+) -> Dict[str, Any]:
+    """push ข้อความเดียวกันไปหลายกลุ่มพร้อมกันด้วย thread pool (คุมอัตราด้วย _push_bucket)
 
-    หมายเหตุ: LINE Multicast รองรับเฉพาะ userId เท่านั้น ถ้าเอา groupId ไปใส่จะได้ 400
+    on_result(gid, result) ถูกเรียกทันทีที่แต่ละกลุ่มเสร็จ (ใช้ทำ checkpoint)
+    คืนค่าสรุป {"ok", "failed", "elapsed", "results": {gid: {...}}}
     """
-    all_targets = list(iter_all_targets(exclude_id=exclude_id))
-    if not all_targets:
-        print("⚠️ ไม่มีกลุ่มเป้าหมายให้ส่ง")
+    retry_keys = retry_keys or {}
+    started = time.monotonic()
+    results: Dict[str, Dict[str, Any]] = {}
+    if targets:
+        n_workers = max(1, min(workers or PUSH_WORKERS, len(targets)))
+        with ThreadPoolExecutor(max_workers=n_workers, thread_name_prefix="push") as pool:
+            futures = {pool.submit(_push_one, gid, messages, retry_keys.get(gid)): gid for gid in targets}
+            for fut in as_completed(futures):
+                gid = futures[fut]
+                res = fut.result()
+                results[gid] = res
+                outcome = "ok" if res["status"] == "ok" else "retry" if res.get("retryable") else "failed"
+                metrics.inc("broadcast_targets_total", outcome=outcome)
+                if on_result is not None:
+                    on_result(gid, res)
+                if res["status"] != "ok":
+                    log_event(logging.WARNING, "push_failed", gid=gid, http_status=res.get("http_status"), error=res.get("error"))
+    ok = sum(1 for r in results.values() if r["status"] == "ok")
+    return {
+        "ok": ok,
+        "failed": len(results) - ok,
+        "elapsed": round(time.monotonic() - started, 3),
+        "results": results,
+    }
+# Broadcast jobs (persisted)
+# ทุก broadcast ถูกบันทึกเป็น job ใน SQLite พร้อมสถานะรายกลุ่ม ถ้า worker ตาย/ถูก recycle
+# process ถัดไปจะส่งต่อเฉพาะกลุ่มที่ยังไม่สำเร็จ (retry key ต่อกลุ่มคงที่ LINE จึงไม่ส่งซ้ำ)
+BROADCAST_JOB_ROUNDS = int(os.getenv("BROADCAST_JOB_ROUNDS", "4"))
+BROADCAST_STALE_SEC = float(os.getenv("BROADCAST_STALE_SEC", "120"))
+# job ที่เริ่มนานเกินนี้ไม่ส่งต่อแล้ว (ข้อความอย่างปิดรับ/ผลหวยหมดความหมาย) ปิดเป็น abandoned แทน
+BROADCAST_MAX_AGE_SEC = float(os.getenv("BROADCAST_MAX_AGE_SEC", "900"))
+# ทุก worker ตรวจ job ค้างเป็นระยะ (worker ที่ตายถูก gunicorn แทนภายในไม่กี่วินาที จะรอแค่ตอนเริ่มไม่ได้)
+BROADCAST_RESUME_SEC = float(os.getenv("BROADCAST_RESUME_SEC", "15"))
+def _job_retry_key(job_id: str, gid: str) -> str:
+    return str(uuid.uuid5(uuid.NAMESPACE_URL, f"lotto-bot:{job_id}:{gid}"))
+def create_broadcast_job(job_id: str, messages: List[Any], targets: List[str], label: str = "") -> bool:
+    """สร้าง job ใหม่ (idempotent ตาม job_id) คืน False ถ้ามี job นี้อยู่แล้ว"""
+    now = time.time()
+    payload = json.dumps([m.to_dict() for m in messages], ensure_ascii=False)
+    conn = _db()
+    with conn:
+        cur = conn.execute(
+            "INSERT OR IGNORE INTO broadcast_jobs (id, label, status, messages, total, owner, heartbeat, created_at)"
+            " VALUES (?, ?, 'running', ?, ?, ?, ?, ?)",
+            (job_id, label, payload, len(targets), _owner_id(), now, now),
+        )
+        if cur.rowcount == 0:
+            return False
+        conn.executemany(
+            "INSERT OR IGNORE INTO broadcast_targets (job_id, gid, status) VALUES (?, ?, 'pending')",
+            [(job_id, gid) for gid in targets],
+        )
+    return True
+def _owner_alive(owner: Optional[str]) -> bool:
+    """เจ้าของ job (host:pid) ยังทำงานอยู่ไหม ตรวจได้เฉพาะ process บนเครื่องเดียวกัน เครื่องอื่นดูจาก heartbeat"""
+    host, _, pid = (owner or "").rpartition(":")
+    if host != socket.gethostname() or not pid.isdigit():
+        return True
+    try:
+        os.kill(int(pid), 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+def _claim_broadcast_job(job_id: str, owner: Optional[str] = None, heartbeat: Optional[float] = None) -> bool:
+    """ยึด job ที่เจ้าของเดิมหยุดไปแล้ว (UPDATE แบบมีเงื่อนไข ได้ผู้ชนะคนเดียว)
+    ไม่ระบุ owner = ยึดเมื่อ heartbeat เงียบเกิน BROADCAST_STALE_SEC ระบุ owner/heartbeat ที่อ่านมา = ยึดเมื่อยังเป็นค่าเดิม"""
+    now = time.time()
+    conn = _db()
+    with conn:
+        if owner is None:
+            cur = conn.execute(
+                "UPDATE broadcast_jobs SET owner = ?, heartbeat = ? WHERE id = ? AND status = 'running' AND heartbeat < ?",
+                (_owner_id(), now, job_id, now - BROADCAST_STALE_SEC),
+            )
+        else:
+            cur = conn.execute(
+                "UPDATE broadcast_jobs SET owner = ?, heartbeat = ? WHERE id = ? AND status = 'running' AND owner = ? AND heartbeat = ?",
+                (_owner_id(), now, job_id, owner, heartbeat),
+            )
+    return cur.rowcount == 1
+def _abandon_broadcast_job(job_id: str, owner: str, heartbeat: float) -> bool:
+    """ปิด job ที่ค้างนานเกิน BROADCAST_MAX_AGE_SEC กลุ่มที่ยังไม่ได้ส่งนับเป็น failed"""
+    conn = _db()
+    with conn:
+        cur = conn.execute(
+            "UPDATE broadcast_jobs SET status = 'abandoned', finished_at = ? WHERE id = ? AND status = 'running' AND owner = ? AND heartbeat = ?",
+            (time.time(), job_id, owner, heartbeat),
+        )
+        if cur.rowcount == 0:
+            return False
+        conn.execute(
+            "UPDATE broadcast_targets SET status = 'failed', last_error = 'abandoned' WHERE job_id = ? AND status IN ('pending', 'retry')",
+            (job_id,),
+        )
+    return True
+def _checkpoint_target(job_id: str, gid: str, res: Dict[str, Any], round_no: int) -> None:
+    if res["status"] == "ok":
+        status, next_at = "ok", 0.0
+    elif res.get("retryable"):
+        status, next_at = "retry", time.time() + min(5.0 * (2 ** (round_no - 1)), 60.0)
+    else:
+        status, next_at = "failed", 0.0
+    conn = _db()
+    with conn:
+        conn.execute(
+            "UPDATE broadcast_targets SET status = ?, attempts = attempts + ?, next_at = ?, last_error = ?"
+            " WHERE job_id = ? AND gid = ?",
+            (status, res.get("attempts", 1), next_at, res.get("error"), job_id, gid),
+        )
+        conn.execute("UPDATE broadcast_jobs SET heartbeat = ? WHERE id = ?", (time.time(), job_id))
+def get_broadcast_job(job_id: str) -> Optional[Dict[str, Any]]:
+    conn = _db()
+    row = conn.execute("SELECT * FROM broadcast_jobs WHERE id = ?", (job_id,)).fetchone()
+    if row is None:
+        return None
+    job = dict(row)
+    job["counts"] = {
+        r["status"]: r["n"]
+        for r in conn.execute(
+            "SELECT status, COUNT(*) AS n FROM broadcast_targets WHERE job_id = ? GROUP BY status", (job_id,)
+        )
+    }
+    return job
+def run_broadcast_job(job_id: str) -> Dict[str, Any]:
+    """ส่งกลุ่มที่ยัง pending/retry ของ job นี้ วนหลายรอบพร้อม backoff แล้วปิด job"""
+    started = time.monotonic()
+    conn = _db()
+    row = conn.execute("SELECT messages FROM broadcast_jobs WHERE id = ?", (job_id,)).fetchone()
+    messages = [messaging.Message.from_dict(m) for m in json.loads(row["messages"])]
+    for round_no in range(1, BROADCAST_JOB_ROUNDS + 1):
+        rows = conn.execute(
+            "SELECT gid, next_at FROM broadcast_targets WHERE job_id = ? AND status IN ('pending', 'retry')",
+            (job_id,),
+        ).fetchall()
+        if not rows:
+            break
+        wait = max(r["next_at"] for r in rows) - time.time()
+        if wait > 0:
+            time.sleep(wait)
+        with conn:
+            conn.execute("UPDATE broadcast_jobs SET heartbeat = ? WHERE id = ?", (time.time(), job_id))
+        targets = [r["gid"] for r in rows]
+        broadcast(
+            targets,
+            messages,
+            retry_keys={gid: _job_retry_key(job_id, gid) for gid in targets},
+            on_result=lambda gid, res, n=round_no: _checkpoint_target(job_id, gid, res, n),
+        )
+    with conn:
+        conn.execute(
+            "UPDATE broadcast_targets SET status = 'failed' WHERE job_id = ? AND status IN ('pending', 'retry')",
+            (job_id,),
+        )
+        conn.execute(
+            "UPDATE broadcast_jobs SET status = 'done', finished_at = ?, heartbeat = ? WHERE id = ?",
+            (time.time(), time.time(), job_id),
+        )
+    job = get_broadcast_job(job_id) or {"counts": {}}
+    results = {
+        r["gid"]: {"status": r["status"], "attempts": r["attempts"], "error": r["last_error"]}
+        for r in conn.execute("SELECT gid, status, attempts, last_error FROM broadcast_targets WHERE job_id = ?", (job_id,))
+    }
+    return {
+        "job_id": job_id,
+        "ok": job["counts"].get("ok", 0),
+        "failed": job["counts"].get("failed", 0),
+        "elapsed": round(time.monotonic() - started, 3),
+        "results": results,
+    }
+def resume_broadcast_jobs() -> None:
+    """ส่งต่อ job ที่เจ้าของหยุดไปแล้ว (process ตาย หรือ heartbeat เงียบเกิน BROADCAST_STALE_SEC)
+    job ที่เริ่มนานเกิน BROADCAST_MAX_AGE_SEC ไม่ส่งต่อ ปิดเป็น abandoned"""
+    try:
+        rows = _db().execute(
+            "SELECT id, owner, heartbeat, created_at FROM broadcast_jobs WHERE status = 'running'"
+        ).fetchall()
+    except Exception as e:
+        log_event(logging.WARNING, "broadcast_resume_failed", error=e)
         return
-
-    print(f"เริ่มส่ง Push ไปยัง {len(all_targets)} กลุ่ม...")
-    ok = 0
-    fail = 0
-
-    # เปิด ApiClient ครั้งเดียว แล้ววนส่งทีละกลุ่ม (เร็วกว่า/เสถียรกว่า)
-    with ApiClient(config) as api_client:
-        api = MessagingApi(api_client)
-        for gid in all_targets:
+    now = time.time()
+    for row in rows:
+        if row["heartbeat"] >= now - BROADCAST_STALE_SEC and _owner_alive(row["owner"]):
+            continue
+        if row["created_at"] < now - BROADCAST_MAX_AGE_SEC:
+            if _abandon_broadcast_job(row["id"], row["owner"], row["heartbeat"]):
+                log_event(logging.WARNING, "broadcast_abandoned", job_id=row["id"], owner=row["owner"])
+            continue
+        if _claim_broadcast_job(row["id"], owner=row["owner"], heartbeat=row["heartbeat"]):
+            log_event(logging.INFO, "broadcast_resumed", job_id=row["id"], owner=row["owner"])
             try:
-                req = PushMessageRequest(to=gid, messages=messages)
-                api.push_message(req)
-                ok += 1
-            except ApiException as e:
-                fail += 1
-                app.logger.warning(f"Push failed to group {gid}: {e}")
-                print(f"❌ ส่งไม่ผ่าน (group): {gid} | {e}")
+                run_broadcast_job(row["id"])
             except Exception as e:
-                fail += 1
-                app.logger.warning(f"Push error to group {gid}: {e}")
-                print(f"❌ ส่งไม่ผ่าน (group): {gid} | {e}")
+                log_event(logging.ERROR, "broadcast_resume_failed", job_id=row["id"], error=e)
+def _resume_loop() -> None:
+    while True:
+        resume_broadcast_jobs()
+        time.sleep(BROADCAST_RESUME_SEC)
+def broadcast_job_key(event: MessageEvent, tag: str) -> str:
+    """idempotency key ของ broadcast จาก webhookEventId (LINE ส่ง event ซ้ำ -> ได้ key เดิม)"""
+    eid = getattr(event, "webhook_event_id", None)
+    return f"{tag}:{eid}" if eid else f"{tag}:{uuid.uuid4().hex}"
+def push_to_all(messages: List[Any], exclude_id: Optional[str] = None, job_key: Optional[str] = None,
+                selector: Optional[List[str]] = None) -> Dict[str, Any]:
+    """ส่งข้อความไปยังทุก Group ID ที่บันทึกไว้ (push_message แบบขนาน บันทึกเป็น broadcast job)
+    ใส่ selector (เช่น ["@vip"]) เพื่อส่งเฉพาะกลุ่มที่มีแท็กนั้น
+
+    หมายเหตุ: LINE Multicast รองรับเฉพาะ userId เท่านั้น ถ้าเอา groupId ไปใส่จะได้ 400
+    """
+    all_targets = list(iter_all_targets(exclude_id=exclude_id, selector=selector))
+    if not all_targets:
+        log_event(logging.WARNING, "broadcast_no_targets")
+        return broadcast([], messages)
 
-    print(f"สรุป: ✅สำเร็จ {ok} กลุ่ม | ❌ล้มเหลว {fail} กลุ่ม")
+    job_id = job_key or uuid.uuid4().hex
+    if not create_broadcast_job(job_id, messages, all_targets, label=job_id.split(":", 1)[0]):
+        # job เดิม (เช่น LINE ส่ง event ซ้ำ) ทำต่อเฉพาะถ้าเจ้าของเดิมหยุดไปแล้ว
+        if not _claim_broadcast_job(job_id):
+            log_event(logging.INFO, "broadcast_duplicate_job", job_id=job_id)
+            return {"job_id": job_id, "ok": 0, "failed": 0, "elapsed": 0.0, "results": {}, "skipped": True}
+    log_event(logging.INFO, "broadcast_started", job_id=job_id, targets=len(all_targets), selector=" ".join(selector or []) or "all")
+    summary = run_broadcast_job(job_id)
+    summary["bytes_saved"] = image_bytes_saved(messages) * summary["ok"]
+    if summary["bytes_saved"]:
+        metrics.inc("broadcast_image_bytes_saved_total", summary["bytes_saved"])
+    metrics.observe("broadcast_seconds", summary["elapsed"])
+    log_event(logging.INFO, "broadcast_finished", job_id=job_id, ok=summary["ok"], failed=summary["failed"],
+              elapsed=summary["elapsed"], bytes_saved=summary["bytes_saved"])
+    return summary
+def build_broadcast_jobs_text(limit: int = 3) -> str:
+    rows = _db().execute(
+        "SELECT id FROM broadcast_jobs ORDER BY (status = 'running') DESC, created_at DESC LIMIT ?", (limit,)
+    ).fetchall()
+    if not rows:
+        return "ยังไม่มีงานส่ง (broadcast)"
+    lines: List[str] = ["📤 งานส่งล่าสุด"]
+    for row in rows:
+        job = get_broadcast_job(row["id"])
+        c = job["counts"]
+        done = c.get("ok", 0) + c.get("failed", 0)
+        state = {"running": "กำลังส่ง", "abandoned": "ยกเลิก ค้างนานเกินไป"}.get(job["status"], "เสร็จแล้ว")
+        started = time.strftime("%d/%m %H:%M:%S", time.localtime(job["created_at"]))
+        lines.append("")
+        lines.append(f"{job['label'] or '-'} ({state}) เริ่ม {started}")
+        lines.append(f" ความคืบหน้า: {done}/{job['total']}")
+        lines.append(f" ✅ {c.get('ok', 0)} | 🔁 รอส่งซ้ำ {c.get('retry', 0)} | ⏳ รอ {c.get('pending', 0)} | ❌ {c.get('failed', 0)}")
+    return "\n".join(lines)
 
 # Fonts
 FONT_REGULAR_PATH = os.path.join(BASE_DIR, "fonts", "Sarabun-Regular.ttf")
 FONT_BOLD_PATH = os.path.join(BASE_DIR, "fonts", "Sarabun-Bold.ttf")
+@lru_cache(maxsize=64)
 def _load_font(size: int, bold: bool = False) -> ImageFont.FreeTypeFont:
     path = FONT_BOLD_PATH if bold else FONT_REGULAR_PATH
     try:
@@ -262,17 +1482,17 @@ def _load_font(size: int, bold: bool = False) -> ImageFont.FreeTypeFont:
     except:
         return ImageFont.load_default()
 # Lotto fetching
-LOTTERY_CO_TH_URL = "https://www.lottery.co.th/"
-SANOOK_ICHECK_URL = "https://news.sanook.com/lotto/icheck/"
+# ชี้ไปที่ mock ในเครื่องได้ (bench.py) ปกติใช้เว็บจริง
+LOTTERY_CO_TH_URL = os.getenv("LOTTERY_CO_TH_URL", "https://www.lottery.co.th/")
+SANOOK_ICHECK_URL = os.getenv("SANOOK_ICHECK_URL", "https://news.sanook.com/lotto/icheck/")
 THAI_MONTHS_ABBR = {
     "ม.ค.": "มกราคม", "ก.พ.": "กุมภาพันธ์", "มี.ค.": "มีนาคม", "เม.ย.": "เมษายน",
     "พ.ค.": "พฤษภาคม", "มิ.ย.": "มิถุนายน", "ก.ค.": "กรกฎาคม", "ส.ค.": "สิงหาคม",
     "ก.ย.": "กันยายน", "ต.ค.": "ตุลาคม", "พ.ย.": "พฤศจิกายน", "ธ.ค.": "ธันวาคม",
 }
-_cache = {"ts": 0.0, "data": None}
 def _normalize_date_th_from_short(short_date: str) -> str:
     s = (short_date or "").strip()
-    m = re.search(r"(\d{1,2})\s+([ก-๙]{1,4}\.)\s+(\d{2})", s)
+    m = re.search(r"(\d{1,2})\s+((?:[ก-๙]{1,4}\.){1,2})\s+(\d{2})", s)
     if not m:
         return s
     day = int(m.group(1))
@@ -281,102 +1501,614 @@ def _normalize_date_th_from_short(short_date: str) -> str:
     mon_full = THAI_MONTHS_ABBR.get(mon_abbr, mon_abbr)
     be_year = 2500 + yy
     return f"{day} {mon_full} {be_year}"
-def fetch_lotto_from_lottery_co_th() -> Optional[Dict[str, Any]]:
-    try:
-        r = requests.get(LOTTERY_CO_TH_URL, timeout=15, headers={"User-Agent": "Mozilla/5.0"})
+LOTTO_FETCH_TIMEOUT = float(os.getenv("LOTTO_FETCH_TIMEOUT", "15"))
+# sequential = ลองทีละเว็บแบบเดิม | race = ยิงพร้อมกัน เอาผลแรกที่ parse ได้
+# quorum = รอทั้งสองเว็บแล้วเทียบตัวเลข ถ้าไม่ตรงกันจะติดธง mismatch ไว้ในผล
+LOTTO_FETCH_MODE = os.getenv("LOTTO_FETCH_MODE", "race").strip().lower()
+LOTTO_HTTP_POOL_SIZE = int(os.getenv("LOTTO_HTTP_POOL_SIZE", "4"))
+class _FetchCancelled(Exception):
+    pass
+_http_local: Dict[str, Any] = {"pid": None, "session": None}
+_http_lock = threading.Lock()
+# validator (ETag / Last-Modified) + ผลที่ parse แล้วของแต่ละ URL ถ้าได้ 304 ใช้ผลเดิมโดยไม่ต้อง parse
+_conditional: Dict[str, Dict[str, Any]] = {}
+def _http_session() -> requests.Session:
+    """requests.Session ตัวเดียวต่อ process (keep-alive กับเว็บผลหวย)"""
+    if _http_local["pid"] != os.getpid():
+        with _http_lock:
+            if _http_local["pid"] != os.getpid():
+                session = requests.Session()
+                adapter = requests.adapters.HTTPAdapter(pool_connections=4, pool_maxsize=LOTTO_HTTP_POOL_SIZE)
+                session.mount("https://", adapter)
+                session.mount("http://", adapter)
+                session.headers["User-Agent"] = "Mozilla/5.0"
+                _http_local["session"] = session
+                _http_local["pid"] = os.getpid()
+    return _http_local["session"]
+def _fetch_parsed(tag: str, url: str, parse: Any, cancel: Optional[threading.Event] = None) -> Optional[Dict[str, Any]]:
+    """GET แบบมีเงื่อนไข (If-None-Match / If-Modified-Since) อ่าน body แบบ stream
+    ถ้า cancel ถูก set จะปิด connection ทันที"""
+    with _http_lock:
+        cached = _conditional.get(url)
+    headers: Dict[str, str] = {}
+    if cached:
+        if cached.get("etag"):
+            headers["If-None-Match"] = cached["etag"]
+        if cached.get("last_modified"):
+            headers["If-Modified-Since"] = cached["last_modified"]
+    with _http_session().get(url, timeout=LOTTO_FETCH_TIMEOUT, headers=headers, stream=True) as r:
+        metrics.inc("lotto_http_total", source=tag, status=r.status_code)
+        if r.status_code == 304 and cached:
+            return dict(cached["data"])
         r.raise_for_status()
-        soup = BeautifulSoup(r.text, "html.parser")
-        txt = soup.get_text("\n", strip=True)
-        pat = re.compile(
-            r"(\d{1,2}\s+[ก-๙]{1,4}\.\s+\d{2}).{0,120}?"
-            r"(\d{6})\s+(\d{2})\s+(\d{3})\s+(\d{3})\s+(\d{3})\s+(\d{3})"
-        )
-        m = pat.search(txt)
-        if not m:
-            return None
-        short_date = m.group(1)
-        first = m.group(2)
-        last2 = m.group(3)
-        last3a, last3b = m.group(4), m.group(5)
-        front3a, front3b = m.group(6), m.group(7)
-        return {
-            "date_th": _normalize_date_th_from_short(short_date),
-            "first": first,
-            "front3": [front3a, front3b],
-            "last3": [last3a, last3b],
-            "last2": last2,
-        }
-    except Exception as e:
-        app.logger.warning(f"lottery.co.th parse failed: {e}")
+        chunks: List[bytes] = []
+        for chunk in r.iter_content(16384):
+            if cancel is not None and cancel.is_set():
+                raise _FetchCancelled(url)
+            chunks.append(chunk)
+        r._content = b"".join(chunks)
+        html = r.text
+        etag, last_modified = r.headers.get("ETag"), r.headers.get("Last-Modified")
+    started = time.monotonic()
+    data = parse(html)
+    metrics.observe("lotto_parse_seconds", time.monotonic() - started, source=tag)
+    if data and (etag or last_modified):
+        with _http_lock:
+            _conditional[url] = {"etag": etag, "last_modified": last_modified, "data": dict(data)}
+    return data
+# ดึงข้อความจาก HTML แบบเร็ว: ตัด tag ด้วย regex แทนการสร้าง DOM ทั้งต้นด้วย BeautifulSoup
+# ได้ลำดับข้อความเดียวกับ soup.get_text("\n", strip=True) (ข้าม script/style/template/comment)
+_HTML_SKIP_RE = re.compile(r"<(script|style|template)\b[^>]*>.*?</\1\s*>|<!--.*?-->", re.S | re.I)
+_HTML_TAG_RE = re.compile(r"<[^>]*>")
+def _html_text(html: str) -> str:
+    parts = (unescape(p).strip() for p in _HTML_TAG_RE.split(_HTML_SKIP_RE.sub("<>", html)))
+    return "\n".join(p for p in parts if p)
+def _html_text_bs4(html: str) -> str:
+    return bs4.BeautifulSoup(html, "html.parser").get_text("\n", strip=True)
+_LOTTERY_CO_TH_RE = re.compile(
+    r"(\d{1,2}\s+(?:[ก-๙]{1,4}\.){1,2}\s+\d{2}).{0,120}?"
+    r"(\d{6})\s+(\d{2})\s+(\d{3})\s+(\d{3})\s+(\d{3})\s+(\d{3})"
+)
+_SANOOK_ICHECK_RE = re.compile(
+    r"(\d{1,2}\s+\S+\s+\d{4}).{0,1200}?"
+    r"รางวัลที่ 1\s+(\d{6}).{0,800}?"
+    r"เลขหน้า 3 ตัว\s+(\d{3})\s+(\d{3}).{0,800}?"
+    r"เลขท้าย 3 ตัว\s+(\d{3})\s+(\d{3}).{0,800}?"
+    r"เลขท้าย 2 ตัว\s+(\d{2})",
+    re.S
+)
+def _parse_lottery_co_th_text(txt: str) -> Optional[Dict[str, Any]]:
+    m = _LOTTERY_CO_TH_RE.search(txt)
+    if not m:
         return None
-def fetch_lotto_from_sanook_icheck() -> Optional[Dict[str, Any]]:
+    short_date = m.group(1)
+    first = m.group(2)
+    last2 = m.group(3)
+    last3a, last3b = m.group(4), m.group(5)
+    front3a, front3b = m.group(6), m.group(7)
+    return {
+        "date_th": _normalize_date_th_from_short(short_date),
+        "first": first,
+        "front3": [front3a, front3b],
+        "last3": [last3a, last3b],
+        "last2": last2,
+    }
+def _parse_sanook_icheck_text(txt: str) -> Optional[Dict[str, Any]]:
+    # ค้นเฉพาะช่วงรอบ "รางวัลที่ 1" ก่อน (regex มีช่องว่างกว้าง ถ้าไล่ทั้งหน้าจะช้ามาก)
+    anchor = txt.find("รางวัลที่ 1")
+    m = None
+    if anchor >= 0:
+        m = _SANOOK_ICHECK_RE.search(txt[max(0, anchor - 1300):anchor + 3400])
+    if m is None:
+        m = _SANOOK_ICHECK_RE.search(txt)
+    if not m:
+        return None
+    return {
+        "date_th": m.group(1),
+        "first": m.group(2),
+        "front3": [m.group(3), m.group(4)],
+        "last3": [m.group(5), m.group(6)],
+        "last2": m.group(7),
+    }
+def _parse_lottery_co_th(html: str) -> Optional[Dict[str, Any]]:
+    # ทางเร็วก่อน ถ้า HTML แปลกจน regex หาไม่เจอค่อยใช้ BeautifulSoup
+    return _parse_lottery_co_th_text(_html_text(html)) or _parse_lottery_co_th_text(_html_text_bs4(html))
+def _parse_sanook_icheck(html: str) -> Optional[Dict[str, Any]]:
+    return _parse_sanook_icheck_text(_html_text(html)) or _parse_sanook_icheck_text(_html_text_bs4(html))
+# None = เปิดหน้าได้แต่หาเลขไม่เจอ ส่วน error ของ HTTP/parse โยนต่อให้ _run_source แยกประเภทลงสุขภาพของแหล่ง
+def fetch_lotto_from_lottery_co_th(cancel: Optional[threading.Event] = None) -> Optional[Dict[str, Any]]:
+    return _fetch_parsed("lottery.co.th", LOTTERY_CO_TH_URL, _parse_lottery_co_th, cancel)
+def fetch_lotto_from_sanook_icheck(cancel: Optional[threading.Event] = None) -> Optional[Dict[str, Any]]:
+    return _fetch_parsed("sanook", SANOOK_ICHECK_URL, _parse_sanook_icheck, cancel)
+# ลำดับ = ลำดับความน่าเชื่อถือ (ใช้ตัดสินใน quorum) ส่วนลำดับที่ลองจริงเรียงตามความเร็ว ดู _ordered_sources
+LOTTO_SOURCES: List[Tuple[str, Any]] = [
+    ("lottery.co.th", fetch_lotto_from_lottery_co_th),
+    ("sanook", fetch_lotto_from_sanook_icheck),
+]
+# Source health / circuit breaker
+# สุขภาพของแต่ละเว็บเก็บใน state (ใช้ร่วมทุก worker): เวลาเฉลี่ยตอนสำเร็จ (EWMA) ผล SOURCE_HEALTH_WINDOW ครั้งล่าสุด
+# และจำนวนครั้งที่ล้มติดกัน ล้มติดกัน LOTTO_BREAKER_FAILURES ครั้ง -> ตัดวงจร ข้ามเว็บนั้น LOTTO_BREAKER_COOLDOWN_SEC
+# ครบเวลาแล้วให้ลอง 1 ครั้ง (half-open) ถ้าล้มอีกพักนานขึ้นเท่าตัว (ไม่เกิน LOTTO_BREAKER_MAX_COOLDOWN_SEC)
+LOTTO_BREAKER_FAILURES = int(os.getenv("LOTTO_BREAKER_FAILURES", "3"))
+LOTTO_BREAKER_COOLDOWN_SEC = float(os.getenv("LOTTO_BREAKER_COOLDOWN_SEC", "120"))
+LOTTO_BREAKER_MAX_COOLDOWN_SEC = float(os.getenv("LOTTO_BREAKER_MAX_COOLDOWN_SEC", "1800"))
+SOURCE_HEALTH_WINDOW = 20
+def _parse_source_health(raw: Optional[str]) -> Dict[str, Any]:
+    health = json.loads(raw) if raw else {}
+    for key, default in (("ewma_sec", None), ("recent", []), ("failures", 0), ("open_until", 0.0), ("cooldown", 0.0),
+                         ("last_error", None), ("last_ok_at", 0.0), ("last_fail_at", 0.0)):
+        health.setdefault(key, default)
+    return health
+def source_health(tag: str) -> Dict[str, Any]:
+    return _parse_source_health(_state_get(f"source_health:{tag}"))
+def source_state(health: Dict[str, Any], now: Optional[float] = None) -> str:
+    """closed = ใช้ได้ปกติ | open = ตัดวงจรอยู่ | half-open = พักครบแล้ว รอลองใหม่ 1 ครั้ง"""
+    if not health["open_until"]:
+        return "closed"
+    return "open" if (time.time() if now is None else now) < health["open_until"] else "half-open"
+def record_source_result(tag: str, outcome: str, elapsed: float, error: Any = None) -> Dict[str, Any]:
+    """บันทึกผลการดึง 1 ครั้ง (outcome = ok / timeout / network / http / parse) คืนสุขภาพหลังอัปเดต
+    อ่าน-แก้-เขียนใน transaction เดียว (_state_update) ผลจากหลาย worker พร้อมกันจึงไม่ทับกัน"""
+    now = time.time()
+    opened: List[Dict[str, Any]] = []
+    def update(raw: Optional[str]) -> str:
+        health = _parse_source_health(raw)
+        health["recent"] = (health["recent"] + [outcome])[-SOURCE_HEALTH_WINDOW:]
+        if outcome == "ok":
+            prev = health["ewma_sec"]
+            health["ewma_sec"] = round(elapsed if prev is None else 0.3 * elapsed + 0.7 * prev, 4)
+            health.update(failures=0, open_until=0.0, cooldown=0.0, last_ok_at=now)
+        else:
+            half_open = source_state(health, now) == "half-open"
+            health["failures"] += 1
+            health.update(last_error=f"{outcome}: {error}"[:200] if error else outcome, last_fail_at=now)
+            if half_open or health["failures"] >= LOTTO_BREAKER_FAILURES:
+                cooldown = health["cooldown"] * 2 if half_open else LOTTO_BREAKER_COOLDOWN_SEC
+                health["cooldown"] = min(max(cooldown, LOTTO_BREAKER_COOLDOWN_SEC), LOTTO_BREAKER_MAX_COOLDOWN_SEC)
+                health["open_until"] = now + health["cooldown"]
+                opened.append(health)
+        return json.dumps(health)
+    health = json.loads(_state_update(f"source_health:{tag}", update))
+    if opened:
+        metrics.inc("lotto_breaker_open_total", source=tag)
+        log_event(logging.WARNING, "lotto_source_breaker_open", source=tag, failures=health["failures"],
+                  cooldown=health["cooldown"], error=health["last_error"])
+    metrics.set("lotto_source_open", 1 if health["open_until"] else 0, source=tag)
+    return health
+def reset_source_health(tag: Optional[str] = None) -> None:
+    """ปิด breaker และล้างสถิติ (ทุกแหล่งถ้าไม่ระบุ)"""
+    for t, _ in LOTTO_SOURCES:
+        if tag is None or t == tag:
+            _state_set(f"source_health:{t}", json.dumps({}))
+            metrics.set("lotto_source_open", 0, source=t)
+def _ordered_sources(record: bool = False) -> Tuple[List[Tuple[str, Any]], List[str]]:
+    """(แหล่งที่จะลอง เรียงเร็วไปช้า, แหล่งที่ถูกตัดวงจร) ถ้าตัดหมดทุกแหล่งจะลองทั้งหมดตามลำดับเดิม
+    record=True (ตอนดึงจริง) นับแหล่งที่ถูกข้ามลง metrics และแหล่ง half-open ต้องได้ lease ลองใหม่ก่อน
+    (ทั้งระบบลองได้ครั้งละ 1 worker ที่เหลือถือว่ายังตัดวงจรอยู่)"""
+    now = time.time()
+    usable: List[Tuple[Tuple[int, float, int], Tuple[str, Any]]] = []
+    skipped: List[str] = []
+    for i, (tag, fn) in enumerate(LOTTO_SOURCES):
+        health = source_health(tag)
+        state = source_state(health, now)
+        if state == "open" or (record and state == "half-open"
+                               and not _acquire_lease(f"source_trial:{tag}", LOTTO_FETCH_TIMEOUT * 2)):
+            skipped.append(tag)
+            continue
+        # ยังไม่เคยวัดเวลา = ให้ลองก่อน (ได้ตัวอย่าง) แหล่งที่เพิ่งล้มไปไว้ท้าย
+        usable.append(((1 if health["failures"] else 0, health["ewma_sec"] or 0.0, i), (tag, fn)))
+    if not usable:
+        if record:
+            log_event(logging.WARNING, "lotto_all_sources_open", sources=",".join(skipped))
+        return list(LOTTO_SOURCES), []
+    for tag in skipped if record else ():
+        metrics.inc("lotto_source_total", source=tag, result="skipped")
+    return [src for _, src in sorted(usable, key=lambda row: row[0])], skipped
+def _run_source(tag: str, fn: Any, cancel: Optional[threading.Event] = None) -> Optional[Dict[str, Any]]:
+    started = time.monotonic()
+    data, kind, error, cancelled = None, "parse", None, False
     try:
-        r = requests.get(SANOOK_ICHECK_URL, timeout=15, headers={"User-Agent": "Mozilla/5.0"})
-        r.raise_for_status()
-        txt = BeautifulSoup(r.text, "html.parser").get_text("\n", strip=True)
-        pattern = re.compile(
-            r"(\d{1,2}\s+\S+\s+\d{4}).{0,1200}?"
-            r"รางวัลที่ 1\s+(\d{6}).{0,800}?"
-            r"เลขหน้า 3 ตัว\s+(\d{3})\s+(\d{3}).{0,800}?"
-            r"เลขท้าย 3 ตัว\s+(\d{3})\s+(\d{3}).{0,800}?"
-            r"เลขท้าย 2 ตัว\s+(\d{2})",
-            re.S
-        )
-        m = pattern.search(txt)
-        if not m:
-            return None
-        return {
-            "date_th": m.group(1),
-            "first": m.group(2),
-            "front3": [m.group(3), m.group(4)],
-            "last3": [m.group(5), m.group(6)],
-            "last2": m.group(7),
-        }
+        data = fn(cancel=cancel)
+    except _FetchCancelled:
+        cancelled = True
+    except requests.Timeout as e:
+        kind, error = "timeout", e
+    except requests.HTTPError as e:
+        kind, error = "http", e
+    except requests.RequestException as e:
+        kind, error = "network", e
     except Exception as e:
-        app.logger.warning(f"sanook icheck parse failed: {e}")
-        return None
-def fetch_latest_lotto(force: bool = False) -> Optional[Dict[str, Any]]:
-    now_ts = time.time()
-    if (not force) and _cache["data"] and (now_ts - _cache["ts"] < 300):
-        return _cache["data"]
-    for fn, tag in [
-        (fetch_lotto_from_lottery_co_th, "lottery.co.th"),
-        (fetch_lotto_from_sanook_icheck, "sanook"),
-    ]:
-        data = fn()
+        kind, error = "parse", e
+    elapsed = time.monotonic() - started
+    # cancelled เฉพาะที่ถูกตัดกลางทางจริง (_FetchCancelled) ถ้า timeout/HTTP error จบหลังอีกแหล่งชนะไปแล้ว
+    # ก็ยังต้องลงสุขภาพ ไม่งั้นแหล่งที่ค้างในโหมด race จะไม่เคยถูกตัดวงจร
+    if data:
+        result = "ok"
+    elif cancelled:
+        result = "cancelled"
+    else:
+        result = "failed"
+    metrics.inc("lotto_source_total", source=tag, result=result)
+    if result != "cancelled":
+        metrics.observe("lotto_source_seconds", elapsed, source=tag)
+        record_source_result(tag, "ok" if data else kind, elapsed, error)
+    if result == "failed":
+        metrics.inc("lotto_source_errors_total", source=tag, kind=kind)
+        log_event(logging.WARNING, "lotto_source_failed", source=tag, kind=kind, error=error or "no result in page")
+    return data
+def _lotto_numbers(data: Dict[str, Any]) -> Dict[str, Any]:
+    return {
+        "first": str(data.get("first") or ""),
+        "front3": sorted(str(x) for x in (data.get("front3") or [])),
+        "last3": sorted(str(x) for x in (data.get("last3") or [])),
+        "last2": str(data.get("last2") or ""),
+    }
+def _fetch_sequential() -> Optional[Dict[str, Any]]:
+    sources, _ = _ordered_sources(record=True)
+    for tag, fn in sources:
+        data = _run_source(tag, fn)
         if data:
-            app.logger.info(f"lotto picked {tag}: {data.get('date_th')}")
-            _cache["ts"] = now_ts
-            _cache["data"] = data
-            return data
-    _cache["ts"] = now_ts
-    _cache["data"] = None
+            return dict(data, source=tag)
     return None
+def _fetch_race(quorum: bool = False) -> Optional[Dict[str, Any]]:
+    """ยิงทุกแหล่งพร้อมกัน race: คืนผลแรกที่ parse ได้แล้วยกเลิกที่เหลือ / quorum: รอครบแล้วเทียบกัน"""
+    cancel = threading.Event()
+    sources, _ = _ordered_sources(record=True)
+    pool = ThreadPoolExecutor(max_workers=len(sources), thread_name_prefix="lotto")
+    futures = {pool.submit(_run_source, tag, fn, cancel): tag for tag, fn in sources}
+    results: Dict[str, Dict[str, Any]] = {}
+    try:
+        for fut in as_completed(futures, timeout=LOTTO_FETCH_TIMEOUT * 2):
+            data = fut.result()
+            if data:
+                results[futures[fut]] = data
+                if not quorum:
+                    break
+    except FuturesTimeout:
+        log_event(logging.WARNING, "lotto_fetch_timeout")
+    finally:
+        cancel.set()
+        pool.shutdown(wait=False)
+    if not results:
+        return None
+    tag = next(t for t, _ in LOTTO_SOURCES if t in results)
+    data = dict(results[tag], source=tag)
+    if quorum:
+        data["sources"] = sorted(results)
+        ref = _lotto_numbers(results[tag])
+        mismatch = sorted({
+            field
+            for other in results.values()
+            for field, val in _lotto_numbers(other).items()
+            if val != ref[field]
+        })
+        if mismatch:
+            data["mismatch"] = mismatch
+            metrics.inc("lotto_quorum_mismatch_total")
+            log_event(logging.WARNING, "lotto_sources_disagree", keys=",".join(mismatch), results=results)
+    return data
+# Lotto result cache
+# ผลที่ดึงได้เก็บใน SQLite ต่องวด (ใช้ร่วมกันทุก worker) ผลเก่าเสิร์ฟได้ทันทีระหว่างที่มี
+# refresh เบื้องหลังแค่ตัวเดียว (lease ข้าม worker + lock ใน process) ดึงล้มเหลวไม่ลบผลเดิม
+LOTTO_CACHE_TTL_SEC = float(os.getenv("LOTTO_CACHE_TTL_SEC", "300"))
+LOTTO_RETRY_SEC = float(os.getenv("LOTTO_RETRY_SEC", "30"))
+_THAI_MONTH_NUM = {name: i + 1 for i, pair in enumerate(THAI_MONTHS_ABBR.items()) for name in pair}
+_lotto_refresh_lock = threading.Lock()
+def _draw_key(date_th: str) -> str:
+    """"16 มีนาคม 2568" -> "2568-03-16" (เรียงตามงวดได้) ถ้าอ่านไม่ออกคืนข้อความเดิม"""
+    s = (date_th or "").strip()
+    m = re.search(r"(\d{1,2})\s+(\S+)\s+(\d{2}|\d{4})(?!\d)", s)
+    if not m or m.group(2) not in _THAI_MONTH_NUM:
+        return s
+    year = int(m.group(3))
+    if year < 100:
+        year += 2500
+    return f"{year:04d}-{_THAI_MONTH_NUM[m.group(2)]:02d}-{int(m.group(1)):02d}"
+def _store_lotto_result(data: Dict[str, Any], fetched_at: Optional[float] = None) -> None:
+    now = time.time() if fetched_at is None else fetched_at
+    draw_key = _draw_key(str(data.get("date_th", "")))
+    conn = _db()
+    with conn:
+        conn.execute(
+            "INSERT INTO lotto_results (draw_key, data, source, fetched_at) VALUES (?, ?, ?, ?)"
+            " ON CONFLICT(draw_key) DO UPDATE SET data = excluded.data, source = excluded.source,"
+            " fetched_at = excluded.fetched_at",
+            (draw_key, json.dumps(data, ensure_ascii=False), data.get("source"), now),
+        )
+        _index_lotto_result(conn, draw_key, data)
+    if fetched_at is None:
+        _meta_set("lotto_checked_at", now)
+def _latest_lotto_result() -> Optional[Dict[str, Any]]:
+    row = _db().execute("SELECT data FROM lotto_results ORDER BY draw_key DESC LIMIT 1").fetchone()
+    return json.loads(row["data"]) if row else None
+def _refresh_lotto(mode: Optional[str] = None, requested_at: Optional[float] = None) -> Optional[Dict[str, Any]]:
+    """ดึงจากเว็บจริง 1 ครั้งแล้วเก็บลง cache คืนผลล่าสุดที่ดีที่สุดเสมอ (แม้ดึงรอบนี้ไม่สำเร็จ)"""
+    requested_at = requested_at or time.time()
+    lease_ttl = LOTTO_FETCH_TIMEOUT * 2 + 5
+    with _lotto_refresh_lock:
+        # thread อื่นเพิ่ง refresh สำเร็จระหว่างที่รอ lock ใช้ผลนั้นเลย
+        if _meta_get("lotto_checked_at") >= requested_at:
+            metrics.inc("lotto_cache_total", result="coalesced")
+            return _latest_lotto_result()
+        if not _acquire_lease("lotto_refresh", lease_ttl):
+            # worker อื่นกำลังดึงอยู่ รอผลของมันแทนการยิงซ้ำ
+            deadline = time.time() + lease_ttl
+            while time.time() < deadline:
+                time.sleep(0.25)
+                if _meta_get("lotto_checked_at") >= requested_at:
+                    metrics.inc("lotto_cache_total", result="coalesced")
+                    return _latest_lotto_result()
+                if _acquire_lease("lotto_refresh", lease_ttl):
+                    break
+            else:
+                return _latest_lotto_result()
+        try:
+            _meta_set("lotto_attempt_at", time.time())
+            metrics.inc("lotto_cache_total", result="refresh")
+            mode = (mode or LOTTO_FETCH_MODE)
+            if mode == "sequential":
+                data = _fetch_sequential()
+            else:
+                data = _fetch_race(quorum=(mode == "quorum"))
+            if data:
+                log_event(logging.INFO, "lotto_picked", source=data.get("source"), date_th=data.get("date_th"))
+                _store_lotto_result(data)
+            else:
+                metrics.inc("lotto_cache_total", result="refresh_failed")
+        finally:
+            _release_lease("lotto_refresh")
+        return _latest_lotto_result()
+def _refresh_lotto_background() -> None:
+    if _lotto_refresh_lock.locked():
+        return
+    # ล้มเหลวรอบก่อน -> เว้นช่วง LOTTO_RETRY_SEC ก่อนลองใหม่ (ไม่ยิงทุก request)
+    if time.time() - _meta_get("lotto_attempt_at") < LOTTO_RETRY_SEC:
+        return
+    threading.Thread(target=_refresh_lotto, name="lotto-refresh", daemon=True).start()
+def fetch_latest_lotto(force: bool = False, mode: Optional[str] = None) -> Optional[Dict[str, Any]]:
+    """ผลหวยงวดล่าสุดจาก cache ถ้าเก่ากว่า TTL จะคืนผลเดิมทันทีแล้ว refresh เบื้องหลัง
+
+    force=True: รอดึงใหม่ (รวมกับ refresh ที่กำลังวิ่งอยู่ถ้ามี) ถ้าไม่สำเร็จคืนผลล่าสุดที่เคยได้
+    """
+    now_ts = time.time()
+    data = _latest_lotto_result()
+    if force or data is None:
+        return _refresh_lotto(mode, requested_at=now_ts)
+    if now_ts - _meta_get("lotto_checked_at") >= LOTTO_CACHE_TTL_SEC:
+        metrics.inc("lotto_cache_total", result="stale")
+        _refresh_lotto_background()
+    else:
+        metrics.inc("lotto_cache_total", result="hit")
+    return data
+# Draw archive + ticket index
+# lotto_results เก็บทุกงวดที่เคยดึงได้ (คลังผลย้อนหลัง) lotto_index เก็บเลขที่ถูกรางวัลแยกตามประเภท
+# ตรวจสลากกี่ใบก็ได้ใน SQL query เดียว (join กับ index) ไม่ต้องไปดึงเว็บ
+LOTTO_INDEX_VERSION = 1
+LOTTO_CHECK_MAX_TICKETS = int(os.getenv("LOTTO_CHECK_MAX_TICKETS", "50"))
+LOTTO_PRIZES: Dict[str, Tuple[str, int]] = {
+    "first": ("รางวัลที่ 1", 6000000),
+    "front3": ("เลขหน้า 3 ตัว", 4000),
+    "last3": ("เลขท้าย 3 ตัว", 4000),
+    "last2": ("เลขท้าย 2 ตัว", 2000),
+}
+_lotto_index_ready_pid: Optional[int] = None
+def _lotto_index_rows(data: Dict[str, Any]) -> List[Tuple[str, str]]:
+    rows: List[Tuple[str, str]] = []
+    first = re.sub(r"\D", "", str(data.get("first") or ""))
+    if len(first) == 6:
+        rows.append(("first", first))
+    for kind in ("front3", "last3"):
+        for n in data.get(kind) or []:
+            n = re.sub(r"\D", "", str(n or ""))
+            if n:
+                rows.append((kind, n.zfill(3)))
+    last2 = re.sub(r"\D", "", str(data.get("last2") or ""))
+    if last2:
+        rows.append(("last2", last2.zfill(2)))
+    return rows
+def _index_lotto_result(conn: sqlite3.Connection, draw_key: Optional[str], data: Dict[str, Any]) -> None:
+    """แทนที่ index ของงวดนี้ (ผลบางส่วน -> ผลครบ ก็เขียนทับได้) ต้องเรียกใน transaction เดียวกับ lotto_results"""
+    if not draw_key:
+        return
+    conn.execute("DELETE FROM lotto_index WHERE draw_key = ?", (draw_key,))
+    conn.executemany(
+        "INSERT OR IGNORE INTO lotto_index (kind, number, draw_key) VALUES (?, ?, ?)",
+        [(kind, n, draw_key) for kind, n in _lotto_index_rows(data)],
+    )
+def rebuild_lotto_index() -> int:
+    """สร้าง index ใหม่จาก lotto_results ทั้งหมด คืนจำนวนงวด"""
+    conn = _db()
+    rows = conn.execute("SELECT draw_key, data FROM lotto_results").fetchall()
+    with conn:
+        conn.execute("DELETE FROM lotto_index")
+        for row in rows:
+            _index_lotto_result(conn, row["draw_key"], json.loads(row["data"]))
+    _meta_set("lotto_index_version", LOTTO_INDEX_VERSION)
+    return len(rows)
+def _ensure_lotto_index() -> None:
+    """งวดที่เก็บไว้ก่อนมี index (หรือ index เวอร์ชันเก่า) สร้างให้ครั้งเดียว"""
+    global _lotto_index_ready_pid
+    if _lotto_index_ready_pid == os.getpid():
+        return
+    if _meta_get("lotto_index_version") < LOTTO_INDEX_VERSION:
+        rebuild_lotto_index()
+    _lotto_index_ready_pid = os.getpid()
+def import_lotto_results(records: Iterable[Dict[str, Any]]) -> int:
+    """นำผลย้อนหลัง (รูปแบบเดียวกับ fetch_latest_lotto) เข้าคลัง ไม่ทับงวดที่มีอยู่แล้ว คืนจำนวนที่เพิ่ม"""
+    _ensure_lotto_index()
+    known = {r[0] for r in _db().execute("SELECT draw_key FROM lotto_results")}
+    added = 0
+    for data in records:
+        key = _draw_key(str(data.get("date_th", "")))
+        if not key or key in known:
+            continue
+        _store_lotto_result(data, fetched_at=0.0)
+        known.add(key)
+        added += 1
+    return added
+def lotto_draw_keys() -> List[str]:
+    return [r[0] for r in _db().execute("SELECT draw_key FROM lotto_results ORDER BY draw_key DESC")]
+def check_tickets(tickets: List[str], draw_key: Optional[str] = None) -> Dict[str, List[Tuple[str, str]]]:
+    """ตรวจสลาก 6 หลักหลายใบในครั้งเดียว คืน {ticket: [(draw_key, kind), ...]}
+
+    draw_key=None = ทุกงวดในคลัง
+    """
+    _ensure_lotto_index()
+    started = time.monotonic()
+    tickets = list(dict.fromkeys(tickets))
+    probe: List[Tuple[str, str, str]] = []
+    for t in tickets:
+        probe += [(t, "first", t), (t, "front3", t[:3]), (t, "last3", t[-3:]), (t, "last2", t[-2:])]
+    sql = (
+        "WITH probe(ticket, kind, number) AS ("
+        " SELECT json_extract(value, '$[0]'), json_extract(value, '$[1]'), json_extract(value, '$[2]')"
+        " FROM json_each(?))"
+        " SELECT p.ticket, p.kind, i.draw_key FROM probe p"
+        " JOIN lotto_index i ON i.kind = p.kind AND i.number = p.number"
+    )
+    params: List[Any] = [json.dumps(probe)]
+    if draw_key:
+        sql += " WHERE i.draw_key = ?"
+        params.append(draw_key)
+    hits: Dict[str, List[Tuple[str, str]]] = {t: [] for t in tickets}
+    for row in _db().execute(sql + " ORDER BY i.draw_key DESC", params):
+        hits[row[0]].append((row[2], row[1]))
+    metrics.observe("lotto_check_seconds", time.monotonic() - started)
+    return hits
+def _parse_draw_arg(arg: str) -> Optional[str]:
+    """งวดจากข้อความ: 2568-07-16, 16/7/68, 16/07/2568, 16 ก.ค. 68"""
+    arg = arg.strip()
+    if re.fullmatch(r"\d{4}-\d{2}-\d{2}", arg):
+        return arg
+    m = re.fullmatch(r"(\d{1,2})/(\d{1,2})/(\d{2}|\d{4})", arg)
+    if m:
+        year = int(m.group(3))
+        year = year + 2500 if year < 100 else year + 543 if year < 2400 else year
+        return f"{year:04d}-{int(m.group(2)):02d}-{int(m.group(1)):02d}"
+    return _draw_key(arg)
+def _draw_label(draw_key: str) -> str:
+    y, m, d = draw_key.split("-")
+    return f"{int(d)}/{int(m)}/{y}"
+def build_ticket_check_text(args: List[str]) -> str:
+    # เลขซ้ำในคำสั่งเดียวกันตรวจครั้งเดียว (ไม่แสดงซ้ำ/นับใบเกิน)
+    tickets = list(dict.fromkeys(a for a in args if re.fullmatch(r"\d{6}", a)))
+    rest = [a for a in args if a not in tickets]
+    if not tickets:
+        return "ใช้คำสั่ง:\n/ตรวจหวย 245174 123456  (งวดล่าสุด)\n/ตรวจหวย 245174 16/7/68\n/ตรวจหวย 245174 ทั้งหมด"
+    if len(tickets) > LOTTO_CHECK_MAX_TICKETS:
+        return f"⚠️ ตรวจได้ครั้งละไม่เกิน {LOTTO_CHECK_MAX_TICKETS} ใบครับ"
+    keys = lotto_draw_keys()
+    if not keys:
+        return "ยังไม่มีผลหวยในคลังครับ"
+    if rest and rest[0] == "ทั้งหมด":
+        draw_key, scope = None, f"ทุกงวดในคลัง ({len(keys)} งวด)"
+    else:
+        draw_key = _parse_draw_arg(" ".join(rest)) if rest else keys[0]
+        if draw_key not in keys:
+            return f"ไม่พบงวด {' '.join(rest)} ในคลังครับ"
+        scope = f"งวด {_draw_label(draw_key)}"
+    hits = check_tickets(tickets, draw_key)
+    lines = [f"🎫 ตรวจสลาก {len(tickets)} ใบ - {scope}"]
+    for t in tickets:
+        if not hits[t]:
+            lines.append(f"{t}: ไม่ถูกรางวัล")
+            continue
+        for dk, kind in hits[t]:
+            label, amount = LOTTO_PRIZES[kind]
+            lines.append(f"{t}: ✅ {label} {amount:,} บาท" + ("" if draw_key else f" (งวด {_draw_label(dk)})"))
+    return "\n".join(lines)
 # Lotto image rendering
-def render_lotto_image_clean(data: Dict[str, Any]) -> bytes:
-    W, H = 1200, 720
-    img = Image.new("RGB", (W, H), (255, 255, 255))
-    draw = ImageDraw.Draw(img)
-    top_color = (245, 247, 250)
-    bottom_color = (255, 210, 230)
+# เรนเดอร์เป็น 2 ชั้น: ชั้นนิ่ง (gradient, การ์ด, แถบ, หัวข้อ, ป้าย) สร้างครั้งเดียวต่อขนาด+ธีม
+# แล้วเก็บไว้ใน memory แต่ละครั้งแค่ copy ชั้นนิ่งแล้ววาดวันที่กับตัวเลขทับ
+LOTTO_THEMES: Dict[str, Dict[str, Tuple[int, int, int]]] = {
+    "default": {
+        "top": (245, 247, 250),
+        "bottom": (255, 210, 230),
+        "accent": (233, 30, 99),
+        "accent_soft": (255, 105, 180),
+        "text": (30, 30, 30),
+        "card": (255, 255, 255),
+        "border": (240, 180, 210),
+        "on_accent": (255, 255, 255),
+    },
+    "gold": {
+        "top": (255, 251, 240),
+        "bottom": (250, 225, 170),
+        "accent": (176, 124, 20),
+        "accent_soft": (222, 170, 60),
+        "text": (45, 32, 10),
+        "card": (255, 255, 255),
+        "border": (230, 200, 140),
+        "on_accent": (255, 255, 255),
+    },
+    "navy": {
+        "top": (240, 245, 252),
+        "bottom": (190, 210, 240),
+        "accent": (22, 52, 120),
+        "accent_soft": (60, 110, 200),
+        "text": (20, 28, 45),
+        "card": (255, 255, 255),
+        "border": (170, 190, 225),
+        "on_accent": (255, 255, 255),
+    },
+}
+_render_base_cache: Dict[Tuple[int, int, str], Image.Image] = {}
+_render_base_lock = threading.Lock()
+def _lotto_layout(W: int, H: int) -> Dict[str, Tuple[int, int, int, int]]:
+    margin = 70
+    return {
+        "main": (margin, 210, int(W * 0.68), 520),
+        "last2": (int(W * 0.72), 210, W - margin, 520),
+        "front3": (margin, 540, int(W * 0.5) - 10, 690),
+        "last3": (int(W * 0.5) + 10, 540, W - margin, 690),
+    }
+def _vertical_gradient(W: int, H: int, top: Tuple[int, int, int], bottom: Tuple[int, int, int]) -> Image.Image:
+    """gradient แนวตั้งแบบสร้างทีเดียว: คำนวณสีคอลัมน์เดียวแล้วยืดเต็มความกว้าง"""
+    col = bytearray()
     for y in range(H):
         t = y / max(H - 1, 1)
-        r = int(top_color[0] * (1 - t) + bottom_color[0] * t)
-        g = int(top_color[1] * (1 - t) + bottom_color[1] * t)
-        b = int(top_color[2] * (1 - t) + bottom_color[2] * t)
-        draw.line([(0, y), (W, y)], fill=(r, g, b))
-    COLOR_PINK = (233, 30, 99)
-    COLOR_PINK_SOFT = (255, 105, 180)
-    COLOR_TEXT = (30, 30, 30)
-    COLOR_CARD = (255, 255, 255)
-    COLOR_BORDER = (240, 180, 210)
-    font_title = _load_font(52, bold=True)
+        col += bytes(int(top[i] * (1 - t) + bottom[i] * t) for i in range(3))
+    return Image.frombytes("RGB", (1, H), bytes(col)).resize((W, H), Image.NEAREST)
+def _render_base(W: int, H: int, theme: str) -> Image.Image:
+    key = (W, H, theme)
+    base = _render_base_cache.get(key)
+    if base is not None:
+        return base
+    with _render_base_lock:
+        base = _render_base_cache.get(key)
+        if base is not None:
+            return base
+        c = LOTTO_THEMES.get(theme) or LOTTO_THEMES["default"]
+        img = _vertical_gradient(W, H, c["top"], c["bottom"])
+        draw = ImageDraw.Draw(img)
+        draw.text((W / 2, 80), "ผลสลากกินแบ่งรัฐบาล", font=_load_font(52, bold=True), fill=c["accent"], anchor="mm")
+        boxes = _lotto_layout(W, H)
+        for name, radius in (("main", 35), ("last2", 35), ("front3", 28), ("last3", 28)):
+            draw.rounded_rectangle(boxes[name], radius=radius, fill=c["card"], outline=c["border"], width=2)
+        font_label_big = _load_font(32, bold=True)
+        font_label = _load_font(28, bold=True)
+        band_h = 80
+        for name, label, font in (("main", "รางวัลที่ 1", font_label_big), ("last2", "เลขท้าย 2 ตัว", font_label)):
+            x0, y0, x1, y1 = boxes[name]
+            draw.rounded_rectangle((x0, y0, x1, y0 + band_h), radius=35, fill=c["accent_soft"], outline=None)
+            draw.rectangle((x0, y0 + band_h - 20, x1, y0 + band_h), fill=c["accent_soft"])
+            draw.text(((x0 + x1) / 2, y0 + band_h / 2 + 2), label, font=font, fill=c["on_accent"], anchor="mm")
+        band_h2 = 60
+        for name, label in (("front3", "เลขหน้า 3 ตัว"), ("last3", "เลขท้าย 3 ตัว")):
+            x0, y0, x1, y1 = boxes[name]
+            draw.rounded_rectangle((x0, y0, x1, y0 + band_h2), radius=28, fill=c["accent"], outline=None)
+            draw.rectangle((x0, y0 + band_h2 - 18, x1, y0 + band_h2), fill=c["accent"])
+            draw.text(((x0 + x1) / 2, y0 + band_h2 / 2 + 1), label, font=font_label, fill=c["on_accent"], anchor="mm")
+        _render_base_cache[key] = img
+        return img
+def render_lotto_image(data: Dict[str, Any], theme: str = "default", size: Tuple[int, int] = (1200, 720)) -> Image.Image:
+    W, H = size
+    c = LOTTO_THEMES.get(theme) or LOTTO_THEMES["default"]
+    img = _render_base(W, H, theme).copy()
+    draw = ImageDraw.Draw(img)
     font_date = _load_font(30, bold=True)
-    font_label_big = _load_font(32, bold=True)
     font_num_big = _load_font(120, bold=True)
-    font_label = _load_font(28, bold=True)
     font_num = _load_font(56, bold=True)
-    draw.text((W / 2, 80), "ผลสลากกินแบ่งรัฐบาล", font=font_title, fill=COLOR_PINK, anchor="mm")
     date_th = str(data.get("date_th", "")).strip()
     date_text = f"งวดประจำวันที่  {date_th}" if date_th else "งวดประจำวันที่ -"
     pad_x, pad_y = 40, 12
@@ -386,82 +2118,645 @@ def render_lotto_image_clean(data: Dict[str, Any]) -> bytes:
     box_w, box_h = w_date + pad_x * 2, h_date + pad_y * 2
     box_x0, box_y0 = (W - box_w) / 2, 130
     box_x1, box_y1 = box_x0 + box_w, box_y0 + box_h
-    draw.rounded_rectangle((box_x0, box_y0, box_x1, box_y1), radius=25, fill=COLOR_PINK, outline=None)
-    draw.text(((box_x0 + box_x1) / 2, (box_y0 + box_y1) / 2), date_text, font=font_date, fill=(255, 255, 255), anchor="mm")
-    margin = 70
-    main_card = (margin, 210, int(W * 0.68), 520)
-    last2_card = (int(W * 0.72), 210, W - margin, 520)
-    front3_card = (margin, 540, int(W * 0.5) - 10, 690)
-    last3_card = (int(W * 0.5) + 10, 540, W - margin, 690)
-    def card(box, radius=35):
-        draw.rounded_rectangle(box, radius=radius, fill=COLOR_CARD, outline=COLOR_BORDER, width=2)
-    card(main_card)
-    card(last2_card)
-    card(front3_card, radius=28)
-    card(last3_card, radius=28)
-    x0, y0, x1, y1 = main_card
-    band_h = 80
-    draw.rounded_rectangle((x0, y0, x1, y0 + band_h), radius=35, fill=COLOR_PINK_SOFT, outline=None)
-    draw.rectangle((x0, y0 + band_h - 20, x1, y0 + band_h), fill=COLOR_PINK_SOFT)
-    draw.text(((x0 + x1) / 2, y0 + band_h / 2 + 2), "รางวัลที่ 1", font=font_label_big, fill=(255, 255, 255), anchor="mm")
+    draw.rounded_rectangle((box_x0, box_y0, box_x1, box_y1), radius=25, fill=c["accent"], outline=None)
+    draw.text(((box_x0 + box_x1) / 2, (box_y0 + box_y1) / 2), date_text, font=font_date, fill=c["on_accent"], anchor="mm")
+    boxes = _lotto_layout(W, H)
+    x0, y0, x1, y1 = boxes["main"]
     first = str(data.get("first", "")).strip() or "-"
-    draw.text(((x0 + x1) / 2, (y0 + y1) / 2 + 30), first, font=font_num_big, fill=COLOR_TEXT, anchor="mm")
-    x0, y0, x1, y1 = last2_card
-    draw.rounded_rectangle((x0, y0, x1, y0 + band_h), radius=35, fill=COLOR_PINK_SOFT, outline=None)
-    draw.rectangle((x0, y0 + band_h - 20, x1, y0 + band_h), fill=COLOR_PINK_SOFT)
-    draw.text(((x0 + x1) / 2, y0 + band_h / 2 + 2), "เลขท้าย 2 ตัว", font=font_label, fill=(255, 255, 255), anchor="mm")
+    draw.text(((x0 + x1) / 2, (y0 + y1) / 2 + 30), first, font=font_num_big, fill=c["text"], anchor="mm")
+    x0, y0, x1, y1 = boxes["last2"]
     last2 = str(data.get("last2", "")).zfill(2) if data.get("last2") is not None else "-"
-    draw.text(((x0 + x1) / 2, (y0 + y1) / 2 + 24), last2, font=font_num_big, fill=COLOR_TEXT, anchor="mm")
-    x0, y0, x1, y1 = front3_card
-    band_h2 = 60
-    draw.rounded_rectangle((x0, y0, x1, y0 + band_h2), radius=28, fill=COLOR_PINK, outline=None)
-    draw.rectangle((x0, y0 + band_h2 - 18, x1, y0 + band_h2), fill=COLOR_PINK)
-    draw.text(((x0 + x1) / 2, y0 + band_h2 / 2 + 1), "เลขหน้า 3 ตัว", font=font_label, fill=(255, 255, 255), anchor="mm")
+    draw.text(((x0 + x1) / 2, (y0 + y1) / 2 + 24), last2, font=font_num_big, fill=c["text"], anchor="mm")
+    x0, y0, x1, y1 = boxes["front3"]
     f = data.get("front3") or []
     f1 = str(f[0]).zfill(3) if len(f) > 0 and f[0] else "---"
     f2 = str(f[1]).zfill(3) if len(f) > 1 and f[1] else "---"
-    draw.text(((x0 + x1) / 2, (y0 + y1) / 2 + 26), f"{f1}   {f2}", font=font_num, fill=COLOR_TEXT, anchor="mm")
-    x0, y0, x1, y1 = last3_card
-    draw.rounded_rectangle((x0, y0, x1, y0 + band_h2), radius=28, fill=COLOR_PINK, outline=None)
-    draw.rectangle((x0, y0 + band_h2 - 18, x1, y0 + band_h2), fill=COLOR_PINK)
-    draw.text(((x0 + x1) / 2, y0 + band_h2 / 2 + 1), "เลขท้าย 3 ตัว", font=font_label, fill=(255, 255, 255), anchor="mm")
+    draw.text(((x0 + x1) / 2, (y0 + y1) / 2 + 26), f"{f1}   {f2}", font=font_num, fill=c["text"], anchor="mm")
+    x0, y0, x1, y1 = boxes["last3"]
     l = data.get("last3") or []
     l1 = str(l[0]).zfill(3) if len(l) > 0 and l[0] else "---"
     l2 = str(l[1]).zfill(3) if len(l) > 1 and l[1] else "---"
-    draw.text(((x0 + x1) / 2, (y0 + y1) / 2 + 26), f"{l1}   {l2}", font=font_num, fill=COLOR_TEXT, anchor="mm")
+    draw.text(((x0 + x1) / 2, (y0 + y1) / 2 + 26), f"{l1}   {l2}", font=font_num, fill=c["text"], anchor="mm")
+    return img
+def render_lotto_image_clean(data: Dict[str, Any], theme: str = "default") -> bytes:
+    started = time.monotonic()
+    img = render_lotto_image(data, theme=theme)
     buf = BytesIO()
     img.save(buf, format="PNG")
+    metrics.observe("lotto_render_seconds", time.monotonic() - started, theme=theme)
+    return buf.getvalue()
+# Content-addressed lotto images
+# ชื่อไฟล์ = hash ของข้อมูลที่ใช้เรนเดอร์ ผลเดิม -> ไฟล์เดิม ไม่ต้องเรนเดอร์/ดาวน์โหลดซ้ำ
+# เก็บใน memory (LRU) และบน disk ใต้ static/lotto ให้ worker อื่นใช้ร่วมได้
+# แต่ละผลมี 2 variant: original (PNG ลดสีเป็น palette หรือ JPEG) และ preview (JPEG ย่อสำหรับหน้าแชท)
+LOTTO_RENDER_VERSION = "2"
+LOTTO_IMAGE_DIR = os.path.join(STATIC_DIR, "lotto")
+LOTTO_IMAGE_CACHE_SIZE = int(os.getenv("LOTTO_IMAGE_CACHE_SIZE", "32"))
+LOTTO_IMAGE_FORMAT = os.getenv("LOTTO_IMAGE_FORMAT", "png").strip().lower()  # png | jpeg
+LOTTO_PNG_COLORS = int(os.getenv("LOTTO_PNG_COLORS", "256"))
+LOTTO_JPEG_QUALITY = int(os.getenv("LOTTO_JPEG_QUALITY", "85"))
+LOTTO_PREVIEW_WIDTH = int(os.getenv("LOTTO_PREVIEW_WIDTH", "480"))
+LOTTO_PREVIEW_QUALITY = int(os.getenv("LOTTO_PREVIEW_QUALITY", "70"))
+LOTTO_IMAGE_VARIANTS = ("original", "preview")
+_image_cache: "OrderedDict[str, bytes]" = OrderedDict()
+_image_lock = threading.Lock()
+_IMAGE_NAME_RE = re.compile(r"^[0-9a-f]{16}\.(png|jpg)$")
+_IMAGE_MIMETYPES = {"png": "image/png", "jpg": "image/jpeg"}
+def _variant_params(variant: str) -> Dict[str, Any]:
+    if variant == "preview":
+        return {"ext": "jpg", "width": LOTTO_PREVIEW_WIDTH, "quality": LOTTO_PREVIEW_QUALITY}
+    if LOTTO_IMAGE_FORMAT in ("jpg", "jpeg"):
+        return {"ext": "jpg", "quality": LOTTO_JPEG_QUALITY}
+    return {"ext": "png", "colors": LOTTO_PNG_COLORS}
+def lotto_image_hash(data: Dict[str, Any], theme: str = "default", variant: str = "original") -> str:
+    fields = {k: data.get(k) for k in ("date_th", "first", "front3", "last3", "last2")}
+    raw = json.dumps([LOTTO_RENDER_VERSION, theme, variant, _variant_params(variant), fields], ensure_ascii=False, sort_keys=True)
+    return hashlib.sha256(raw.encode("utf-8")).hexdigest()[:16]
+def lotto_image_name(data: Dict[str, Any], theme: str = "default", variant: str = "original") -> str:
+    return f"{lotto_image_hash(data, theme, variant)}.{_variant_params(variant)['ext']}"
+def encode_lotto_variant(img: Image.Image, variant: str) -> bytes:
+    """เข้ารหัสรูปที่เรนเดอร์แล้วตาม variant"""
+    params = _variant_params(variant)
+    img = img.convert("RGB")
+    if params.get("width") and img.width > params["width"]:
+        w = params["width"]
+        img = img.resize((w, round(img.height * w / img.width)), Image.LANCZOS)
+    buf = BytesIO()
+    if params["ext"] == "jpg":
+        img.save(buf, format="JPEG", quality=params["quality"], optimize=True, progressive=True)
+    else:
+        # รูปผลหวยเป็นสีเรียบ + gradient อ่อน ๆ ลดเหลือ palette แล้วเล็กลงราวครึ่งหนึ่งโดยแทบไม่ต่าง
+        img.quantize(colors=params["colors"], method=Image.Quantize.MEDIANCUT).save(buf, format="PNG", optimize=True)
     return buf.getvalue()
-def save_lotto_image_to_static(data: Dict[str, Any]) -> str:
-    """สร้างรูปผลหวยและเซฟลง static คืนค่า filepath"""
-    png = render_lotto_image_clean(data)
-    file_path = os.path.join(STATIC_DIR, LOTTO_IMAGE_FILENAME)
-    with open(file_path, "wb") as f:
-        f.write(png)
-    return file_path
+def _image_put(name: str, payload: bytes) -> None:
+    with _image_lock:
+        _image_cache[name] = payload
+        _image_cache.move_to_end(name)
+        while len(_image_cache) > LOTTO_IMAGE_CACHE_SIZE:
+            _image_cache.popitem(last=False)
+def load_lotto_image(name: str) -> Optional[bytes]:
+    """รูปตามชื่อไฟล์ (hash.ext) จาก memory ก่อน แล้วค่อย disk"""
+    with _image_lock:
+        payload = _image_cache.get(name)
+        if payload is not None:
+            _image_cache.move_to_end(name)
+            return payload
+    path = os.path.join(LOTTO_IMAGE_DIR, name)
+    if not os.path.exists(path):
+        return None
+    with open(path, "rb") as f:
+        payload = f.read()
+    _image_put(name, payload)
+    return payload
+def _write_atomic(path: str, payload: bytes) -> None:
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+    with open(tmp, "wb") as f:
+        f.write(payload)
+    os.replace(tmp, path)
+def get_lotto_images(data: Dict[str, Any], theme: str = "default") -> Dict[str, Tuple[str, bytes]]:
+    """คืน {variant: (name, bytes)} เรนเดอร์ครั้งเดียวเฉพาะเมื่อยังขาด variant ใดอยู่"""
+    out: Dict[str, Tuple[str, bytes]] = {}
+    missing: List[Tuple[str, str]] = []
+    for variant in LOTTO_IMAGE_VARIANTS:
+        name = lotto_image_name(data, theme, variant)
+        payload = load_lotto_image(name)
+        if payload is None:
+            missing.append((variant, name))
+        else:
+            out[variant] = (name, payload)
+    if not missing:
+        metrics.inc("lotto_image_total", result="reused")
+        return out
+    started = time.monotonic()
+    img = render_lotto_image(data, theme=theme)
+    for variant, name in missing:
+        payload = encode_lotto_variant(img, variant)
+        try:
+            _write_atomic(os.path.join(LOTTO_IMAGE_DIR, name), payload)
+        except Exception as e:
+            log_event(logging.WARNING, "lotto_image_save_failed", name=name, error=e)
+        _image_put(name, payload)
+        out[variant] = (name, payload)
+    metrics.observe("lotto_render_seconds", time.monotonic() - started, theme=theme)
+    metrics.inc("lotto_image_total", result="rendered")
+    # ขนาดของแต่ละ variant (ได้จาก payload ที่ encode แล้ว ไม่ต้อง encode เพิ่ม) ไว้คำนวณ bytes ที่ประหยัดได้ตอน broadcast
+    sizes = {v: len(p) for v, (_, p) in out.items()}
+    _state_set(f"lotto_image_sizes:{out['original'][0]}", json.dumps({**sizes, "preview_name": out["preview"][0]}))
+    return out
+def get_lotto_image(data: Dict[str, Any], theme: str = "default") -> Tuple[str, bytes]:
+    """คืน (name, bytes) ของ variant original"""
+    return get_lotto_images(data, theme)["original"]
+def ensure_lotto_image(data: Dict[str, Any]) -> Dict[str, str]:
+    """เรนเดอร์ไว้ล่วงหน้า (scheduler) คืน {variant: name}"""
+    return {v: name for v, (name, _) in get_lotto_images(data).items()}
+def lotto_image_url(name: str, variant: str = "original") -> str:
+    return f"{BASE_URL}/lotto/{variant}/{name}"
+def lotto_image_message(names: Dict[str, str]) -> messaging.ImageMessage:
+    return messaging.ImageMessage(
+        original_content_url=lotto_image_url(names["original"], "original"),
+        preview_image_url=lotto_image_url(names["preview"], "preview"),
+    )
+def image_message_for_url(url: str) -> messaging.ImageMessage:
+    """ImageMessage จากลิงก์ ถ้าเป็นรูปผลหวยของเราเองใช้ preview ขนาดเล็กที่มีอยู่แล้ว"""
+    prefix = lotto_image_url("", "original")
+    if BASE_URL and url.startswith(prefix):
+        raw = _state_get(f"lotto_image_sizes:{url[len(prefix):]}")
+        if raw:
+            preview = json.loads(raw).get("preview_name")
+            return messaging.ImageMessage(original_content_url=url, preview_image_url=lotto_image_url(preview, "preview"))
+    return messaging.ImageMessage(original_content_url=url, preview_image_url=url)
+def image_bytes_saved(messages: List[Any]) -> int:
+    """bytes ที่ประหยัดได้ต่อ 1 ปลายทาง เทียบกับการใช้รูป original เป็น preview ด้วย
+    (ใช้ขนาดที่บันทึกไว้ตอนเรนเดอร์ ไม่เรนเดอร์/encode ใหม่เพื่อ metric นี้)"""
+    saved = 0
+    prefix = lotto_image_url("", "original")
+    for m in messages:
+        url = getattr(m, "original_content_url", None) or ""
+        if not (BASE_URL and url.startswith(prefix)):
+            continue
+        raw = _state_get(f"lotto_image_sizes:{url[len(prefix):]}")
+        if not raw:
+            continue
+        sizes = json.loads(raw)
+        if m.preview_image_url != url:
+            saved += sizes["original"] - sizes["preview"]
+    return max(saved, 0)
+# Batch rendering
+# เรนเดอร์หลายงวด x หลายธีมพร้อมกันด้วย process pool (Pillow กิน CPU, thread ไม่ช่วย)
+# โครงไฟล์: <out>/<draw_key>/<theme>/<variant>-<hash>.<ext> ชื่อมี hash ของข้อมูล ข้อมูลต่างกันไม่ทับกัน
+def _render_batch_one(job: Dict[str, Any]) -> Dict[str, Any]:
+    data, theme, out_dir = job["data"], job["theme"], job["dir"]
+    files = {v: os.path.join(out_dir, f"{v}-{lotto_image_name(data, theme, v)}") for v in LOTTO_IMAGE_VARIANTS}
+    started = time.monotonic()
+    rendered = False
+    if job.get("force") or not all(os.path.exists(f) for f in files.values()):
+        img = render_lotto_image(data, theme=theme)
+        for variant, path in files.items():
+            _write_atomic(path, encode_lotto_variant(img, variant))
+        rendered = True
+    return {"draw_key": job["draw_key"], "theme": theme, "files": files, "rendered": rendered,
+            "seconds": round(time.monotonic() - started, 3)}
+def render_lotto_batch(records: Iterable[Dict[str, Any]], themes: Iterable[str], out_dir: str,
+                       workers: Optional[int] = None, force: bool = False) -> List[Dict[str, Any]]:
+    """เรนเดอร์ทุก record x ทุกธีมลง out_dir คืนรายการไฟล์ (ไฟล์ที่มีอยู่แล้วข้าม เว้นแต่ force)"""
+    from concurrent.futures import ProcessPoolExecutor
+    jobs: List[Dict[str, Any]] = []
+    seen = set()
+    for data in records:
+        draw_key = _draw_key(str(data.get("date_th") or "")) or "unknown"
+        for theme in themes:
+            if theme not in LOTTO_THEMES:
+                raise ValueError(f"unknown theme: {theme}")
+            key = (theme, lotto_image_hash(data, theme))
+            if key in seen:
+                continue
+            seen.add(key)
+            jobs.append({"data": data, "theme": theme, "draw_key": draw_key,
+                         "dir": os.path.join(out_dir, draw_key, theme), "force": force})
+    if not jobs:
+        return []
+    workers = max(1, min(workers or os.cpu_count() or 1, len(jobs)))
+    if workers == 1:
+        return [_render_batch_one(j) for j in jobs]
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        return list(pool.map(_render_batch_one, jobs, chunksize=max(1, len(jobs) // (workers * 4))))
+# Draw-day scheduler
+# หวยออกวันที่ 1 และ 16 (มีวันเลื่อนตามวันหยุด) วันออกผลจะเริ่มถามเว็บตั้งแต่ LOTTO_POLL_START
+# ถี่ขึ้นช่วงประกาศผล พอได้เลขครบของงวดวันนั้นจะเรนเดอร์รูปเก็บไว้ /ผลหวย จึงตอบจาก cache ได้ทันที
+TH_TZ = timezone(timedelta(hours=7))
+LOTTO_SCHEDULER = os.getenv("LOTTO_SCHEDULER", "1").strip() != "0"
+LOTTO_POLL_START = os.getenv("LOTTO_POLL_START", "14:00")
+LOTTO_POLL_PEAK = os.getenv("LOTTO_POLL_PEAK", "14:30")
+LOTTO_POLL_END = os.getenv("LOTTO_POLL_END", "18:00")
+LOTTO_POLL_FAST_SEC = float(os.getenv("LOTTO_POLL_FAST_SEC", "30"))
+LOTTO_POLL_SLOW_SEC = float(os.getenv("LOTTO_POLL_SLOW_SEC", "120"))
+# วันเลื่อนประจำ (เดือน, วัน) -> (เดือน, วัน, ปีที่ขยับ): 1 ม.ค. ออก 30 ธ.ค. ปีก่อน, 16 ม.ค. วันครู, 1 พ.ค. วันแรงงาน
+DRAW_DAY_RULES: Dict[Tuple[int, int], Tuple[int, int, int]] = {
+    (1, 1): (12, 30, -1),
+    (1, 16): (1, 17, 0),
+    (5, 1): (5, 2, 0),
+}
+def _parse_draw_overrides(raw: str) -> Dict[date, Optional[date]]:
+    """"2026-05-01=2026-05-02,2026-06-01=" -> เลื่อนงวด / ค่าว่าง = งดออกงวดนั้น"""
+    out: Dict[date, Optional[date]] = {}
+    for item in (raw or "").split(","):
+        if "=" not in item:
+            continue
+        src, _, dst = item.strip().partition("=")
+        try:
+            out[date.fromisoformat(src.strip())] = date.fromisoformat(dst.strip()) if dst.strip() else None
+        except ValueError:
+            log_event(logging.WARNING, "bad_draw_override", entry=item)
+    return out
+LOTTO_DRAW_OVERRIDES = _parse_draw_overrides(os.getenv("LOTTO_DRAW_OVERRIDES", ""))
+def _hhmm(day: date, hhmm: str) -> datetime:
+    h, _, m = hhmm.partition(":")
+    return datetime(day.year, day.month, day.day, int(h), int(m or 0), tzinfo=TH_TZ)
+def draw_dates(year: int) -> List[date]:
+    """วันออกผลจริงของงวดประจำปี year (หลังใช้กฎวันหยุดและ override แล้ว)"""
+    out: List[date] = []
+    for month in range(1, 13):
+        for day in (1, 16):
+            nominal = date(year, month, day)
+            if nominal in LOTTO_DRAW_OVERRIDES:
+                actual = LOTTO_DRAW_OVERRIDES[nominal]
+            elif (month, day) in DRAW_DAY_RULES:
+                m, d, dy = DRAW_DAY_RULES[(month, day)]
+                actual = date(year + dy, m, d)
+            else:
+                actual = nominal
+            if actual is not None:
+                out.append(actual)
+    return out
+def next_draw_date(today: date) -> date:
+    """งวดถัดไปที่ออกวันนี้หรือหลังจากนี้"""
+    return min(d for y in (today.year, today.year + 1) for d in draw_dates(y) if d >= today)
+def latest_draw_date(today: date) -> date:
+    """งวดล่าสุดที่ออกวันนี้หรือก่อนหน้า"""
+    return max(d for y in (today.year - 1, today.year) for d in draw_dates(y) if d <= today)
+def _be_draw_key(day: date) -> str:
+    return f"{day.year + 543:04d}-{day.month:02d}-{day.day:02d}"
+def lotto_result_complete(data: Optional[Dict[str, Any]], day: date) -> bool:
+    """ผลเป็นของงวด day และเลขครบทุกช่อง"""
+    if not data or _draw_key(str(data.get("date_th", ""))) != _be_draw_key(day):
+        return False
+    nums = _lotto_numbers(data)
+    return (
+        re.fullmatch(r"\d{6}", nums["first"]) is not None
+        and re.fullmatch(r"\d{2}", nums["last2"]) is not None
+        and len(nums["front3"]) == 2 and all(re.fullmatch(r"\d{3}", x) for x in nums["front3"])
+        and len(nums["last3"]) == 2 and all(re.fullmatch(r"\d{3}", x) for x in nums["last3"])
+    )
+def lotto_result_is_current(now: Optional[float] = None) -> bool:
+    today = datetime.fromtimestamp(now or time.time(), TH_TZ).date()
+    return lotto_result_complete(_latest_lotto_result(), latest_draw_date(today))
+class DrawScheduler:
+    """clock/sleep/fetch/on_complete เปลี่ยนได้ ใช้นาฬิกาและแหล่งข้อมูลปลอมทดสอบแบบ offline ได้"""
+    LEASE = "draw_scheduler"
+    MAX_SLEEP = 3600.0
+    def __init__(self, clock: Any = time.time, sleep: Any = time.sleep, fetch: Any = None,
+                 on_complete: Any = None, cached: Any = None, use_lease: bool = True):
+        self.clock = clock
+        self.sleep = sleep
+        self.fetch = fetch or (lambda: fetch_latest_lotto(force=True))
+        self.cached = cached or _latest_lotto_result
+        self.on_complete = on_complete or ensure_lotto_image
+        self.use_lease = use_lease
+        self.done: set = set()
+        self.polls = 0
+    def _until(self, now: datetime, target: datetime) -> float:
+        return min(max((target - now).total_seconds(), 1.0), self.MAX_SLEEP)
+    def tick(self) -> float:
+        """ทำงาน 1 รอบ คืนจำนวนวินาทีที่ควรรอก่อนรอบถัดไป"""
+        now = datetime.fromtimestamp(self.clock(), TH_TZ)
+        today = now.date()
+        draw = next_draw_date(today)
+        if draw == today and draw not in self.done:
+            start, peak, end = (_hhmm(today, LOTTO_POLL_START), _hhmm(today, LOTTO_POLL_PEAK),
+                                _hhmm(today, LOTTO_POLL_END))
+            if now < start:
+                return self._until(now, start)
+            if now <= end and lotto_result_complete(self.cached(), today):
+                # worker อื่นได้ผลครบไปแล้ว (cache ร่วม) แค่เช็กว่ามีรูปแล้ว
+                self.on_complete(self.cached())
+                self.done.add(today)
+            elif now <= end:
+                # ถามเว็บแค่ worker เดียว (worker อื่นได้ผลจาก cache ร่วม)
+                if self.use_lease and not _acquire_lease(self.LEASE, LOTTO_POLL_SLOW_SEC * 2):
+                    return LOTTO_POLL_SLOW_SEC
+                self.polls += 1
+                metrics.inc("draw_scheduler_polls_total")
+                data = self.fetch()
+                if lotto_result_complete(data, today):
+                    self.on_complete(data)
+                    self.done.add(today)
+                    log_event(logging.INFO, "draw_complete", date=today)
+                else:
+                    return LOTTO_POLL_FAST_SEC if now >= peak else LOTTO_POLL_SLOW_SEC
+        if draw == today:
+            draw = next_draw_date(today + timedelta(days=1))
+        return self._until(now, _hhmm(draw, LOTTO_POLL_START))
+    def run(self) -> None:
+        while True:
+            try:
+                wait = self.tick()
+            except Exception as e:
+                log_event(logging.ERROR, "draw_scheduler_error", exc_info=True, error=e)
+                wait = LOTTO_POLL_SLOW_SEC
+            self.sleep(wait)
+# Webhook job queue
+# ตอบ LINE 200 ทันทีหลังตรวจ signature แล้วค่อยประมวลผล event ใน worker thread
+# (ถ้า webhook ช้า LINE จะส่งซ้ำ ทำให้โหลดเบิ้ลตอนที่หนักที่สุดพอดี)
+WEBHOOK_ASYNC = os.getenv("WEBHOOK_ASYNC", "1").strip() != "0"
+WEBHOOK_WORKERS = int(os.getenv("WEBHOOK_WORKERS", "4"))
+# จำนวนงานที่รันพร้อมกันได้ต่อคำสั่ง (คำสั่งที่ไม่อยู่ในนี้ไม่จำกัด นอกจากจำนวน worker)
+COMMAND_LIMITS: Dict[str, int] = {
+    "/ปิดรับ": 1,
+    "/แจ้งโอน": 1,
+    "/ส่งผลหวย": 1,
+    "/ผลหวย": 1,
+}
+_job_queue: "queue.Queue[Tuple[str, Any, float]]" = queue.Queue()
+_job_lock = threading.Lock()
+_job_running: Dict[str, int] = {}
+_job_pending: Dict[str, deque] = {}
+_job_workers_pid: Optional[int] = None
+def _command_key(event: Any) -> str:
+    """จัดกลุ่ม event ตามคำสั่ง (token แรก) ไว้ใช้คุม concurrency และเก็บสถิติ
+    คำที่ขึ้นต้น / แต่ไม่ใช่คำสั่งที่ลงทะเบียนไว้รวมเป็น "other" (ใช้เป็น label ของ metrics จำนวนจึงต้องจำกัด)"""
+    msg = getattr(event, "message", None)
+    text = (getattr(msg, "text", None) or "").strip() if msg is not None else ""
+    if text.startswith("/"):
+        name = text.split()[0]
+        return name if name in COMMANDS or name in COMMAND_LIMITS else "other"
+    return "chat" if msg is not None else str(getattr(event, "type", "event"))
+def _dispatch_event(event: Any) -> None:
+    if isinstance(event, MessageEvent) and isinstance(event.message, TextMessageContent):
+        on_text(event)
+def _update_queue_gauges() -> None:
+    metrics.set("webhook_queue_depth", _job_queue.qsize())
+    metrics.set("webhook_jobs_deferred", sum(len(d) for d in _job_pending.values()))
+def _job_worker() -> None:
+    while True:
+        cmd, event, enqueued_at = _job_queue.get()
+        limit = COMMAND_LIMITS.get(cmd)
+        with _job_lock:
+            if limit is not None and _job_running.get(cmd, 0) >= limit:
+                # คำสั่งนี้รันเต็มโควต้าแล้ว พักไว้ก่อน ไม่ให้ถือ worker ค้าง
+                _job_pending.setdefault(cmd, deque()).append((cmd, event, enqueued_at))
+                _update_queue_gauges()
+                continue
+            _job_running[cmd] = _job_running.get(cmd, 0) + 1
+            _update_queue_gauges()
+        started = time.monotonic()
+        metrics.observe("webhook_job_wait_seconds", started - enqueued_at, command=cmd)
+        try:
+            _dispatch_event(event)
+            metrics.inc("webhook_jobs_total", command=cmd, status="ok")
+        except Exception as e:
+            metrics.inc("webhook_jobs_total", command=cmd, status="error")
+            log_event(logging.ERROR, "job_failed", exc_info=True, command=cmd, error=e)
+        finally:
+            metrics.observe("webhook_job_seconds", time.monotonic() - started, command=cmd)
+            with _job_lock:
+                _job_running[cmd] -= 1
+                pending = _job_pending.get(cmd)
+                if pending:
+                    _job_queue.put(pending.popleft())
+                _update_queue_gauges()
+def _ensure_job_workers() -> None:
+    """เปิด worker แบบ lazy ต่อ process (หลัง gunicorn fork แล้วเท่านั้น)"""
+    global _job_workers_pid
+    if _job_workers_pid == os.getpid():
+        return
+    with _job_lock:
+        if _job_workers_pid == os.getpid():
+            return
+        for i in range(max(1, WEBHOOK_WORKERS)):
+            threading.Thread(target=_job_worker, name=f"webhook-job-{i}", daemon=True).start()
+        _job_workers_pid = os.getpid()
+# Event dedup
+# LINE ส่ง event เดิมซ้ำได้ (retry ก่อนครั้งแรกเสร็จ / worker แย่งกัน) คำสั่ง broadcast ซ้ำ = push ทุกกลุ่มอีกรอบ
+# จำ webhookEventId ไว้: ทุก event ผ่าน LRU ใน process (ไม่มี I/O) คำสั่ง (/...) จอง id ใน SQLite ด้วย
+# เพื่อกันซ้ำข้าม gunicorn worker  ลบทิ้งเมื่อเกิน TTL และจำกัดจำนวนแถว
+EVENT_DEDUP_TTL_SEC = float(os.getenv("EVENT_DEDUP_TTL_SEC", str(24 * 3600)))
+EVENT_DEDUP_MAX = int(os.getenv("EVENT_DEDUP_MAX", "50000"))
+EVENT_DEDUP_LOCAL_MAX = int(os.getenv("EVENT_DEDUP_LOCAL_MAX", "10000"))
+EVENT_DEDUP_PRUNE_SEC = 60.0
+_seen_local: "OrderedDict[str, float]" = OrderedDict()
+_seen_lock = threading.Lock()
+_seen_pruned_at = 0.0
+def _prune_seen_events(now: float) -> None:
+    global _seen_pruned_at
+    _seen_pruned_at = now
+    conn = _db()
+    with conn:
+        conn.execute("DELETE FROM seen_events WHERE seen_at < ?", (now - EVENT_DEDUP_TTL_SEC,))
+        conn.execute(
+            "DELETE FROM seen_events WHERE event_id IN"
+            " (SELECT event_id FROM seen_events ORDER BY seen_at DESC LIMIT -1 OFFSET ?)",
+            (EVENT_DEDUP_MAX,),
+        )
+def claim_event(event: Any) -> bool:
+    """True = event ใหม่ ทำงานต่อได้ / False = ซ้ำ ทิ้งได้เลย (นับไว้ใน webhook_events_duplicate_total)"""
+    eid = getattr(event, "webhook_event_id", None)
+    if not eid:
+        return True
+    now = time.time()
+    with _seen_lock:
+        seen_at = _seen_local.get(eid)
+        if seen_at is not None and now - seen_at < EVENT_DEDUP_TTL_SEC:
+            metrics.inc("webhook_events_duplicate_total", scope="local")
+            return False
+        _seen_local[eid] = now
+        _seen_local.move_to_end(eid)
+        while len(_seen_local) > EVENT_DEDUP_LOCAL_MAX:
+            _seen_local.popitem(last=False)
+    cmd = _command_key(event)
+    if cmd not in COMMANDS and cmd != "other":
+        return True
+    conn = _db()
+    with conn:
+        cur = conn.execute("INSERT OR IGNORE INTO seen_events (event_id, seen_at) VALUES (?, ?)", (eid, now))
+        if cur.rowcount == 0:
+            # แถวเก่าที่หมด TTL แล้ว (ยังไม่ถูก prune) ถือเป็น event ใหม่
+            cur = conn.execute(
+                "UPDATE seen_events SET seen_at = ? WHERE event_id = ? AND seen_at < ?",
+                (now, eid, now - EVENT_DEDUP_TTL_SEC),
+            )
+        if cur.rowcount == 0:
+            conn.execute(
+                "INSERT INTO meta (key, value) VALUES ('events_suppressed', 1)"
+                " ON CONFLICT(key) DO UPDATE SET value = value + 1"
+            )
+    if cur.rowcount == 0:
+        metrics.inc("webhook_events_duplicate_total", scope="shared")
+        return False
+    if now - _seen_pruned_at > EVENT_DEDUP_PRUNE_SEC:
+        _prune_seen_events(now)
+    return True
+def enqueue_event(event: Any) -> None:
+    _ensure_job_workers()
+    cmd = _command_key(event)
+    metrics.inc("webhook_events_total", command=cmd)
+    _job_queue.put((cmd, event, time.monotonic()))
+    _update_queue_gauges()
+def job_queue_status() -> Dict[str, Any]:
+    with _job_lock:
+        running = {k: v for k, v in _job_running.items() if v}
+        deferred = {k: len(v) for k, v in _job_pending.items() if v}
+    return {"depth": _job_queue.qsize(), "running": running, "deferred": deferred}
+_SOURCE_STATE_TH = {"closed": "ปกติ✅", "open": "ตัดวงจร⛔", "half-open": "รอลองใหม่⚠️"}
+def build_source_health_text() -> str:
+    now = time.time()
+    lines = [f"🌐 แหล่งผลหวย (โหมด {LOTTO_FETCH_MODE})"]
+    order, _ = _ordered_sources()
+    lines.append("ลำดับที่ลอง: " + " → ".join(tag for tag, _ in order))
+    for tag, _ in LOTTO_SOURCES:
+        health = source_health(tag)
+        state = source_state(health, now)
+        recent = health["recent"]
+        ok = sum(1 for r in recent if r == "ok")
+        lines.append("")
+        lines.append(f"{tag}: {_SOURCE_STATE_TH[state]}")
+        if state == "open":
+            lines.append(f" ข้ามอีก {health['open_until'] - now:.0f} วินาที (พักรอบละ {health['cooldown']:.0f} วินาที)")
+        ewma = f"{health['ewma_sec']:.2f}s" if health["ewma_sec"] is not None else "-"
+        lines.append(f" เวลาเฉลี่ย {ewma} | {len(recent)} ครั้งล่าสุดสำเร็จ {ok} | ล้มติดกัน {health['failures']}")
+        if recent and ok < len(recent):
+            kinds = sorted({r for r in recent if r != "ok"})
+            lines.append(f" ที่ล้ม: {', '.join(f'{k} {recent.count(k)}' for k in kinds)}")
+        if health["last_error"] and health["failures"]:
+            lines.append(f" ล่าสุด: {health['last_error']}")
+    lines.append("")
+    lines.append("ล้างสถานะ/เปิดวงจรคืน: /แหล่งผล รีเซ็ต")
+    return "\n".join(lines)
+def build_status_text() -> str:
+    q = job_queue_status()
+    lines: List[str] = ["⚙️ สถานะระบบ"]
+    lines.append(f"คิวงาน: รอ {q['depth']} | พักไว้ {sum(q['deferred'].values())} | กำลังทำ {sum(q['running'].values())}")
+    for cmd, n in sorted(q["running"].items()):
+        lines.append(f" - กำลังทำ {cmd}: {n}")
+    with _remember_lock:
+        n_touches = len(_pending_touches)
+    conn_stats = line_connection_stats()
+    lines.append(f"LINE API: เปิด connection {conn_stats['connections_opened']} ครั้ง / {conn_stats['requests']} request")
+    lines.append(f"ชื่อกลุ่ม: cache {len(group_names.entries)} | รอ refresh {group_names.pending()}")
+    lines.append(f"target store: เขียน {target_store.writes_per_sec():.2f} ครั้ง/วินาที (60 วิ) | updated_at รอ flush {n_touches} กลุ่ม")
+    snap = metrics.snapshot()
+    hists = snap["histograms"]
+    lines.append(f"event ซ้ำที่ตัดทิ้ง: {int(_meta_get('events_suppressed')) + snap['counters'].get('webhook_events_duplicate_total{scope=local}', 0)} ครั้ง")
+    saved = snap["counters"].get("broadcast_image_bytes_saved_total", 0)
+    lazy = ", ".join(f"{k} {v:.0f}ms" for k, v in STARTUP["lazy_ms"].items()) or "ยังไม่มี"
+    lines.append(f"เริ่มระบบ: import {STARTUP['import_ms']:.0f} ms (budget {STARTUP_BUDGET_MS:.0f}) | lazy: {lazy}")
+    lines.append(f"รูปผลหวย: broadcast ประหยัดไปแล้ว {saved / 1024 / 1024:.1f} MB (preview ย่อแทนรูป original)")
+    lines.append("")
+    lines.append(f"แหล่งผลหวย (โหมด {LOTTO_FETCH_MODE}):")
+    for tag, _ in LOTTO_SOURCES:
+        ok = snap["counters"].get(f"lotto_source_total{{result=ok,source={tag}}}", 0)
+        failed = snap["counters"].get(f"lotto_source_total{{result=failed,source={tag}}}", 0)
+        h = hists.get(f"lotto_source_seconds{{source={tag}}}")
+        rate = f"{ok / (ok + failed) * 100:.0f}%" if ok + failed else "-"
+        p50 = f"{h['p50']:.2f}s" if h else "-"
+        state = _SOURCE_STATE_TH[source_state(source_health(tag))]
+        lines.append(f" - {tag}: สำเร็จ {rate} ({ok}/{ok + failed}) | p50 {p50} | {state}")
+    rows = [(k, v) for k, v in hists.items() if k.startswith("webhook_job_seconds")]
+    if rows:
+        lines.append("")
+        lines.append("เวลาทำงานต่อคำสั่ง (p50 / p99 วินาที):")
+        for k, v in sorted(rows):
+            cmd = k[k.find("command=") + len("command="):].rstrip("}")
+            lines.append(f" - {cmd}: {v['p50']:.2f} / {v['p99']:.2f} ({v['count']} ครั้ง)")
+    return "\n".join(lines)
 # Routes
 @app.route("/callback", methods=["POST"])
 def callback():
+    started = time.monotonic()
+    status = "500"
+    try:
+        resp = _handle_webhook()
+        status = "200"
+        return resp
+    except HTTPException as e:
+        status = str(e.code)
+        raise
+    finally:
+        metrics.inc("webhook_requests_total", status=status)
+        metrics.observe("webhook_request_seconds", time.monotonic() - started)
+def _handle_webhook():
     signature = request.headers.get("X-Line-Signature", "")
     body = request.get_data(as_text=True)
     try:
-        handler.handle(body, signature)
+        events = handler.parser.parse(body, signature)
+    except InvalidSignatureError:
+        abort(400)
     except Exception as e:
-        app.logger.exception(f"handler error: {e}")
+        log_event(logging.ERROR, "webhook_parse_error", exc_info=True, error=e)
         abort(400)
+    for event in events:
+        # ตัด event ซ้ำก่อนเริ่มงานใด ๆ (ก่อนเข้าคิว)
+        if not claim_event(event):
+            log_event(logging.INFO, "event_duplicate", event_id=getattr(event, "webhook_event_id", ""))
+            continue
+        if not WEBHOOK_ASYNC:
+            try:
+                _dispatch_event(event)
+            except Exception as e:
+                log_event(logging.ERROR, "handler_error", exc_info=True, error=e)
+                abort(400)
+            continue
+        enqueue_event(event)
     return "OK"
+@app.route("/stats", methods=["GET"])
+def stats():
+    snap = metrics.snapshot()
+    snap["queue"] = job_queue_status()
+    snap["line_connections"] = line_connection_stats()
+    return Response(json.dumps(snap, ensure_ascii=False), mimetype="application/json")
+# เปิด /metrics ให้ Prometheus ดึง ค่าของ worker อื่นมาจาก snapshot ที่แต่ละ worker เขียนลง SQLite ทุก METRICS_SHARE_SEC
+METRICS_SHARE_SEC = float(os.getenv("METRICS_SHARE_SEC", "10"))
+# snapshot ที่ไม่อัปเดตเกินนี้ (worker ตาย/ถูก recycle) ไม่นับและลบทิ้ง
+METRICS_SNAPSHOT_TTL_SEC = float(os.getenv("METRICS_SNAPSHOT_TTL_SEC", str(max(METRICS_SHARE_SEC, 1) * 3)))
+def _prune_metrics_snapshots(conn: sqlite3.Connection) -> None:
+    """ลบ snapshot ที่หมด TTL และของ worker ที่ process ตายไปแล้ว (เครื่องเดียวกัน) ทันที"""
+    dead = [r["owner"] for r in conn.execute("SELECT owner FROM metrics_snapshots") if not _owner_alive(r["owner"])]
+    with conn:
+        conn.execute("DELETE FROM metrics_snapshots WHERE updated_at < ?", (time.time() - METRICS_SNAPSHOT_TTL_SEC,))
+        conn.executemany("DELETE FROM metrics_snapshots WHERE owner = ?", [(o,) for o in dead])
+def share_metrics_snapshot() -> None:
+    conn = _db()
+    with conn:
+        conn.execute(
+            "INSERT INTO metrics_snapshots (owner, data, updated_at) VALUES (?, ?, ?)"
+            " ON CONFLICT(owner) DO UPDATE SET data = excluded.data, updated_at = excluded.updated_at",
+            (_owner_id(), json.dumps(metrics.export()), time.time()),
+        )
+    _prune_metrics_snapshots(conn)
+def _metrics_share_loop() -> None:
+    while True:
+        time.sleep(METRICS_SHARE_SEC)
+        try:
+            share_metrics_snapshot()
+        except Exception as e:
+            log_event(logging.WARNING, "metrics_share_failed", error=e)
+@app.route("/metrics", methods=["GET"])
+def prometheus_metrics():
+    exports = [metrics.export()]
+    if METRICS_SHARE_SEC > 0:
+        conn = _db()
+        _prune_metrics_snapshots(conn)
+        rows = conn.execute("SELECT data FROM metrics_snapshots WHERE owner != ?", (_owner_id(),)).fetchall()
+        exports.extend(json.loads(r["data"]) for r in rows)
+    return Response(render_prometheus(exports), mimetype="text/plain; version=0.0.4")
+def _image_response(payload: bytes, etag: str, cache_control: str, mimetype: str = "image/png") -> Response:
+    """ตอบรูปพร้อม strong ETag ถ้า If-None-Match ตรงกันตอบ 304 (ไม่ส่ง body)"""
+    if request.if_none_match.contains(etag):
+        resp = Response(status=304)
+        metrics.inc("lotto_image_http_total", status="304")
+    else:
+        resp = Response(payload, mimetype=mimetype)
+        metrics.inc("lotto_image_http_total", status="200")
+        metrics.inc("lotto_image_bytes_sent_total", len(payload))
+    resp.set_etag(etag)
+    resp.headers["Cache-Control"] = cache_control
+    return resp
+def _serve_lotto_image(name: str) -> Response:
+    m = _IMAGE_NAME_RE.match(name)
+    if not m:
+        abort(404)
+    payload = load_lotto_image(name)
+    if payload is None:
+        abort(404)
+    return _image_response(payload, name, "public, max-age=31536000, immutable", _IMAGE_MIMETYPES[m.group(1)])
+@app.route("/lotto/original/<name>", methods=["GET"])
+def lotto_image_original(name: str):
+    return _serve_lotto_image(name)
+@app.route("/lotto/preview/<name>", methods=["GET"])
+def lotto_image_preview(name: str):
+    return _serve_lotto_image(name)
 @app.route("/lotto/latest_clean.png", methods=["GET"])
 def lotto_latest_clean():
-    headers = {
-        "Cache-Control": "no-store, no-cache, must-revalidate, max-age=0",
-        "Pragma": "no-cache",
-        "Expires": "0",
-    }
-    file_path = os.path.join(STATIC_DIR, LOTTO_IMAGE_FILENAME)
-    if os.path.exists(file_path):
-        with open(file_path, "rb") as f:
-            png = f.read()
-        return Response(png, mimetype="image/png", headers=headers)
     data = fetch_latest_lotto()
     if not data:
         img = Image.new("RGB", (900, 300), (255, 220, 230))
@@ -470,136 +2765,291 @@ def lotto_latest_clean():
         draw.text((450, 150), "ยังดึงผลหวยไม่ได้ / ยังไม่ออกผล", font=font, fill=(0, 0, 0), anchor="mm")
         buf = BytesIO()
         img.save(buf, format="PNG")
+        headers = {"Cache-Control": "no-store, no-cache, must-revalidate, max-age=0", "Pragma": "no-cache", "Expires": "0"}
         return Response(buf.getvalue(), mimetype="image/png", headers=headers)
-    png = render_lotto_image_clean(data)
-    try:
-        with open(file_path, "wb") as f:
-            f.write(png)
-    except Exception as e:
-        app.logger.warning(f"save lotto image failed in endpoint: {e}")
-    return Response(png, mimetype="image/png", headers=headers)
+    # URL นี้เปลี่ยนรูปได้เมื่อผลใหม่ออก -> ให้ cache ไว้แต่ต้อง revalidate (ได้ 304 ถ้ายังเป็นผลเดิม)
+    name, payload = get_lotto_image(data)
+    return _image_response(payload, name, "public, no-cache", _IMAGE_MIMETYPES[name.rsplit(".", 1)[1]])
+# Command router
+# คำสั่งลงทะเบียนในตาราง COMMANDS (token แรก -> Command) เลือก handler ได้ใน O(1) ไม่ต้องไล่ if ทีละอัน
+# ข้อความที่ไม่ขึ้นต้นด้วย / (แชทปกติ เกือบทั้งหมด) ไม่ผ่าน router เลย
+# middleware ต่อคำสั่ง (admin_only / rate_limit) ประกอบไว้ตอนลงทะเบียน เวลาทำงานจับให้ทุกคำสั่ง
+# เพิ่มคำสั่งใหม่ด้วย @command(...) ไม่ต้องแก้ on_text
+ADMIN_USER_IDS = {u.strip() for u in os.getenv("ADMIN_USER_IDS", "").split(",") if u.strip()}
+class Command:
+    def __init__(self, name: str, func: Any, usage: Tuple[str, ...], middleware: Tuple[Any, ...]):
+        self.name = name
+        self.func = func
+        self.usage = usage or (name,)
+        self.middleware = middleware
+        run = func
+        for mw in reversed(middleware):
+            run = (lambda mw, nxt: lambda event, args: mw(self, event, args, nxt))(mw, run)
+        self.run = run
+    def __call__(self, event: MessageEvent, args: List[str]) -> None:
+        started = time.monotonic()
+        try:
+            self.run(event, args)
+        finally:
+            metrics.observe("command_seconds", time.monotonic() - started, command=self.name)
+COMMANDS: Dict[str, Command] = {}
+def command(name: str, usage: Tuple[str, ...] = (), middleware: Tuple[Any, ...] = ()):
+    """ลงทะเบียน handler(event, args) ของคำสั่ง (args = คำหลังชื่อคำสั่ง)"""
+    def deco(func):
+        COMMANDS[name] = Command(name, func, usage, middleware)
+        return func
+    return deco
+def admin_only(cmd: Command, event: MessageEvent, args: List[str], nxt: Any) -> None:
+    """ตั้ง ADMIN_USER_IDS แล้วเฉพาะ user เหล่านั้นใช้คำสั่งนี้ได้ (ไม่ตั้ง = ทุกคนใช้ได้เหมือนเดิม)"""
+    if ADMIN_USER_IDS and getattr(event.source, "user_id", None) not in ADMIN_USER_IDS:
+        metrics.inc("command_denied_total", command=cmd.name, reason="admin")
+        safe_send(event, [messaging.TextMessage(text="⛔ คำสั่งนี้สำหรับแอดมินเท่านั้นครับ")])
+        return
+    nxt(event, args)
+_command_buckets: "OrderedDict[Tuple[str, str], _TokenBucket]" = OrderedDict()
+_command_buckets_lock = threading.Lock()
+def rate_limit(per_sec: float, burst: int = 1, notify: bool = False):
+    """จำกัดความถี่ของคำสั่งต่อห้องแชท เกินแล้วเงียบ (ไม่ตอบ ไม่เปลือง quota)
+    notify=True (คำสั่งแอดมิน) ตอบบอกให้รอแทน ไม่งั้นแอดมินที่พิมพ์ใหม่หลังพิมพ์ผิดจะไม่รู้ว่าคำสั่งไม่ทำงาน"""
+    def mw(cmd: Command, event: MessageEvent, args: List[str], nxt: Any) -> None:
+        key = (cmd.name, current_target_id(event) or "")
+        with _command_buckets_lock:
+            bucket = _command_buckets.get(key)
+            if bucket is None:
+                bucket = _command_buckets[key] = _TokenBucket(per_sec, burst)
+                while len(_command_buckets) > 10000:
+                    _command_buckets.popitem(last=False)
+            _command_buckets.move_to_end(key)
+        if not bucket.try_acquire():
+            metrics.inc("command_denied_total", command=cmd.name, reason="rate")
+            if notify:
+                safe_send(event, [messaging.TextMessage(text=f"⏳ {cmd.name} เพิ่งสั่งไป กรุณารออีก {max(1, round(bucket.wait_time()))} วินาทีแล้วพิมพ์ใหม่ครับ")])
+            return
+        nxt(event, args)
+    return mw
+def build_help_text() -> str:
+    lines = ["คำสั่งที่ใช้ได้:"]
+    for cmd in COMMANDS.values():
+        lines.extend(f"- {u}" for u in cmd.usage)
+    return "\n".join(lines)
 # Handlers
 @handler.add(MessageEvent, message=TextMessageContent)
 def on_text(event: MessageEvent):
     text = (event.message.text or "").strip()
     dc = getattr(event, "delivery_context", None)
     if dc and getattr(dc, "is_redelivery", False):
-        app.logger.info("skip redelivery event")
+        log_event(logging.INFO, "redelivery_skipped")
         return
     # จำกลุ่มถ้าเปิดโหมดจำ (ให้พิมอะไรก็ได้)
     remember_target(event)
     # รับเฉพาะคำสั่งที่ขึ้นต้นด้วย / สำหรับการประมวลผลคำสั่ง
     if not text.startswith("/"):
         return
-    exclude_id = current_target_id(event)
+    parts = text.split()
+    cmd = COMMANDS.get(parts[0])
+    if cmd is None:
+        safe_send(event, [messaging.TextMessage(text=build_help_text())])
+        return
+    cmd(event, parts[1:])
 # ---------------- ลูกค้า ----------------
-    if text == "/ลูกค้า":
-        full_text = build_customers_text()
-        # ถ้าข้อความสั้น ส่งเลย
-        if len(full_text) < 4500:
-            safe_send(event, [TextMessage(text=full_text)])
-            return
-        # ถ้าข้อยาวเกิน ให้ตัดแบ่งเป็นท่อนๆ (Chunk)
-        lines = full_text.split('\n')
-        chunks = []
-        current_chunk = ""
-        for line in lines:
-            # ถ้าเอาบรรทัดใหม่ไปต่อแล้วเกิน 4000 ตัว ให้ตัดท่อนเก็บไว้ก่อน
-            if len(current_chunk) + len(line) + 1 > 4000:
-                chunks.append(current_chunk)
-                current_chunk = line + "\n"
-            else:
-                current_chunk += line + "\n"
-        if current_chunk:
-            chunks.append(current_chunk)
-        # สร้าง Message Object จากท่อนที่ตัดไว้ (ส่งได้สูงสุด 5 บับเบิ้ลต่อครั้ง)
-        messages = [TextMessage(text=c.strip()) for c in chunks[:5]]
-        safe_send(event, messages)
+@command("/ลูกค้า", usage=("/ลูกค้า", "/ลูกค้า 2", "/ลูกค้า ค้นหา ชื่อ", "/ลูกค้า เปิด", "/ลูกค้า ปิด"), middleware=(admin_only,))
+def cmd_customers(event: MessageEvent, args: List[str]) -> None:
+    # isdecimal ไม่ใช่ isdigit: "²" เป็น digit แต่ int() แปลงไม่ได้
+    if not args or args[0].isdecimal():
+        # ทยอยอัปเดตชื่อกลุ่มที่ cache หมดอายุ (เบื้องหลัง) รายชื่อครั้งถัดไปจะเป็นชื่อล่าสุด
+        group_names.refresh_all(target_store.ids())
+        # ทีละหน้า (CUSTOMERS_PAGE_SIZE กลุ่ม) ข้อความไม่เกินขนาดของ LINE จึงไม่มีส่วนไหนหายไป
+        safe_send(event, [messaging.TextMessage(text=build_customers_text(int(args[0]) if args else 1))])
         return
-    if text.startswith("/ลูกค้า"):
-        parts = text.split()
-        if len(parts) == 1:
-            safe_send(event, [TextMessage(text=build_customers_text())])
-            return
-        sub = parts[1].strip()
-        if sub == "เปิด":
-            set_remember_enabled(True)
-            safe_send(event, [TextMessage(text="✅ เปิดโหมดจำชื่อ/ID (เฉพาะกลุ่ม) แล้วครับ\n(จากนี้เมื่อมีข้อความเข้ากลุ่ม จะเริ่มบันทึกลง targets.json)")])
-            return
-        if sub == "ปิด":
-            set_remember_enabled(False)
-            safe_send(event, [TextMessage(text="⛔ ปิดโหมดจำชื่อ/ID (เฉพาะกลุ่ม) แล้วครับ\n(จะไม่บันทึกเพิ่ม แต่รายชื่อเดิมยังอยู่ใน targets.json)")])
+    if args[0] == "ค้นหา":
+        if len(args) < 2:
+            safe_send(event, [messaging.TextMessage(text="ใช้คำสั่ง: /ลูกค้า ค้นหา ชื่อกลุ่ม")])
             return
+        safe_send(event, [messaging.TextMessage(text=build_customer_search_text(" ".join(args[1:])))])
+        return
+    sub = args[0].strip()
+    if sub == "เปิด":
+        set_remember_enabled(True)
+        safe_send(event, [messaging.TextMessage(text="✅ เปิดโหมดจำชื่อ/ID (เฉพาะกลุ่ม) แล้วครับ\n(จากนี้เมื่อมีข้อความเข้ากลุ่ม จะเริ่มบันทึกรายชื่อกลุ่ม)")])
+        return
+    if sub == "ปิด":
+        set_remember_enabled(False)
+        safe_send(event, [messaging.TextMessage(text="⛔ ปิดโหมดจำชื่อ/ID (เฉพาะกลุ่ม) แล้วครับ\n(จะไม่บันทึกเพิ่ม แต่รายชื่อเดิมยังอยู่)")])
+        return
 
-        safe_send(event, [TextMessage(text="ใช้คำสั่ง:\n- /ลูกค้า\n- /ลูกค้า เปิด\n- /ลูกค้า ปิด")])
-        return
-    # ---------------- ปิดรับ / แจ้งโอน ----------------
-    if text == "/ปิดรับ":
-        # ใส่ Link ที่ได้จากเว็บฝากรูปตรงนี้
-        url = "https://i.postimg.cc/WtcRzDxG/close.jpg" 
-        msg = ImageMessage(original_content_url=url, preview_image_url=url)
-        safe_send(event, [msg])
-        push_to_all([msg], exclude_id=exclude_id)
-        return
-    if text == "/แจ้งโอน":
-        # ใส่ Link ที่ได้จากเว็บฝากรูปตรงนี้
-        url = "https://i.postimg.cc/d1QGM41P/transferv.jpg"
-        msg = ImageMessage(original_content_url=url, preview_image_url=url)
-        safe_send(event, [msg])
-        push_to_all([msg], exclude_id=exclude_id)
-        return
-    # ---------------- ส่งผลหวย (แบบระบุ URL ท้ายคำสั่ง) ----------------
-    if text.startswith("/ส่งผลหวย"):
-        # แยกคำสั่งกับลิงก์ออกจากกัน
-        parts = text.split()
-        # 1. เช็กว่าใส่ลิงก์มาหรือเปล่า? (ถ้าพิมพ์มาแค่ /ส่งผลหวย ให้เตือน)
-        if len(parts) < 2:
-            safe_send(event, [TextMessage(text="⚠️ กรุณาใส่ลิงก์รูปต่อท้ายคำสั่งด้วยครับ\n\nตัวอย่าง:\n/ส่งผลหวย https://i.postimg.cc/ตัวอย่าง/lotto.jpg")])
-            return
-        # ดึงลิงก์จากข้อความส่วนที่ 2
-        url = parts[1].strip()
-        # 2. ตรวจสอบว่าเป็น HTTPS และเป็นไฟล์รูปหรือไม่
-        if not url.lower().startswith("https://"):
-            safe_send(event, [TextMessage(text="⚠️ ลิงก์รูปต้องขึ้นต้นด้วย https:// เท่านั้นครับ")])
-            return
-        # (ตรวจสอบนามสกุลไฟล์เพิ่ม เพื่อความชัวร์)
-        if not (url.endswith(".jpg") or url.endswith(".png") or url.endswith(".jpeg")):
-             safe_send(event, [TextMessage(text="⚠️ ลิงก์ดูเหมือนไม่ใช่รูปภาพ (ต้องลงท้ายด้วย .jpg หรือ .png)\nตรวจสอบว่าเป็น 'Direct Link' หรือไม่ครับ")])
-             return
-        # 3. สร้างข้อความรูปภาพ
-        msg = ImageMessage(original_content_url=url, preview_image_url=url)
-        # 4. ส่งให้แอดมินดูตัวอย่างก่อน 1 รอบ
-        safe_send(event, [msg])
-        push_to_all([msg], exclude_id=exclude_id)
-        safe_send(event, [TextMessage(text="✅ ระบบกำลังทยอยส่งรูปไปยังทุกกลุ่มครับ")])
-        return
-    # ---------------- ผลหวย ----------------
-    if text == "/ผลหวย":
-        # 1. เช็กว่าตั้งค่า BASE_URL หรือยัง
-        if not _is_https(BASE_URL):
-            safe_send(event, [TextMessage(text="⚠️ ต้องตั้งค่า BASE_URL เป็น https ก่อนครับ ถึงจะส่งรูปให้ดูได้")])
+    safe_send(event, [messaging.TextMessage(text="ใช้คำสั่ง:\n- /ลูกค้า\n- /ลูกค้า 2\n- /ลูกค้า ค้นหา ชื่อ\n- /ลูกค้า เปิด\n- /ลูกค้า ปิด")])
+@command("/แท็ก", usage=("/แท็ก", "/แท็ก เพิ่ม vip [groupId]", "/แท็ก ลบ vip [groupId]", "/แท็ก ดู @vip"), middleware=(admin_only,))
+def cmd_tags(event: MessageEvent, args: List[str]) -> None:
+    if not args:
+        safe_send(event, [messaging.TextMessage(text=build_tags_text())])
+        return
+    sub, rest = args[0], args[1:]
+    try:
+        if sub == "ดู" and rest:
+            safe_send(event, [messaging.TextMessage(text=build_selector_text(rest))])
             return
-        # 2. พยายามดึงข้อมูลหวย
-        data = fetch_latest_lotto(force=True)
-        if not data:
-            safe_send(event, [TextMessage(text="ยังดึงผลหวยไม่ได้ / หรือผลอาจจะยังไม่ออกครับ")])
+        if sub in ("เพิ่ม", "ลบ") and rest:
+            # ใส่ groupId ต่อท้ายได้ (แก้จากแชทแอดมิน) ไม่ใส่ = กลุ่มที่พิมพ์คำสั่ง
+            gids = [a for a in rest if _GROUP_ID_RE.match(a)]
+            tags = [a for a in rest if a not in gids]
+            gid = gids[0] if gids else getattr(event.source, "group_id", None)
+            if not gid or not tags:
+                safe_send(event, [messaging.TextMessage(text="ใช้ในกลุ่ม หรือใส่ groupId ต่อท้ายครับ เช่น /แท็ก เพิ่ม vip Cxxxx")])
+                return
+            result = set_target_tags(gid, add=tags if sub == "เพิ่ม" else (), remove=tags if sub == "ลบ" else ())
+            if result is None:
+                safe_send(event, [messaging.TextMessage(text="ยังไม่มีกลุ่มนี้ในรายชื่อ (เปิด /ลูกค้า เปิด แล้วพิมพ์อะไรก็ได้ในกลุ่มก่อน)")])
+                return
+            safe_send(event, [messaging.TextMessage(text=f"✅ แท็กของกลุ่มนี้: {' '.join('@' + t for t in result) or '(ไม่มี)'}")])
             return
-        try:
-            # 3. สร้างรูปและบันทึก
-            save_lotto_image_to_static(data)
-            # 4. สร้าง URL ของรูป (ต้องมี BASE_URL + path ของรูป)
-            # เติม ?t=... เพื่อให้ LINE รู้ว่าเป็นรูปใหม่เสมอ (ไม่ cached รูปเก่า)
-            url = f"{BASE_URL}{LOTTO_IMAGE_PATH}?t={int(time.time())}"
-            # 5. เตรียมข้อความรูปภาพ
-            msg = ImageMessage(original_content_url=url, preview_image_url=url)
-            # 6. ส่งกลับหาคนสั่ง
-            safe_send(event, [msg])
-        except Exception as e:
-            app.logger.exception(f"save lotto image failed: {e}")
-            safe_send(event, [TextMessage(text=f"เกิดข้อผิดพลาดในการสร้างรูป: {e}")])
+    except ValueError as e:
+        safe_send(event, [messaging.TextMessage(text=f"⚠️ {e}")])
+        return
+    safe_send(event, [messaging.TextMessage(text="ใช้คำสั่ง:\n- /แท็ก\n- /แท็ก เพิ่ม vip [groupId]\n- /แท็ก ลบ vip [groupId]\n- /แท็ก ดู @vip+north")])
+# ---------------- ปิดรับ / แจ้งโอน ----------------
+# broadcast ทุกกลุ่ม: ห้องเดียวกันสั่งซ้ำได้อย่างมาก 1 ครั้งต่อ 10 วินาที (เกินแล้วตอบให้รอ ไม่เงียบ)
+BROADCAST_COMMAND_MIDDLEWARE = (admin_only, rate_limit(0.1, 1, notify=True))
+def _broadcast_selector(event: MessageEvent, cmd: str, args: List[str], positional: int = 0) -> Optional[Tuple[List[str], List[str]]]:
+    """แยก @แท็ก ออกจาก args คืน (selector, args ที่เหลือ) ถ้าแท็กผิด/ไม่มีกลุ่มที่ตรง ตอบแอดมินแล้วคืน None
+
+    args อื่นที่ไม่ใช่ @แท็ก เกิน positional ตัว (เช่นลืมพิมพ์ @) ถือว่าผิด ไม่ส่ง เพื่อไม่ให้พิมพ์ผิดกลายเป็นส่งทุกกลุ่ม
+    """
+    selector, rest = split_selector(args)
+    if len(rest) > positional:
+        usage = "\n".join(f"- {u}" for u in COMMANDS[cmd].usage)
+        safe_send(event, [messaging.TextMessage(text=f"⚠️ ไม่เข้าใจ \"{' '.join(rest[positional:])}\" ไม่ได้ส่งครับ (แท็กต้องขึ้นต้นด้วย @)\nใช้คำสั่ง:\n{usage}")])
+        return None
+    if not selector:
+        return selector, rest
+    try:
+        n = len(target_store.select(selector))
+    except ValueError as e:
+        safe_send(event, [messaging.TextMessage(text=f"⚠️ {e} (ดูแท็กที่มี: /แท็ก)")])
+        return None
+    if n == 0:
+        safe_send(event, [messaging.TextMessage(text=f"⚠️ ไม่มีกลุ่มที่ตรงกับ {' '.join(selector)} ไม่ได้ส่งครับ")])
+        return None
+    return selector, rest
+@command("/ปิดรับ", usage=("/ปิดรับ", "/ปิดรับ @vip"), middleware=BROADCAST_COMMAND_MIDDLEWARE)
+def cmd_close(event: MessageEvent, args: List[str]) -> None:
+    sel = _broadcast_selector(event, "/ปิดรับ", args)
+    if sel is None:
+        return
+    # ใส่ Link ที่ได้จากเว็บฝากรูปตรงนี้
+    url = "https://i.postimg.cc/WtcRzDxG/close.jpg" 
+    msg = messaging.ImageMessage(original_content_url=url, preview_image_url=url)
+    safe_send(event, [msg])
+    push_to_all([msg], exclude_id=current_target_id(event), job_key=broadcast_job_key(event, "/ปิดรับ"), selector=sel[0])
+@command("/แจ้งโอน", usage=("/แจ้งโอน", "/แจ้งโอน @vip"), middleware=BROADCAST_COMMAND_MIDDLEWARE)
+def cmd_transfer(event: MessageEvent, args: List[str]) -> None:
+    sel = _broadcast_selector(event, "/แจ้งโอน", args)
+    if sel is None:
+        return
+    # ใส่ Link ที่ได้จากเว็บฝากรูปตรงนี้
+    url = "https://i.postimg.cc/d1QGM41P/transferv.jpg"
+    msg = messaging.ImageMessage(original_content_url=url, preview_image_url=url)
+    safe_send(event, [msg])
+    push_to_all([msg], exclude_id=current_target_id(event), job_key=broadcast_job_key(event, "/แจ้งโอน"), selector=sel[0])
+# ---------------- ผลหวย ----------------
+@command("/ผลหวย", middleware=(rate_limit(0.2, 2),))
+def cmd_lotto(event: MessageEvent, args: List[str]) -> None:
+    # 1. เช็กว่าตั้งค่า BASE_URL หรือยัง
+    if not _is_https(BASE_URL):
+        safe_send(event, [messaging.TextMessage(text="⚠️ ต้องตั้งค่า BASE_URL เป็น https ก่อนครับ ถึงจะส่งรูปให้ดูได้")])
+        return
+    # 2. พยายามดึงข้อมูลหวย (ถ้า scheduler ได้ผลงวดล่าสุดครบแล้ว ใช้ cache เลย)
+    data = fetch_latest_lotto(force=not lotto_result_is_current())
+    if not data:
+        safe_send(event, [messaging.TextMessage(text="ยังดึงผลหวยไม่ได้ / หรือผลอาจจะยังไม่ออกครับ")])
+        return
+    try:
+        # 3. สร้างรูป (ข้ามถ้ารูปของผลนี้ถูกเรนเดอร์ไว้แล้ว)
+        names = ensure_lotto_image(data)
+        # 4-5. URL ตาม hash ของผล: ผลใหม่ได้ URL ใหม่เอง ผลเดิม LINE ใช้ cache เดิมได้
+        # preview เป็น JPEG ย่อ หน้าแชทไม่ต้องโหลดรูปเต็ม
+        msg = lotto_image_message(names)
+        # 6. ส่งกลับหาคนสั่ง (โหมด quorum: ถ้าสองเว็บให้เลขไม่ตรงกันให้เตือนแอดมินด้วย)
+        messages: List[Any] = [msg]
+        if data.get("mismatch"):
+            messages.append(messaging.TextMessage(text=f"⚠️ ผลจากแต่ละเว็บไม่ตรงกัน ({', '.join(data['mismatch'])}) ใช้ผลจาก {data.get('source')} กรุณาตรวจสอบก่อนส่งต่อครับ"))
+        safe_send(event, messages)
+    except Exception as e:
+        log_event(logging.ERROR, "lotto_image_failed", exc_info=True, error=e)
+        safe_send(event, [messaging.TextMessage(text=f"เกิดข้อผิดพลาดในการสร้างรูป: {e}")])
+# ---------------- ตรวจหวย (จากคลังผลย้อนหลัง ไม่ดึงเว็บ) ----------------
+@command("/ตรวจหวย", usage=("/ตรวจหวย เลข [งวด|ทั้งหมด]",), middleware=(rate_limit(1, 5),))
+def cmd_check_ticket(event: MessageEvent, args: List[str]) -> None:
+    safe_send(event, [messaging.TextMessage(text=build_ticket_check_text(args))])
+# ---------------- ส่งผลหวย (แบบระบุ URL ท้ายคำสั่ง) ----------------
+@command("/ส่งผลหวย", usage=("/ส่งผลหวย ลิงก์รูป", "/ส่งผลหวย ลิงก์รูป @vip"), middleware=BROADCAST_COMMAND_MIDDLEWARE)
+def cmd_send_lotto(event: MessageEvent, args: List[str]) -> None:
+    # อนุญาตแค่ลิงก์รูป 1 ตัว ที่เหลือต้องเป็น @แท็ก
+    sel = _broadcast_selector(event, "/ส่งผลหวย", args, positional=1)
+    if sel is None:
+        return
+    selector, args = sel
+    # 1. เช็กว่าใส่ลิงก์มาหรือเปล่า? (ถ้าพิมพ์มาแค่ /ส่งผลหวย ให้เตือน)
+    if not args:
+        safe_send(event, [messaging.TextMessage(text="⚠️ กรุณาใส่ลิงก์รูปต่อท้ายคำสั่งด้วยครับ\n\nตัวอย่าง:\n/ส่งผลหวย https://i.postimg.cc/ตัวอย่าง/lotto.jpg")])
+        return
+    # ดึงลิงก์จากข้อความส่วนที่ 2
+    url = args[0].strip()
+    # 2. ตรวจสอบว่าเป็น HTTPS และเป็นไฟล์รูปหรือไม่
+    if not url.lower().startswith("https://"):
+        safe_send(event, [messaging.TextMessage(text="⚠️ ลิงก์รูปต้องขึ้นต้นด้วย https:// เท่านั้นครับ")])
+        return
+    # (ตรวจสอบนามสกุลไฟล์เพิ่ม เพื่อความชัวร์)
+    if not (url.endswith(".jpg") or url.endswith(".png") or url.endswith(".jpeg")):
+        safe_send(event, [messaging.TextMessage(text="⚠️ ลิงก์ดูเหมือนไม่ใช่รูปภาพ (ต้องลงท้ายด้วย .jpg หรือ .png)\nตรวจสอบว่าเป็น 'Direct Link' หรือไม่ครับ")])
+        return
+    # 3. สร้างข้อความรูปภาพ (ถ้าเป็นรูปผลหวยจาก /lotto/original/ ของเราจะใช้ preview ขนาดเล็ก)
+    msg = image_message_for_url(url)
+    # 4. ส่งให้แอดมินดูตัวอย่างก่อน 1 รอบ
+    safe_send(event, [msg])
+    push_to_all([msg], exclude_id=current_target_id(event), job_key=broadcast_job_key(event, "/ส่งผลหวย"), selector=selector)
+    safe_send(event, [messaging.TextMessage(text=f"✅ ระบบกำลังทยอยส่งรูปไปยัง{'กลุ่ม ' + ' '.join(selector) + ' ' if selector else 'ทุกกลุ่ม'}ครับ")])
+# ---------------- สถานะระบบ ----------------
+@command("/แหล่งผล", usage=("/แหล่งผล", "/แหล่งผล รีเซ็ต"), middleware=(admin_only,))
+def cmd_sources(event: MessageEvent, args: List[str]) -> None:
+    if args and args[0] == "รีเซ็ต":
+        reset_source_health()
+        safe_send(event, [messaging.TextMessage(text="✅ ล้างสถานะแหล่งผลหวยแล้ว ทุกเว็บกลับมาใช้ได้ตามปกติครับ")])
+        return
+    safe_send(event, [messaging.TextMessage(text=build_source_health_text())])
+@command("/สถานะ", middleware=(admin_only,))
+def cmd_status(event: MessageEvent, args: List[str]) -> None:
+    safe_send(event, [messaging.TextMessage(text=build_status_text())])
+@command("/งานส่ง", middleware=(admin_only,))
+def cmd_broadcast_jobs(event: MessageEvent, args: List[str]) -> None:
+    safe_send(event, [messaging.TextMessage(text=build_broadcast_jobs_text())])
+# Background tasks
+_background_pid: Optional[int] = None
+def start_background_tasks() -> None:
+    """งานเบื้องหลังต่อ process (เรียกซ้ำได้ จะเริ่มแค่ครั้งเดียวต่อ pid)"""
+    global _background_pid
+    if _background_pid == os.getpid():
         return
-    # help
-    safe_send(event, [TextMessage(text="คำสั่งที่ใช้ได้:\n- /ลูกค้า\n- /ลูกค้า เปิด\n- /ลูกค้า ปิด\n- /ปิดรับ\n- /แจ้งโอน\n- /ผลหวย\n- /ส่งผลหวย")])
-    return
+    _background_pid = os.getpid()
+    threading.Thread(target=_resume_loop, name="resume-broadcasts", daemon=True).start()
+    threading.Thread(target=_touch_flush_loop, name="flush-touches", daemon=True).start()
+    atexit.register(flush_target_touches)
+    if METRICS_SHARE_SEC > 0:
+        threading.Thread(target=_metrics_share_loop, name="metrics-share", daemon=True).start()
+    if LOTTO_SCHEDULER:
+        threading.Thread(target=DrawScheduler().run, name="draw-scheduler", daemon=True).start()
+    if TARGET_PRUNE_DAYS > 0:
+        threading.Thread(target=_prune_loop, name="target-prune", daemon=True).start()
+# Startup report
+# เวลา import off.py (ไม่รวมโมดูล lazy) ถ้าเกิน STARTUP_BUDGET_MS จะ log เป็น warning
+# ใช้คู่กับ python bench.py startup --budget-ms ... ใน CI กันไม่ให้ import หนักกลับมาอยู่ตอนเริ่ม
+STARTUP_BUDGET_MS = float(os.getenv("STARTUP_BUDGET_MS", "1000"))
+STARTUP["import_ms"] = round((time.perf_counter() - _IMPORT_STARTED) * 1000, 1)
+metrics.observe("startup_import_seconds", STARTUP["import_ms"] / 1000)
+log_event(logging.WARNING if STARTUP["import_ms"] > STARTUP_BUDGET_MS else logging.INFO, "startup",
+          import_ms=STARTUP["import_ms"], budget_ms=STARTUP_BUDGET_MS, pid=os.getpid())
+# ใช้ off.py เป็น library (เช่น render_batch.py) ตั้ง BACKGROUND_TASKS=0 ไม่ให้ resume broadcast/scheduler
+# gunicorn โหมด preload (gunicorn.conf.py) ก็ตั้งเป็น 0 ใน master แล้วเริ่มใน post_fork ของแต่ละ worker แทน
+if os.getenv("BACKGROUND_TASKS", "1").strip() != "0":
+    start_background_tasks()
 if __name__ == "__main__":
     app.run(port=5000, debug=True)
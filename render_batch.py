@@ -0,0 +1,72 @@
+# -*- coding: utf-8 -*-
+"""เรนเดอร์รูปผลหวยหลายงวด x หลายธีมแบบ batch (ไม่ต้องรัน Flask)
+
+ตัวอย่าง:
+    python render_batch.py --from-db --themes default,gold --out renders
+    python render_batch.py --input results.json --all-themes --workers 4
+"""
+import os
+import sys
+import json
+import time
+import argparse
+from typing import Any, Dict, List, Optional
+def load_bot():
+    """import off.py แบบใช้แค่ส่วนเรนเดอร์ (ไม่เริ่มงานเบื้องหลัง ไม่ต้องมี token จริง)"""
+    os.environ.setdefault("CHANNEL_ACCESS_TOKEN", "render-only")
+    os.environ.setdefault("CHANNEL_SECRET", "render-only")
+    os.environ["LOTTO_SCHEDULER"] = "0"
+    os.environ["BACKGROUND_TASKS"] = "0"
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    import off
+    return off
+def read_records(path: str) -> List[Dict[str, Any]]:
+    """อ่านผลหวยจากไฟล์ JSON (dict เดียว หรือ list) หรือ JSON lines รูปแบบเดียวกับ fetch_latest_lotto"""
+    with open(path, encoding="utf-8") as f:
+        text = f.read().strip()
+    if not text:
+        return []
+    if text[0] in "[{":
+        try:
+            data = json.loads(text)
+            return data if isinstance(data, list) else [data]
+        except json.JSONDecodeError:
+            pass
+    return [json.loads(line) for line in text.splitlines() if line.strip()]
+def main(argv: Optional[List[str]] = None) -> int:
+    parser = argparse.ArgumentParser(description="lotto-bot batch image renderer")
+    parser.add_argument("--input", action="append", default=[], help="ไฟล์ JSON/JSONL ของผลหวย (ใส่ได้หลายครั้ง)")
+    parser.add_argument("--from-db", action="store_true", help="ใช้ทุกงวดที่เก็บไว้ใน bot.db")
+    parser.add_argument("--themes", default="default", help="ธีมคั่นด้วย , เช่น default,gold")
+    parser.add_argument("--all-themes", action="store_true")
+    parser.add_argument("--out", default="renders")
+    parser.add_argument("--workers", type=int, default=None, help="จำนวน process (ค่าเริ่มต้น = จำนวน CPU)")
+    parser.add_argument("--force", action="store_true", help="เรนเดอร์ใหม่แม้มีไฟล์อยู่แล้ว")
+    args = parser.parse_args(argv)
+    off = load_bot()
+    records: List[Dict[str, Any]] = []
+    for path in args.input:
+        records.extend(read_records(path))
+    if args.from_db:
+        rows = off._db().execute("SELECT data FROM lotto_results ORDER BY draw_key").fetchall()
+        records.extend(json.loads(r["data"]) for r in rows)
+    if not records:
+        parser.error("ไม่มีผลหวยให้เรนเดอร์ (ใช้ --input หรือ --from-db)")
+    themes = sorted(off.LOTTO_THEMES) if args.all_themes else [t.strip() for t in args.themes.split(",") if t.strip()]
+    unknown = [t for t in themes if t not in off.LOTTO_THEMES]
+    if unknown:
+        parser.error(f"ไม่รู้จักธีม {', '.join(unknown)} (มี {', '.join(sorted(off.LOTTO_THEMES))})")
+    t0 = time.perf_counter()
+    results = off.render_lotto_batch(records, themes, args.out, workers=args.workers, force=args.force)
+    elapsed = time.perf_counter() - t0
+    os.makedirs(args.out, exist_ok=True)
+    off._write_atomic(
+        os.path.join(args.out, "manifest.json"),
+        json.dumps(results, ensure_ascii=False, indent=2).encode("utf-8"),
+    )
+    rendered = sum(1 for r in results if r["rendered"])
+    print(f"{len(records)} งวด x {len(themes)} ธีม -> {len(results)} งาน | เรนเดอร์ {rendered} | ข้าม {len(results) - rendered} | {elapsed:.2f}s")
+    print(f"ไฟล์อยู่ที่ {os.path.abspath(args.out)}")
+    return 0
+if __name__ == "__main__":
+    sys.exit(main())